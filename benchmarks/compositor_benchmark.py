@@ -0,0 +1,96 @@
+# Compares the preallocated in-place compositor used by GridCamera/CurrentTimeCamera with the previous
+# hconcat/vconcat based approach.
+#
+# Usage: python benchmarks/compositor_benchmark.py [frames]
+import os
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+from camera import GridCamera, CurrentTimeCamera  # noqa: E402
+
+WIDTH = 640
+HEIGHT = 480
+CAMERA_COUNTS = [1, 4, 9]
+
+
+class StaticCamera:
+    def __init__(self, camera_id, width, height):
+        self.camera_id = camera_id
+        self.width = width
+        self.height = height
+        self.current_frame = np.full((height, width, 3), camera_id * 20, np.uint8)
+
+    def update_frame(self):
+        pass
+
+    def release(self):
+        pass
+
+    def stats(self):
+        return []
+
+
+def concat_compose(grid):
+    # The previous GridCamera._row_image/update_frame + CurrentTimeCamera.update_frame implementation
+    def row_image(row, fullWidth=None):
+        rowImage = row[0].current_frame
+        for cam in row[1:]:
+            rowImage = cv2.hconcat([rowImage, cam.current_frame])
+
+        if fullWidth is not None and rowImage.shape[1] != fullWidth:
+            blank_space = np.zeros((rowImage.shape[0], fullWidth - rowImage.shape[1], 3), np.uint8)
+            rowImage = cv2.hconcat([rowImage, blank_space])
+
+        return rowImage
+
+    fullImage = row_image(grid.camera_grid[0])
+    for row in grid.camera_grid[1:]:
+        fullImage = cv2.vconcat([fullImage, row_image(row, fullImage.shape[1])])
+
+    status = np.zeros((50, fullImage.shape[1], 3), np.uint8)
+    cv2.putText(status, time.strftime("%Y-%m-%d %H:%M:%S"), (0, 25), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 3)
+    return cv2.vconcat([status, fullImage])
+
+
+def measure(func, frames):
+    func()  # Warm up - the in-place path allocates its buffers on first use
+
+    start = time.perf_counter()
+    for _ in range(frames):
+        func()
+    per_frame_ms = (time.perf_counter() - start) * 1000 / frames
+
+    tracemalloc.start()
+    peak_bytes = 0
+    for _ in range(frames):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        func()
+        peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    return (per_frame_ms, peak_bytes)
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    print(f"{'cameras':>8} {'mode':>8} {'ms/frame':>10} {'alloc/frame':>14}")
+    for count in CAMERA_COUNTS:
+        cameras = [StaticCamera(i, WIDTH, HEIGHT) for i in range(count)]
+        grid = GridCamera(cameras)
+        composed = CurrentTimeCamera(grid)
+
+        for (mode, func) in [("concat", lambda: concat_compose(grid)), ("inplace", composed.update_frame)]:
+            (per_frame_ms, peak_bytes) = measure(func, frames)
+            print(f"{count:>8} {mode:>8} {per_frame_ms:>10.3f} {peak_bytes / 1024:>11.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# Measures the round trip latency and CPU cost of fetching segments of various sizes over the IPC connection
+# between the webserver and camera processes, plus the cost of encoding and decoding a single segment message on
+# its own compared with the previous JSON + base64 encoding.
+#
+# Usage: python benchmarks/ipc_benchmark.py [requests per size]
+import os
+import sys
+import time
+import json
+import base64
+import socket
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+import interprocess_communication as ipc  # noqa: E402
+
+SEGMENT_SIZES = [100 * 1024, 1024 * 1024, 5 * 1024 * 1024, 10 * 1024 * 1024]
+
+
+class FakeCameraManager:
+    def __init__(self):
+        self.segment_data = b""
+
+    def is_recording(self):
+        return False
+
+    def segment(self, last_received):
+        return ("segment.mp4", self.segment_data)
+
+    def recent_segment_names(self):
+        return []
+
+    def add_segment_listener(self, callback):
+        pass
+
+    def add_live_listener(self, init_listener, fragment_listener):
+        pass
+
+    def live_init_segment(self):
+        return None
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_connection(server):
+    start = time.time()
+    while time.time() - start < 10:
+        try:
+            server.is_recording()
+            return
+        except (TimeoutError, ConnectionError):
+            time.sleep(0.1)
+
+    raise TimeoutError("camera side never connected")
+
+
+def legacy_codec(data):
+    encoded = json.dumps({"value": base64.b64encode(data).decode("utf-8"), "filename": "segment.mp4"}).encode("utf-8")
+    decoded = json.loads(encoded.decode("utf-8"))
+    return base64.b64decode(decoded["value"].encode("utf-8"))
+
+
+def binary_codec(data):
+    encoded = ipc.encode_message(ipc.MESSAGE_TYPE_RESPONSE, ipc.NO_ID, {"filename": "segment.mp4"}, data)
+    (message, _) = ipc.decode_message(b"".join(encoded))
+    return message.payload
+
+
+def time_call(func, count):
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for _ in range(count):
+        func()
+    wall_ms = (time.perf_counter() - wall_start) * 1000 / count
+    cpu_ms = (time.process_time() - cpu_start) * 1000 / count
+    return (wall_ms, cpu_ms)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    print("Codec only (encode + decode of one segment response)")
+    print(f"{'size':>10} {'legacy ms':>10} {'binary ms':>10}")
+    for size in SEGMENT_SIZES:
+        data = os.urandom(size)
+        (legacy_ms, _) = time_call(lambda: legacy_codec(data), count)
+        (binary_ms, _) = time_call(lambda: binary_codec(data), count)
+        print(f"{size // 1024:>8}KB {legacy_ms:>10.2f} {binary_ms:>10.2f}")
+
+    print()
+    print("Segment round trip over IPC (CPU is for both ends)")
+    print(f"{'socket':>6} {'size':>10} {'wall ms':>10} {'cpu ms':>10}")
+
+    unix_socket_path = os.path.join(tempfile.gettempdir(), "camera-streamer-benchmark.sock")
+    for (name, path) in [("tcp", None), ("unix", unix_socket_path)]:
+        if path is not None and not ipc.unix_sockets_supported():
+            continue
+
+        round_trips(name, path, count)
+
+
+def round_trips(name, unix_socket_path, count):
+    camera_manager = FakeCameraManager()
+    port = free_port()
+    server = ipc.WebServerSide("localhost", port, unix_socket_path)
+    client = ipc.CameraClientSide(camera_manager, "localhost", port, "benchmark", unix_socket_path)
+
+    try:
+        wait_for_connection(server)
+
+        for size in SEGMENT_SIZES:
+            camera_manager.segment_data = os.urandom(size)
+            try:
+                (wall_ms, cpu_ms) = time_call(lambda: server.segment(""), count)
+                print(f"{name:>6} {size // 1024:>8}KB {wall_ms:>10.2f} {cpu_ms:>10.2f}")
+            except TimeoutError:
+                print(f"{name:>6} {size // 1024:>8}KB {'timeout':>10}")
+    finally:
+        client.stop()
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
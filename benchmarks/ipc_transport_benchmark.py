@@ -0,0 +1,74 @@
+# Compares the throughput of concurrent segment requests over the legacy select loop IPC transport and the asyncio
+# transport. The legacy transport needs a blocked thread per outstanding request, the asyncio one awaits them all on
+# its event loop.
+#
+# Usage: python benchmarks/ipc_transport_benchmark.py [segment size KB]
+import os
+import sys
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+import interprocess_communication  # noqa: E402
+import interprocess_communication_asyncio  # noqa: E402
+from ipc_benchmark import FakeCameraManager, free_port, wait_for_connection  # noqa: E402
+
+CONCURRENCY = [1, 10, 100, 1000]
+MIN_REQUESTS = 200
+
+
+def run_threaded(server, concurrency, requests):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda _: server.segment(""), range(requests)))
+
+
+def run_async(server, concurrency, requests):
+    async def run():
+        limit = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with limit:
+                await server.segment_async("")
+
+        await asyncio.gather(*[one() for _ in range(requests)])
+
+    asyncio.run_coroutine_threadsafe(run(), server.loop).result()
+
+
+def benchmark(name, module, runner, segment_size):
+    camera_manager = FakeCameraManager()
+    camera_manager.segment_data = os.urandom(segment_size)
+
+    port = free_port()
+    server = module.WebServerSide("localhost", port)
+    client = module.CameraClientSide(camera_manager, "localhost", port, "benchmark")
+
+    try:
+        wait_for_connection(server)
+
+        for concurrency in CONCURRENCY:
+            requests = max(concurrency, MIN_REQUESTS)
+            start = time.perf_counter()
+            try:
+                runner(server, concurrency, requests)
+                elapsed = time.perf_counter() - start
+                print(f"{name:>9} {concurrency:>12} {requests / elapsed:>12.0f} {elapsed * 1000 / requests:>12.2f}")
+            except TimeoutError:
+                print(f"{name:>9} {concurrency:>12} {'timeout':>12}")
+    finally:
+        client.stop()
+        server.stop()
+
+
+def main():
+    segment_size = (int(sys.argv[1]) if len(sys.argv) > 1 else 100) * 1024
+
+    print(f"{'transport':>9} {'concurrency':>12} {'requests/s':>12} {'ms/request':>12}")
+    benchmark("legacy", interprocess_communication, run_threaded, segment_size)
+    benchmark("asyncio", interprocess_communication_asyncio, run_async, segment_size)
+
+
+if __name__ == "__main__":
+    main()
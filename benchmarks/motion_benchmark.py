@@ -0,0 +1,75 @@
+# Times the motion detector on the composed frame of a grid of cameras, with something moving in front of the first
+# camera only, and shows the score it gives each camera.
+#
+# Usage: python benchmarks/motion_benchmark.py [frames] [cameras]
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+import settings  # noqa: E402
+from camera import GridCamera, CurrentTimeCamera, camera_regions  # noqa: E402
+from motion import MotionDetector  # noqa: E402
+
+WIDTH = 640
+HEIGHT = 480
+SQUARE_SIZE = 80
+
+
+class MovingSquareCamera:
+    def __init__(self, camera_id, width, height, moving):
+        self.camera_id = camera_id
+        self.width = width
+        self.height = height
+        self.moving = moving
+        self.frame_count = 0
+
+        rng = np.random.default_rng(camera_id)
+        self.background = rng.integers(60, 80, (height, width, 3), dtype=np.uint8)
+        self.current_frame = self.background.copy()
+
+    def update_frame(self):
+        self.frame_count += 1
+        np.copyto(self.current_frame, self.background)
+        if self.moving:
+            x = (self.frame_count * 16) % (self.width - SQUARE_SIZE)
+            self.current_frame[100:100 + SQUARE_SIZE, x:x + SQUARE_SIZE] = 255
+
+    def release(self):
+        pass
+
+    def stats(self):
+        return []
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    camera_count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    cameras = [MovingSquareCamera(i, WIDTH, HEIGHT, i == 0) for i in range(camera_count)]
+    camera = CurrentTimeCamera(GridCamera(cameras))
+    detector = MotionDetector(
+        camera_regions(camera), settings.MOTION_DOWNSCALE, settings.MOTION_PIXEL_THRESHOLD,
+        settings.MOTION_BACKGROUND_RATE)
+
+    times = []
+    scores = {}
+    for _ in range(frames):
+        camera.update_frame()
+        start = time.perf_counter()
+        scores = detector.update(camera.current_frame)
+        times.append(time.perf_counter() - start)
+
+    times.sort()
+    print(f"{camera_count} cameras, {camera.width}x{camera.height} frame, downscaled {settings.MOTION_DOWNSCALE}x")
+    print(f"per frame: {sum(times) / len(times) * 1000:.2f}ms avg, {times[len(times) * 99 // 100] * 1000:.2f}ms p99")
+    for (camera_id, score) in scores.items():
+        moving = "motion" if score >= settings.MOTION_SCORE_THRESHOLD else "still"
+        print(f"camera {camera_id}: {score:.3f} ({moving})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# Compares the frame rate a grid of mock cameras is captured, put together and recorded at (mp4v parts, as the
+# recorder writes them) with everything in threads of one process against settings.CAMERA_PROCESSES, where each camera
+# is captured and the video encoded in processes of their own. The capture loop runs like the camera process' one,
+# aiming for the frame rate given - it's only reached if everything keeps up.
+#
+# Parts aren't combined, only the video is recorded, and frames aren't shown anywhere - see recording_benchmark.py for
+# what combining costs.
+#
+# Usage: python benchmarks/pipeline_benchmark.py [--seconds 10] [--fps 30] [--cameras 1,2,4,8]
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+import settings  # noqa: E402
+
+settings.RECORD_AUDIO = False
+# One long part, so there's nothing to combine
+settings.RECORDINGS_FRAMES_PER_FILE = -1
+settings.RECORDINGS_PERSISTENT_ENCODER = False
+settings.FRAME_RING_NAME = "camera-streamer-pipeline-benchmark"
+
+from camera import MockCamera, ThreadedCamera, ProcessCamera, GridCamera, CurrentTimeCamera  # noqa: E402
+from frame_ring import FrameRing  # noqa: E402
+from recorder import Recorder  # noqa: E402
+
+
+# CPU time used by this process and its children, or None if it can't be measured. resource (Unix only) counts children
+# once they've exited, psutil (elsewhere, if installed) while they're still running - so it's measured both before and
+# after the pipeline is released, and the larger is used.
+def cpu_seconds():
+    try:
+        import resource
+    except ImportError:
+        return psutil_cpu_seconds()
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def psutil_cpu_seconds():
+    try:
+        import psutil
+    except ImportError:
+        return None
+
+    process = psutil.Process()
+    processes = [process] + process.children(recursive=True)
+    total = 0
+    for p in processes:
+        try:
+            times = p.cpu_times()
+        except psutil.Error:  # Exited meanwhile
+            continue
+        total += times.user + times.system
+    return total
+
+
+def create_cameras(count, processes):
+    if processes:
+        return [
+            ProcessCamera(
+                i, settings.CAMERA_WIDTH, settings.CAMERA_HEIGHT, settings.CAMERA_FPS,
+                f"{settings.FRAME_RING_NAME}-capture-{i}", mock=True)
+            for i in range(count)
+        ]
+
+    return [
+        ThreadedCamera(MockCamera(i, settings.CAMERA_WIDTH, settings.CAMERA_HEIGHT), settings.CAMERA_FPS)
+        for i in range(count)
+    ]
+
+
+def run(count, processes, seconds):
+    settings.CAMERA_PROCESSES = processes
+    settings.RECORDINGS_DIRECTORY = tempfile.mkdtemp()
+    os.mkdir(os.path.join(settings.RECORDINGS_DIRECTORY, settings.RECORDINGS_PARTS_SUBDIR_NAME))
+
+    camera = CurrentTimeCamera(GridCamera(create_cameras(count, processes)))
+    ring = FrameRing.create(settings.FRAME_RING_NAME, camera.width, camera.height, settings.FRAME_RING_SLOTS)
+    recorder = Recorder(ring)
+
+    # Let the processes start up before timing anything
+    time.sleep(1)
+    first_stats = recorder.frame_stats()
+    first_sequence = ring.latest_sequence()
+    cpu_start = cpu_seconds()
+
+    start_time = time.time()
+    seconds_per_frame = 1 / settings.CAMERA_FPS
+    while time.time() - start_time < seconds:
+        camera.update_frame()
+        ring.write(camera.current_frame, time.time())
+
+        time_since_start = time.time() - start_time
+        sleep_time = seconds_per_frame - (time_since_start % seconds_per_frame)
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+
+    # Give the recorder (and its stats) time to catch up with the last frames
+    time.sleep(1.5)
+    elapsed = time.time() - start_time
+    stats = recorder.frame_stats()
+    camera_fps = [s["fps"] for s in camera.stats()]
+    ring_frames = ring.latest_sequence()
+    cpu_running = cpu_seconds()
+
+    camera.release()
+    recorder.release()
+    ring.release()
+    cpu_released = cpu_seconds()
+    shutil.rmtree(settings.RECORDINGS_DIRECTORY)
+
+    composed = (ring_frames - first_sequence) / seconds
+    recorded = (stats["frames_written"] - first_stats["frames_written"]) / seconds
+    dropped = stats["dropped"] - first_stats["dropped"]
+
+    cpu = "n/a"
+    if cpu_start is not None:
+        cpu = f"{(max(cpu_running, cpu_released) - cpu_start) / elapsed * 100:.0f}%"
+
+    mode = "processes" if processes else "threads"
+    print(f"{count:>7} {mode:<10} {camera.width:>5}x{camera.height:<5} {sum(camera_fps) / len(camera_fps):>10.1f} "
+          f"{composed:>8.1f} {recorded:>8.1f} {dropped:>7} {cpu:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=int, default=10, help="How long to run each for")
+    parser.add_argument("--fps", type=int, default=30, help="Frame rate to aim for")
+    parser.add_argument("--cameras", default="1,2,4,8", help="Numbers of cameras to try, comma separated")
+    args = parser.parse_args()
+
+    settings.CAMERA_FPS = args.fps
+
+    print(f"{args.seconds}s at up to {args.fps} fps, {settings.CAMERA_WIDTH}x{settings.CAMERA_HEIGHT} cameras, "
+          f"{os.cpu_count()} cores")
+    print(f"{'cameras':>7} {'mode':<10} {'grid':>11} {'camera fps':>10} {'composed':>8} {'recorded':>8} {'dropped':>7} "
+          f"{'CPU':>7}")
+    for count in [int(c) for c in args.cameras.split(",")]:
+        for processes in (False, True):
+            run(count, processes, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# Compares the CPU time and disk space it takes to record with the persistent segment encoder (raw frames piped
+# straight into one ffmpeg process, as BGR or as I420) against writing mp4v + wav parts and combining each pair with a
+# new ffmpeg process. Frames are fed as fast as they're encoded, and the results are scaled to an hour of recording.
+# Disk space includes the parts, which the recorder keeps by default (RECORDINGS_KEEP_PARTS).
+#
+# Usage: python benchmarks/recording_benchmark.py [--seconds 20] [--ffmpeg path/to/ffmpeg]
+import os
+import sys
+import time
+import wave
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+import settings  # noqa: E402
+
+settings.RECORD_AUDIO = False  # No microphone needed, audio is generated
+
+import ffmpeg  # noqa: E402
+from recorder import encoder_frame, RATE, CHANNELS, WIDTH as SAMPLE_WIDTH  # noqa: E402
+
+WIDTH = settings.CAMERA_WIDTH
+HEIGHT = settings.CAMERA_HEIGHT
+FPS = settings.CAMERA_FPS
+SEGMENT_SECONDS = 2
+
+
+# Something for the encoder to work at - a moving gradient with some noise, roughly like a camera
+def make_frames(count):
+    x = np.linspace(0, 255, WIDTH, dtype=np.float32)
+    rng = np.random.default_rng(0)
+    frames = []
+    for i in range(min(count, FPS * 4)):
+        frame = np.empty((HEIGHT, WIDTH, 3), np.uint8)
+        frame[:, :, 0] = np.roll(x, i * 8).astype(np.uint8)
+        frame[:, :, 1] = np.linspace(0, 255, HEIGHT, dtype=np.uint8)[:, None]
+        frame[:, :, 2] = 128
+        frame += rng.integers(0, 8, frame.shape, dtype=np.uint8)
+        frames.append(frame)
+    return [frames[i % len(frames)] for i in range(count)]
+
+
+def audio_samples(seconds):
+    t = np.arange(int(seconds * RATE)) / RATE
+    return (np.sin(2 * np.pi * 440 * t) * 8000).astype(np.int16).tobytes()
+
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def directory_bytes(directory):
+    return sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+
+
+def record_parts(directory, frames):
+    frames_per_part = FPS * SEGMENT_SECONDS
+    part_audio = audio_samples(SEGMENT_SECONDS)
+    threads = []
+
+    for part in range(0, len(frames), frames_per_part):
+        video_filename = os.path.join(directory, f"{part:06}-video.mp4")
+        audio_filename = os.path.join(directory, f"{part:06}-audio.wav")
+
+        writer = cv2.VideoWriter(video_filename, cv2.VideoWriter_fourcc(*"mp4v"), FPS, (WIDTH, HEIGHT))
+        for frame in frames[part:part + frames_per_part]:
+            writer.write(frame)
+        writer.release()
+
+        with wave.open(audio_filename, "wb") as f:
+            f.setnchannels(CHANNELS)
+            f.setsampwidth(SAMPLE_WIDTH)
+            f.setframerate(RATE)
+            f.writeframes(part_audio)
+
+        # Combined in the background, like the recorder does
+        out_filename = os.path.join(directory, f"{part:06}.mp4")
+        thread = threading.Thread(
+            target=ffmpeg.combine_video_audio, args=(video_filename, audio_filename, out_filename))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return directory_bytes(directory)
+
+
+def record_pipe(directory, frames, pixel_format):
+    (audio_read, audio_write) = os.pipe()
+    process = ffmpeg.start_segment_encoder(
+        WIDTH, HEIGHT, FPS, SEGMENT_SECONDS, os.path.join(directory, "%Y-%m-%d-%H-%M-%S.mp4"),
+        audio_read, RATE, CHANNELS, pixel_format)
+    os.close(audio_read)
+
+    def write_audio():
+        with os.fdopen(audio_write, "wb") as f:
+            f.write(audio_samples(len(frames) / FPS))
+
+    # Segments are named by the second they start in, and several are encoded each second here - so each is sized
+    # as soon as it's finished, before the next one with its name overwrites it
+    written = [0]
+
+    def read_segments():
+        for line in process.stdout:
+            written[0] += os.path.getsize(os.path.join(directory, os.fsdecode(line.strip())))
+
+    threads = [threading.Thread(target=write_audio), threading.Thread(target=read_segments)]
+    for thread in threads:
+        thread.start()
+
+    for frame in frames:
+        process.stdin.write(encoder_frame(frame, pixel_format))
+    process.stdin.close()
+
+    for thread in threads:
+        thread.join()
+    process.wait()
+
+    return written[0]
+
+
+def run(name, record, frames):
+    directory = tempfile.mkdtemp(prefix="recording-benchmark-")
+    try:
+        cpu_start = cpu_seconds()
+        start = time.perf_counter()
+        written = record(directory)
+        elapsed = time.perf_counter() - start
+        cpu = cpu_seconds() - cpu_start
+    finally:
+        shutil.rmtree(directory)
+
+    media_seconds = len(frames) / FPS
+    print(
+        f"{name:<20} {elapsed:>7.2f}s {cpu / media_seconds * 100:>10.1f}% "
+        f"{written / media_seconds * 3600 / 1024 / 1024 / 1024:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=int, default=20, help="Seconds of video to record")
+    parser.add_argument("--ffmpeg", default=ffmpeg.FFMPEG_EXE, help="ffmpeg to use (needs libx264)")
+    args = parser.parse_args()
+
+    ffmpeg.FFMPEG_EXE = args.ffmpeg
+    frames = make_frames(args.seconds * FPS)
+
+    print(f"{args.seconds}s of {WIDTH}x{HEIGHT} video at {FPS} fps, with audio")
+    print(f"{'':<20} {'time':>8} {'CPU/stream':>11} {'GB/hour':>12}")
+    run("mp4v parts + combine", lambda directory: record_parts(directory, frames), frames)
+    run("pipe (bgr24)", lambda directory: record_pipe(directory, frames, "bgr24"), frames)
+    run("pipe (yuv420p)", lambda directory: record_pipe(directory, frames, "yuv420p"), frames)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# Simulates a number of viewers polling /segment at the same time and reports the latency they see, optionally with
+# some of them on a slow link (reading their segments slowly) to show how much they hold up everyone else.
+#
+# By default a webserver is started in this process, serving a fake segment from a temporary directory. With
+# --over-ipc it's fetched from a fake camera process instead, with a new segment every second, and the number of
+# fetches that reached the camera process is reported. Pass --url to load test an already running server instead.
+#
+# Usage: python benchmarks/webserver_load_test.py [--viewers N] [--slow-viewers N] [--seconds N] [--workers N]
+#                                                  [--segment-kb N] [--over-ipc] [--url http://host:port]
+import os
+import sys
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import http.client
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+import settings  # noqa: E402
+
+SEGMENT_NAME = "2000-01-01-00-00-00.mp4"
+SLOW_VIEWER_CHUNK = 16 * 1024
+SLOW_VIEWER_CHUNK_DELAY = 0.05
+IPC_FETCH_SECONDS = 0.02
+
+
+class FakeCameraComm:
+    def __init__(self, over_ipc, segment_kb):
+        self.over_ipc = over_ipc
+        self.data = os.urandom(segment_kb * 1024)
+        self.fetches = 0
+
+    def segment_name(self, last_received, camera_id=None):
+        if self.over_ipc:
+            return time.strftime(settings.RECORDINGS_FILENAME_FORMAT) + settings.RECORDINGS_FILENAME_VIDEO_EXTENSION
+        return SEGMENT_NAME
+
+    def is_local_camera(self, camera_id=None):
+        return not self.over_ipc
+
+    def resolve_camera_id(self, camera_id=None):
+        return "camera"
+
+    def segment_data(self, filename, camera_id=None):
+        self.fetches += 1
+        time.sleep(IPC_FETCH_SECONDS)
+        return self.data
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def start_local_server(workers, cam_comm):
+    directory = tempfile.mkdtemp()
+    os.makedirs(os.path.join(directory, settings.RECORDINGS_PARTS_SUBDIR_NAME))
+    with open(os.path.join(directory, settings.RECORDINGS_PARTS_SUBDIR_NAME, SEGMENT_NAME), "wb") as f:
+        f.write(cam_comm.data)
+
+    settings.RECORDINGS_DIRECTORY = directory
+    settings.WEBSERVER_WORKERS = workers
+
+    import webserver
+
+    webserver.server.port = free_port()
+    webserver.setup(cam_comm)
+    thread = threading.Thread(target=webserver.start_listening, name="Load Test Server", daemon=True)
+    thread.start()
+
+    url = f"http://localhost:{webserver.server.port}"
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", webserver.server.port)).close()
+            break
+        except ConnectionError:
+            time.sleep(0.05)
+
+    def stop():
+        webserver.server.stop()
+        thread.join()
+        shutil.rmtree(directory)
+
+    return (url, stop)
+
+
+def viewer(url, slow, deadline, latencies, errors):
+    parsed = urllib.parse.urlsplit(url)
+    connection = None
+
+    while time.time() < deadline:
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=30)
+
+            start = time.perf_counter()
+            connection.request("GET", "/segment")
+            response = connection.getresponse()
+            if slow:
+                while response.read(SLOW_VIEWER_CHUNK):
+                    time.sleep(SLOW_VIEWER_CHUNK_DELAY)
+            else:
+                response.read()
+            latency = time.perf_counter() - start
+
+            if response.status != 200:
+                errors.append(response.status)
+            elif not slow:
+                latencies.append(latency)
+
+            if response.will_close:
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException) as ex:
+            errors.append(ex)
+            if connection is not None:
+                connection.close()
+            connection = None
+
+    if connection is not None:
+        connection.close()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--viewers", type=int, default=20)
+    parser.add_argument("--slow-viewers", type=int, default=0)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=settings.WEBSERVER_WORKERS)
+    parser.add_argument("--segment-kb", type=int, default=500)
+    parser.add_argument("--over-ipc", action="store_true")
+    parser.add_argument("--url")
+    args = parser.parse_args()
+
+    cam_comm = FakeCameraComm(args.over_ipc, args.segment_kb)
+    if args.url is None:
+        (url, stop) = start_local_server(args.workers, cam_comm)
+    else:
+        (url, stop) = (args.url, lambda: None)
+
+    latencies = []
+    errors = []
+    deadline = time.time() + args.seconds
+    threads = [
+        threading.Thread(target=viewer, args=(url, i < args.slow_viewers, deadline, latencies, errors))
+        for i in range(args.viewers + args.slow_viewers)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    stop()
+
+    print(f"{args.viewers} viewers, {args.slow_viewers} slow viewers, {args.seconds}s against {url}")
+    if len(latencies) == 0:
+        print("No successful requests")
+    else:
+        print(f"requests: {len(latencies)} ({len(latencies) / args.seconds:.1f}/s), errors: {len(errors)}")
+        print(f"p50: {percentile(latencies, 0.5) * 1000:.2f}ms  p99: {percentile(latencies, 0.99) * 1000:.2f}ms  "
+              f"max: {max(latencies) * 1000:.2f}ms")
+
+    if args.over_ipc and args.url is None:
+        print(f"segments fetched from the camera process: {cam_comm.fetches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,15 @@ import random
 import math
 import time
 import logging
+import threading
 
 import cv2
 import numpy as np
 
+from frame_ring import FrameRing
+import pipeline_process
+from utils import Mutex
+
 
 class Camera:
     def __init__(self, camera_id, width, height):
@@ -27,6 +32,11 @@ class Camera:
         if frame_width > 0 and frame_height > 0 and fps > 0:
             logging.info(f"camera {self.camera_id} - width: {frame_width}, height: {frame_height}, fps: {fps}")
 
+        # The requested size is only a hint, use what the camera actually gives us so the grid lines up
+        if frame_width > 0 and frame_height > 0:
+            self.width = int(frame_width)
+            self.height = int(frame_height)
+
         self.update_frame()
 
     def update_frame(self):
@@ -36,6 +46,9 @@ class Camera:
     def release(self):
         self.camera.release()
 
+    def stats(self):
+        return []
+
 
 class MockCamera:
     def __init__(self, camera_id, width, height):
@@ -67,6 +80,189 @@ class MockCamera:
     def release(self):
         pass
 
+    def stats(self):
+        return []
+
+
+class ThreadedCamera:
+    # Drives a single camera from its own thread so a slow device cannot stall the others - update_frame just
+    # picks up whatever frame was most recently read
+    def __init__(self, camera, fps):
+        if camera is None:
+            raise Exception("No camera supplied")
+
+        self.camera_id = camera.camera_id
+        self.camera = camera
+        self.width = camera.width
+        self.height = camera.height
+        self.fps = fps
+
+        self.latest_frame = Mutex(camera.current_frame)
+        self.current_frame = camera.current_frame
+
+        self.frames_read = 0
+        self.dropped_reads = 0
+        self.achieved_fps = 0.0
+
+        self._background_reader_running = True
+        self.background_thread = threading.Thread(
+            target=self._read_in_background,
+            name=f"Camera {self.camera_id} Reader"
+        )
+        self.background_thread.start()
+
+    def update_frame(self):
+        with self.latest_frame.acquire() as lock:
+            self.current_frame = lock.value
+
+    def release(self):
+        self._background_reader_running = False
+        self.background_thread.join()
+        self.camera.release()
+
+    def stats(self):
+        return [{
+            "camera_id": self.camera_id,
+            "fps": self.achieved_fps,
+            "frames_read": self.frames_read,
+            "dropped_reads": self.dropped_reads,
+        }]
+
+    def _read_in_background(self):
+        start_time = time.time()
+        seconds_per_frame = 1 / self.fps
+
+        window_start = start_time
+        window_frames = 0
+
+        while self._background_reader_running:
+            self.camera.update_frame()
+            frame = self.camera.current_frame
+
+            if frame is None:
+                self.dropped_reads += 1
+            else:
+                with self.latest_frame.acquire() as lock:
+                    lock.value = frame
+                self.frames_read += 1
+                window_frames += 1
+
+            current_time = time.time()
+            if current_time - window_start >= 1:
+                self.achieved_fps = window_frames / (current_time - window_start)
+                window_start = current_time
+                window_frames = 0
+
+            time_since_start = current_time - start_time
+            sleep_time = seconds_per_frame - (time_since_start % seconds_per_frame)
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+
+
+# How many frames a capture process' ring holds - only the latest is ever read
+CAPTURE_RING_SLOTS = 4
+
+
+# Like ThreadedCamera, but the camera is read by a process of its own (see pipeline_process), which writes each frame
+# into a frame ring named ring_name. update_frame copies the latest frame out of the ring, so it can't be overwritten
+# while it's drawn.
+class ProcessCamera:
+    def __init__(self, camera_id, width, height, fps, ring_name, mock=False):
+        self.camera_id = camera_id
+        self.fps = fps
+
+        (self.process, self.conn) = pipeline_process.start(
+            __name__, "capture_in_process", (camera_id, width, height, fps, ring_name, mock),
+            f"Camera {camera_id} Capture")
+
+        # The camera decides its own size, the ring is ready once it's known
+        (self.width, self.height) = self.conn.recv()
+        self.ring = FrameRing.attach(ring_name, shared_tracker=True)
+
+        # Frames are copied out of the ring into the scratch frame, which only becomes the current frame once the copy
+        # is known to be whole - the current frame itself is never written to
+        self.scratch_frame = np.zeros((self.height, self.width, 3), np.uint8)
+        self.sequence = 0
+        self.current_frame = None
+
+        self.dropped_reads = 0
+        self.achieved_fps = 0.0
+
+        self.update_frame()
+
+    def update_frame(self):
+        while self.conn.poll():
+            (self.achieved_fps, self.dropped_reads) = self.conn.recv()
+
+        latest = self.ring.latest()
+        if latest is None or latest.sequence == self.sequence:
+            return
+
+        # The current frame is kept if this one is overwritten meanwhile
+        np.copyto(self.scratch_frame, latest.data)
+        if not self.ring.is_current(latest):
+            return
+
+        self.sequence = latest.sequence
+        previous = self.current_frame
+        self.current_frame = self.scratch_frame
+        self.scratch_frame = previous if previous is not None else np.zeros_like(self.current_frame)
+
+    def release(self):
+        self.conn.send("terminate")
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+        self.current_frame = None
+        self.ring.release()
+
+    def stats(self):
+        return [{
+            "camera_id": self.camera_id,
+            "fps": self.achieved_fps,
+            "frames_read": self.sequence,
+            "dropped_reads": self.dropped_reads,
+        }]
+
+
+# Run by ProcessCamera's process - reads the camera at fps until told to stop, and sends back how it's doing once a
+# second
+def capture_in_process(camera_id, width, height, fps, ring_name, mock, conn):
+    camera = MockCamera(camera_id, width, height) if mock else Camera(camera_id, width, height)
+    ring = FrameRing.create(ring_name, camera.width, camera.height, CAPTURE_RING_SLOTS)
+    conn.send((camera.width, camera.height))
+
+    start_time = time.time()
+    seconds_per_frame = 1 / fps
+
+    window_start = start_time
+    window_frames = 0
+    dropped_reads = 0
+
+    try:
+        while not conn.poll():
+            camera.update_frame()
+            if camera.current_frame is None:
+                dropped_reads += 1
+            else:
+                ring.write(camera.current_frame, time.time())
+                window_frames += 1
+
+            current_time = time.time()
+            if current_time - window_start >= 1:
+                conn.send((window_frames / (current_time - window_start), dropped_reads))
+                window_start = current_time
+                window_frames = 0
+
+            time_since_start = current_time - start_time
+            sleep_time = seconds_per_frame - (time_since_start % seconds_per_frame)
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+    finally:
+        camera.release()
+        ring.release()
+
 
 class CurrentTimeCamera:
     _id = 0
@@ -82,25 +278,42 @@ class CurrentTimeCamera:
         self.width = camera.width
         self.height = camera.height + self._determine_status_bar_height()
 
+        self.frame_buffers = FrameBuffers(self.width, self.height)
+
+        # The text only changes once a second, so render it once and copy the result in every frame
+        self.status_bar = np.zeros((self._determine_status_bar_height(), self.width, 3), np.uint8)
+        self.status_text = None
+
         self.update_frame()
 
     def update_frame(self):
-        self.camera.update_frame()
+        self.current_frame = self.draw_into(self.frame_buffers.next())
+
+    def draw_into(self, out):
+        status_bar_height = self._determine_status_bar_height()
 
-        time = self._create_status_image(self.camera.current_frame.shape[1])
-        # import pdb; pdb.set_trace()
-        self.current_frame = cv2.vconcat([time, self.camera.current_frame])
+        self._update_status_bar()
+        np.copyto(out[:status_bar_height], self.status_bar)
+        draw_camera_into(self.camera, out[status_bar_height:])
+
+        return out
 
     def release(self):
         self.camera.release()
 
-    @staticmethod
-    def _create_status_image(width):
-        height = CurrentTimeCamera._determine_status_bar_height()
-        result = np.zeros((height, width, 3), np.uint8)
+    def stats(self):
+        return self.camera.stats()
+
+    def _update_status_bar(self):
+        text = time.strftime("%Y-%m-%d %H:%M:%S")
+        if text == self.status_text:
+            return
+
+        self.status_text = text
+        self.status_bar.fill(0)
         cv2.putText(
-            result,
-            time.strftime("%Y-%m-%d %H:%M:%S"),
+            self.status_bar,
+            text,
             (0, 25),
             cv2.FONT_HERSHEY_SIMPLEX,
             1,
@@ -108,13 +321,54 @@ class CurrentTimeCamera:
             3
         )
 
-        return result
-
     @staticmethod
     def _determine_status_bar_height():
         return 50  # TODO Make better?
 
 
+# A smaller copy of a camera's frames, downscale times smaller each way (rounded down to even sizes, as encoders need).
+# The camera isn't updated here - this follows a camera something else updates (e.g. another pipeline), so however
+# many copies are wanted, the frame is only drawn once and each copy is one resize of it.
+class ScaledCamera:
+    _id = 0
+
+    def __init__(self, camera, downscale):
+        if camera is None:
+            raise Exception("No camera supplied")
+
+        self.camera_id = "Scaled-" + str(ScaledCamera._id)
+        ScaledCamera._id += 1
+
+        self.camera = camera
+        self.downscale = max(1, downscale)
+        self.width = max(2, camera.width // self.downscale // 2 * 2)
+        self.height = max(2, camera.height // self.downscale // 2 * 2)
+
+        self.frame_buffers = FrameBuffers(self.width, self.height)
+        self.current_frame = None
+
+        self.update_frame()
+
+    def update_frame(self):
+        frame = self.camera.current_frame
+        if frame is None:
+            return
+
+        # Shrunk to twice the size with a linear resize and then averaged 2x2 - several times quicker than an
+        # INTER_AREA resize straight down (as in motion.MotionDetector)
+        cropped = frame[:self.height * self.downscale, :self.width * self.downscale]
+        if self.downscale > 2:
+            cropped = cv2.resize(cropped, (self.width * 2, self.height * 2), interpolation=cv2.INTER_LINEAR)
+        self.current_frame = cv2.resize(
+            cropped, (self.width, self.height), dst=self.frame_buffers.next(), interpolation=cv2.INTER_AREA)
+
+    def release(self):
+        pass
+
+    def stats(self):
+        return []
+
+
 class GridCamera:
     _id = 0
 
@@ -129,37 +383,31 @@ class GridCamera:
 
         self.camera_grid = self._generate_camera_grid(self.cameras)
         self.width, self.height = self._determine_size()
+        self.tiles = self._determine_tiles()
 
-        self.update_frame()
+        # Only allocated if this camera is used on its own - when wrapped, the wrapper draws us into its own buffer
+        self.frame_buffers = None
+        self.current_frame = None
 
     def update_frame(self):
-        for camera in self.cameras:
-            camera.update_frame()
+        if self.frame_buffers is None:
+            self.frame_buffers = FrameBuffers(self.width, self.height)
 
-        fullImage = self._row_image(self.camera_grid[0])
+        self.draw_into(self.frame_buffers.next())
 
-        for row in self.camera_grid[1:]:
-            rowImage = self._row_image(row, fullImage.shape[1])
-            fullImage = cv2.vconcat([fullImage, rowImage])
+    def draw_into(self, out):
+        for (camera, x, y) in self.tiles:
+            draw_camera_into(camera, out[y:y + camera.height, x:x + camera.width])
 
-        self.current_frame = fullImage
+        self.current_frame = out
+        return out
 
     def release(self):
         for camera in self.cameras:
             camera.release()
 
-    def _row_image(self, row, fullWidth=None):
-        # Create the row image by concatenating the images horizontally
-        rowImage = row[0].current_frame
-        for cam in row[1:]:
-            rowImage = cv2.hconcat([rowImage, cam.current_frame])
-
-        # Ensure the row is as wide as the whole image by adding some black space on the right
-        if fullWidth is not None and rowImage.shape[1] != fullWidth:
-            blank_space = np.zeros((rowImage.shape[0], fullWidth - rowImage.shape[1], 3), np.uint8)
-            rowImage = cv2.hconcat([rowImage, blank_space])
-
-        return rowImage
+    def stats(self):
+        return [stat for camera in self.cameras for stat in camera.stats()]
 
     @staticmethod
     def _generate_camera_grid(cameras):
@@ -192,9 +440,84 @@ class GridCamera:
 
         return (width, height)
 
+    def _determine_tiles(self):
+        tiles = []
+
+        y = 0
+        for row in self.camera_grid:
+            x = 0
+            for cam in row:
+                tiles.append((cam, x, y))
+                x += cam.width
+
+            y += self._determine_row_size(row)[1]
+
+        return tiles
+
     @staticmethod
     def _determine_row_size(row):
         rowWidth = sum(cam.width for cam in row)
         rowHeight = max(cam.height for cam in row)
 
         return (rowWidth, rowHeight)
+
+
+class FrameBuffers:
+    # Frames are composed in place into preallocated buffers rather than allocating a new image every frame. Two
+    # buffers are alternated between so the previous frame stays intact while other threads may still be reading it.
+    BUFFER_COUNT = 2
+
+    def __init__(self, width, height):
+        self.buffers = [np.zeros((height, width, 3), np.uint8) for _ in range(FrameBuffers.BUFFER_COUNT)]
+        self.index = 0
+
+    def next(self):
+        self.index = (self.index + 1) % len(self.buffers)
+        return self.buffers[self.index]
+
+
+def draw_camera_into(camera, out):
+    if hasattr(camera, "draw_into"):
+        camera.draw_into(out)
+        return
+
+    camera.update_frame()
+    frame = camera.current_frame
+    # out is reused, so anything not drawn over would still show an older frame
+    if frame is None:
+        out.fill(0)
+        return
+
+    # Cameras don't always honour the requested size, only copy the region that overlaps the tile and clear the rest
+    height = min(frame.shape[0], out.shape[0])
+    width = min(frame.shape[1], out.shape[1])
+    out[:height, :width] = frame[:height, :width]
+    out[height:] = 0
+    out[:height, width:] = 0
+
+
+# Where each underlying camera is drawn in camera's frames, as (camera id, x, y, width, height)
+def camera_regions(camera):
+    if isinstance(camera, CurrentTimeCamera):
+        status_bar_height = camera._determine_status_bar_height()
+        return [(c, x, y + status_bar_height, w, h) for (c, x, y, w, h) in camera_regions(camera.camera)]
+
+    if isinstance(camera, GridCamera):
+        return [
+            (c, tile_x + x, tile_y + y, w, h)
+            for (tile_camera, tile_x, tile_y) in camera.tiles
+            for (c, x, y, w, h) in camera_regions(tile_camera)
+        ]
+
+    return [(camera.camera_id, 0, 0, camera.width, camera.height)]
+
+
+# The cameras camera's frames are read from - a new frame from any of them is a new frame of camera's
+def source_cameras(camera):
+    if isinstance(camera, (CurrentTimeCamera, ScaledCamera)):
+        return source_cameras(camera.camera)
+
+    if isinstance(camera, GridCamera):
+        return [source for c in camera.cameras for source in source_cameras(c)]
+
+    return [camera]
@@ -2,8 +2,15 @@ import time
 import os
 import logging
 
-from camera import Camera, MockCamera, GridCamera, CurrentTimeCamera
+from camera import Camera, MockCamera, ThreadedCamera, ProcessCamera, GridCamera, CurrentTimeCamera, ScaledCamera, \
+    camera_regions, source_cameras
+from combine_queue import OVERLOAD_PAUSE_LIVE
+from frame_ring import FrameRing
+from hls import is_hls_path, LIVE_PLAYLIST_NAME
+from live_stream import LiveStream
+from motion import MotionDetector, MotionTrigger
 from recorder import Recorder
+from segments import next_segment_name, camera_name, RECENT_SEGMENTS, THUMBNAIL_NAME
 
 import settings
 
@@ -24,25 +31,292 @@ def _create_cameras():
             else:
                 test.release()
 
-    return _merge_cameras(cameras)
+    if settings.CAMERA_PROCESSES:
+        # Each camera is opened again by its own process
+        for c in cameras:
+            c.release()
 
+        return _merge_cameras([
+            ProcessCamera(
+                c.camera_id, c.width, c.height, settings.CAMERA_FPS,
+                f"{settings.FRAME_RING_NAME}-capture-{c.camera_id}", mock=settings.USE_MOCK_CAMERAS)
+            for c in cameras
+        ])
 
+    return _merge_cameras([ThreadedCamera(c, settings.CAMERA_FPS) for c in cameras])
+
+
+# Returns the camera the grid of every camera is drawn by, and the pipelines to capture - the grid's first, recorded
+# unless settings.RECORDINGS_PER_CAMERA records one per camera instead, then the thumbnail grid's if there is one. The
+# thumbnail grid is shrunk from the grid's frames once they've been drawn, so the grid's pipeline has to come before it.
 def _merge_cameras(cameras):
-    return CurrentTimeCamera(GridCamera(cameras))
+    grid = CurrentTimeCamera(GridCamera(cameras))
+    pipelines = [CameraPipeline(None, grid, None, record=not settings.RECORDINGS_PER_CAMERA)]
+
+    if settings.RECORDINGS_PER_CAMERA:
+        for (i, c) in enumerate(cameras):
+            pipelines.append(
+                CameraPipeline(camera_name(c.camera_id), CurrentTimeCamera(c), c, record=True, record_audio=i == 0))
+
+    if settings.THUMBNAIL_GRID_DOWNSCALE > 0:
+        thumbnails = ScaledCamera(grid, settings.THUMBNAIL_GRID_DOWNSCALE)
+        pipelines.append(
+            CameraPipeline(THUMBNAIL_NAME, thumbnails, None, record=True, record_audio=False, watch_only=True))
+
+    return (grid, pipelines)
+
+
+def _create_recordings_directories():
+    if not os.path.exists(settings.RECORDINGS_DIRECTORY):
+        os.mkdir(settings.RECORDINGS_DIRECTORY)
+
+    parts_dir = os.path.join(settings.RECORDINGS_DIRECTORY, settings.RECORDINGS_PARTS_SUBDIR_NAME)
+    if not os.path.exists(parts_dir):
+        os.mkdir(parts_dir)
 
 
-camera = _create_cameras()
+# The frames of one camera (or of the grid of every camera), and everything fed from them - a frame ring, a live stream
+# and, if it's recorded, a recorder with motion detection. Pipelines have the same interface as this module, so each
+# can be served as a camera of its own (see main.start_cameras).
+#
+# name - None for the grid, which is the default camera, otherwise added to the frame ring's and recordings' names
+# source - the underlying camera (None for every camera the frames are drawn from) - a frame is only captured when one
+# of them has a new frame, as otherwise it would be the same as the last one
+# watch_only - its segments are recorded to be watched, but recordings aren't made of them
+class CameraPipeline:
+    def __init__(self, name, camera, source, record, record_audio=True, watch_only=False):
+        self.name = name
+        self.camera_id = settings.CAMERA_ID if name is None else f"{settings.CAMERA_ID}-{name}"
+        self.watch_only = watch_only
+        self.camera = camera
+        self.source = source
+        self.sources = [source] if source is not None else source_cameras(camera)
+        self.last_source_frames = None
+
+        self.frames_captured = 0
+        self.unchanged_frames = 0
+
+        suffix = "" if name is None else "-" + name
+        self.frame_ring = FrameRing.create(
+            settings.FRAME_RING_NAME + suffix, camera.width, camera.height, settings.FRAME_RING_SLOTS)
+
+        self.recorder = None
+        if record:
+            _create_recordings_directories()
+            self.recorder = Recorder(self.frame_ring, suffix, record_audio)
+
+        self.live_stream = LiveStream(self.frame_ring) if settings.LIVE_STREAM else None
+
+        if self.live_stream is not None and self.recorder is not None and self.recorder.combine_queue is not None \
+                and settings.RECORDINGS_COMBINE_OVERLOAD == OVERLOAD_PAUSE_LIVE:
+            self.recorder.combine_queue.overload_listeners.append(self.live_stream.set_paused)
+
+        (self.motion_detector, self.motion_trigger) = self._create_motion_detection()
+
+    def _create_motion_detection(self):
+        if not settings.MOTION_DETECTION or self.recorder is None or self.watch_only:
+            return (None, None)
+
+        detector = MotionDetector(
+            camera_regions(self.camera), settings.MOTION_DOWNSCALE, settings.MOTION_PIXEL_THRESHOLD,
+            settings.MOTION_BACKGROUND_RATE)
+        trigger = MotionTrigger(
+            self.recorder, settings.MOTION_SCORE_THRESHOLD, settings.MOTION_PRE_ROLL_SECONDS,
+            settings.MOTION_POST_ROLL_SECONDS)
+        return (detector, trigger)
+
+    # A camera of its own is checked before its frame is drawn - the grid's cameras are only updated by drawing it, so
+    # they're checked once it has been
+    def capture(self, timestamp):
+        if self.source is not None:
+            self.source.update_frame()
+        else:
+            self.camera.update_frame()
+
+        frames = [c.current_frame for c in self.sources]
+        unchanged = self.last_source_frames is not None and all(
+            frame is last for (frame, last) in zip(frames, self.last_source_frames))
+        if unchanged or all(frame is None for frame in frames):
+            self.unchanged_frames += 1
+            return
+        self.last_source_frames = frames
+
+        if self.source is not None:
+            self.camera.update_frame()
+        self.frame_ring.write(self.camera.current_frame, timestamp)
+        self.frames_captured += 1
+
+        if self.motion_detector is not None:
+            self.motion_trigger.update(self.motion_detector.update(self.camera.current_frame))
+
+    def log_stats(self):
+        label = "" if self.name is None else " " + self.name
+        logging.info(
+            "capture%s - frames captured: %s, unchanged frames skipped: %s", label, self.frames_captured,
+            self.unchanged_frames)
+
+        if self.live_stream is not None:
+            stats = self.live_stream.stats()
+            logging.info(
+                "live stream%s - fragments: %s, encoder starts: %s, capture to fragment latency: %.2fs avg, %.2fs max",
+                label, stats["fragments"], stats["encoder_starts"], stats["average_latency"], stats["max_latency"])
+
+        if self.recorder is None:
+            return
+
+        stats = self.recorder.frame_stats()
+        logging.info(
+            "recorder%s - frames written: %s, duplicated: %s, dropped: %s",
+            label, stats["frames_written"], stats["duplicated"], stats["dropped"])
+
+        if self.recorder.combine_queue is not None:
+            stats = self.recorder.combine_queue.stats()
+            logging.info(
+                "combining%s - queued: %s (max %s), combining: %s, combined: %s, failed: %s, dropped: %s, %.2fs avg",
+                label, stats["queued"], stats["max_queued"], stats["combining"], stats["combined"], stats["failed"],
+                stats["dropped"], stats["average_seconds"])
+
+    # The cameras themselves are released by whoever created them, they may be shared with other pipelines
+    def release(self):
+        if self.recorder is not None:
+            if self.recorder.is_recording():
+                self.stop_recording()
+            self.recorder.release()
+            self.recorder = None
+
+        if self.live_stream is not None:
+            self.live_stream.release()
+            self.live_stream = None
+
+        self.frame_ring.release()
+        self.frame_ring = None
+
+    # How much each camera's picture is changing, by camera id - empty if motion detection is turned off
+    def motion_scores(self):
+        return dict(self.motion_detector.scores) if self.motion_detector is not None else {}
+
+    def start_recording(self):
+        if self.recorder is None or self.watch_only:
+            return
+
+        self.recorder.start_recording()
+        if self.motion_trigger is not None:
+            self.motion_trigger.recording_changed_by_hand()
+
+    def stop_recording(self):
+        if self.recorder is None:
+            return
+
+        self.recorder.stop_recording()
+        if self.motion_trigger is not None:
+            self.motion_trigger.recording_changed_by_hand()
+
+    # The renditions a viewer can pick between to watch this camera - just its own, if it can be watched
+    def renditions(self):
+        return [self.rendition()] if self.recorder is not None or self.live_stream is not None else []
+
+    # bandwidth - peak bits per second of the recent segments (0 if there aren't any)
+    # audio - whether its segments have sound
+    def rendition(self):
+        bandwidth = 0
+        if self.recorder is not None:
+            hls_segments = [s for (_, s) in list(self.recorder.recent_segments) if s is not None and s.duration > 0]
+            bandwidth = max([s.size * 8 / s.duration for s in hls_segments], default=0)
+
+        return {
+            "camera_id": self.camera_id, "width": self.frame_ring.width, "height": self.frame_ring.height,
+            "bandwidth": round(bandwidth), "audio": self.recorder is not None and self.recorder.audio is not None
+        }
+
+    def is_recording(self):
+        return self.recorder is not None and self.recorder.is_recording()
+
+    def segment(self, last_received):
+        filename = self.segment_name(last_received)
+        if filename == "":
+            return ("", b"")
+
+        return (filename, self.segment_data(filename))
+
+    # The name of the segment to serve after last_received, or an empty string if there's nothing new
+    def segment_name(self, last_received):
+        return next_segment_name(self.recent_segment_names(), last_received)
+
+    def recent_segment_names(self):
+        if self.recorder is None:
+            return []
+
+        return [get_filename(s) for s in self.recorder.all_combined_segments[-RECENT_SEGMENTS:]]
+
+    # callback is called with the name of each new segment as soon as it's finished
+    def add_segment_listener(self, callback):
+        if self.recorder is not None:
+            self.recorder.segment_listeners.append(lambda path: callback(get_filename(path)))
+
+    # Only segments the recorder has finished are served, never arbitrary files
+    def segment_data(self, filename):
+        if self.recorder is None:
+            return b""
+
+        for path in reversed(self.recorder.all_combined_segments):
+            if get_filename(path) == filename:
+                with open(path, "rb") as f:
+                    return f.read()
+
+        return b""
+
+    # HLS playlists and segments, by their path in the recordings directory - only the files HLS players need are
+    # served, and the live playlist is this pipeline's own
+    def hls_file(self, path):
+        if self.recorder is None or not is_hls_path(path):
+            return b""
+
+        filename = os.path.join(settings.RECORDINGS_DIRECTORY, *path.split("/"))
+        if path == f"{settings.RECORDINGS_PARTS_SUBDIR_NAME}/{LIVE_PLAYLIST_NAME}":
+            filename = self.recorder.live_playlist.filename
+
+        try:
+            with open(filename, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return b""
+
+    # init_listener is called with (init_id, init_segment) whenever the live encoder (re)starts, fragment_listener
+    # with each LiveFragment - neither is ever called if the live stream is turned off
+    def add_live_listener(self, init_listener, fragment_listener):
+        if self.live_stream is not None:
+            self.live_stream.add_listener(init_listener, fragment_listener)
+
+    # Returns (init_id, init_segment), or None if there isn't one (yet)
+    def live_init_segment(self):
+        return self.live_stream.current_init_segment() if self.live_stream is not None else None
+
+
+# Created once, on module load - the IPC clients started in main.py hold on to the pipelines until the process ends
+(camera, _pipelines) = _create_cameras()
+
+# The grid's pipeline - this module's interface is the grid's, apart from recording (and motion) which covers every
+# camera recorded
+_grid = _pipelines[0]
+frame_ring = _grid.frame_ring
 
 
 def _camera_reader(pipe):
     running = True
     start_time = time.time()
     seconds_per_frame = 1 / settings.CAMERA_FPS
+    last_stats_logged = start_time
 
     while running:
-        camera.update_frame()
+        timestamp = time.time()
+        for pipeline in _pipelines:
+            pipeline.capture(timestamp)
 
         current_time = time.time()
+        if current_time - last_stats_logged >= settings.CAMERA_STATS_LOG_SECONDS:
+            last_stats_logged = current_time
+            _log_camera_stats()
+
         time_since_start = current_time - start_time
         sleep_time = seconds_per_frame - (time_since_start % seconds_per_frame)
         if sleep_time > 0:
@@ -54,8 +328,30 @@ def _camera_reader(pipe):
                 running = False
 
 
+def _log_camera_stats():
+    scores = motion_scores()
+    for stat in camera_stats():
+        logging.info(
+            "camera %s - fps: %.1f, frames read: %s, dropped reads: %s, motion: %.3f",
+            stat["camera_id"], stat["fps"], stat["frames_read"], stat["dropped_reads"],
+            scores.get(stat["camera_id"], 0))
+
+    for pipeline in _pipelines:
+        pipeline.log_stats()
+
+
+def camera_stats():
+    return camera.stats()
+
+
+# The pipelines served as cameras of their own (by their camera_id) - each camera recorded on its own, and the
+# thumbnail grid
+def camera_pipelines():
+    return _pipelines[1:]
+
+
 def start_reader(pipe):
-    global _recorder
+    global frame_ring
 
     logging.info("Starting cameras")
     try:
@@ -67,66 +363,81 @@ def start_reader(pipe):
     release_cameras()
     logging.info("Cameras cleaned up")
 
-    _recorder.release()
-    _recorder = None
-
+    _release_pipelines()
+    frame_ring = None
 
-def _create_recorder():
-    if not os.path.exists(settings.RECORDINGS_DIRECTORY):
-        os.mkdir(settings.RECORDINGS_DIRECTORY)
 
-    parts_dir = os.path.join(settings.RECORDINGS_DIRECTORY, settings.RECORDINGS_PARTS_SUBDIR_NAME)
-    if not os.path.exists(parts_dir):
-        os.mkdir(parts_dir)
+def _release_pipelines():
+    for pipeline in _pipelines:
+        if pipeline.frame_ring is not None:
+            pipeline.release()
 
-    return Recorder(camera)
 
-
-_recorder = _create_recorder()
+def motion_scores():
+    scores = {}
+    for pipeline in _pipelines:
+        scores.update(pipeline.motion_scores())
+    return scores
 
 
 def start_recording():
-    global _recorder
-
-    _recorder.start_recording()
+    for pipeline in _pipelines:
+        pipeline.start_recording()
     logging.info("Recording started")
 
 
 def stop_recording():
-    global _recorder
-
-    _recorder.stop_recording()
+    for pipeline in _pipelines:
+        pipeline.stop_recording()
     logging.info("Recording ended")
 
 
 def is_recording():
-    return _recorder.is_recording()
+    return any(pipeline.is_recording() for pipeline in _pipelines)
+
+
+# The grid can be watched as itself (if it's recorded or live streamed) or as the thumbnail grid
+def renditions():
+    return _grid.renditions() + [r for p in _pipelines if p.name == THUMBNAIL_NAME for r in p.renditions()]
 
 
 def segment(last_received):
-    if len(_recorder.all_combined_segments) == 0:
-        logging.info("No segments exist, returning empty byte string")
-        return ("", b"")
+    return _grid.segment(last_received)
 
-    segments_to_check = [get_filename(i) for i in _recorder.all_combined_segments[-10:]]
 
-    if last_received == segments_to_check[-1]:
-        logging.info("Last received segment is most recent segment, returning empty byte string")
-        return ("", b"")
+# The name of the segment to serve after last_received, or an empty string if there's nothing new
+def segment_name(last_received):
+    return _grid.segment_name(last_received)
 
-    if last_received in segments_to_check:
-        idx_offset = len(_recorder.all_combined_segments) - len(segments_to_check)
-        index_to_serve = segments_to_check.index(last_received) + 1 + idx_offset
-        logging.info("Serving index %s", index_to_serve)
-    else:
-        index_to_serve = max(len(_recorder.all_combined_segments) - 2, 0)
-        logging.info("last_segment cannot be found '%s' - serving index %s", last_received, index_to_serve)
 
-    filename = _recorder.all_combined_segments[index_to_serve]
-    with open(filename, "rb") as f:
-        buf = f.read()
+def recent_segment_names():
+    return _grid.recent_segment_names()
 
-    return (get_filename(filename), buf)
+
+# callback is called with the name of each new segment as soon as it's finished
+def add_segment_listener(callback):
+    _grid.add_segment_listener(callback)
+
+
+# Only segments the recorder has finished are served, never arbitrary files
+def segment_data(filename):
+    return _grid.segment_data(filename)
+
+
+# HLS playlists and segments, by their path in the recordings directory - only the files HLS players need are served
+def hls_file(path):
+    return _grid.hls_file(path)
+
+
+# init_listener is called with (init_id, init_segment) whenever the live encoder (re)starts, fragment_listener with
+# each LiveFragment - neither is ever called if the live stream is turned off
+def add_live_listener(init_listener, fragment_listener):
+    _grid.add_live_listener(init_listener, fragment_listener)
+
+
+# Returns (init_id, init_segment), or None if there isn't one (yet)
+def live_init_segment():
+    return _grid.live_init_segment()
 
 
 def get_filename(s):
@@ -140,9 +451,3 @@ def release_cameras():
     global camera
     camera.release()
     camera = None
-
-
-# This only needs to be called if release_cameras is called prior - a camera will be created initially on module load
-def create_cameras():
-    global camera
-    camera = _create_cameras()
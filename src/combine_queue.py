@@ -0,0 +1,197 @@
+import time
+import logging
+import threading
+from collections import deque, namedtuple
+
+# Combines recorded video and audio parts into segments on a fixed number of worker threads, so a machine that can't
+# keep up ends up with a bounded number of parts waiting rather than a thread (and an ffmpeg process) for each of them.
+# Segments are handed on in the order their parts were queued, however long each took to combine.
+
+# sequence - the order parts were queued in
+# recording - the recording the parts were recorded in (a RecordingIndex), or None
+CombineJob = namedtuple("CombineJob", ["sequence", "video_filename", "audio_filename", "recording"])
+
+# Whole queue is full - the oldest waiting job is dropped to make room
+OVERLOAD_DROP = "drop"
+# Combine with a faster (lower quality) encoder preset while overloaded
+OVERLOAD_FASTER = "faster"
+# Pause the live stream while overloaded, leaving its CPU time to combining
+OVERLOAD_PAUSE_LIVE = "pause_live"
+OVERLOAD_POLICIES = [OVERLOAD_DROP, OVERLOAD_FASTER, OVERLOAD_PAUSE_LIVE]
+
+FASTER_PRESET = "ultrafast"
+
+
+class CombineQueue:
+    # combine is called with (job, preset) and returns the combined segment's filename, or None if it failed. finished
+    # is called with (job, filename) for each job in order, dropped with each job that's dropped.
+    def __init__(self, workers, max_queued, overload_policy, combine, finished, dropped):
+        if overload_policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"Unknown overload policy '{overload_policy}', expected one of {OVERLOAD_POLICIES}")
+
+        self.max_queued = max(1, max_queued)
+        self.overload_policy = overload_policy
+        self.combine = combine
+        self.finished = finished
+        self.dropped = dropped
+
+        # Called with True when the queue becomes overloaded (at least half full), and False once it's empty again
+        self.overload_listeners = []
+        self.overloaded = False
+
+        self.condition = threading.Condition()
+        self.queued = deque()
+        self.combining = 0
+        self.next_sequence = 0
+        # Jobs that are done, by sequence, waiting for the jobs before them to be finished
+        self.done = {}
+        self.next_to_finish = 0
+        # Whether a thread is handing on finished jobs - only one does at a time, so they're handed on in order
+        self.finishing = False
+
+        self.max_queued_seen = 0
+        self.combined = 0
+        self.failed = 0
+        self.dropped_count = 0
+        self.combine_seconds = deque(maxlen=100)
+
+        self._running = True
+        self.workers = [
+            threading.Thread(target=self._work, name=f"Combine AV Worker {i}") for i in range(max(1, workers))
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def add(self, video_filename, audio_filename, recording):
+        dropped_job = None
+
+        with self.condition:
+            job = CombineJob(self.next_sequence, video_filename, audio_filename, recording)
+            self.next_sequence += 1
+
+            if len(self.queued) >= self.max_queued:
+                dropped_job = self.queued.popleft()
+                self.dropped_count += 1
+                self.done[dropped_job.sequence] = (dropped_job, None)
+
+            self.queued.append(job)
+            self.max_queued_seen = max(self.max_queued_seen, len(self.queued))
+            self.condition.notify_all()
+
+        if dropped_job is not None:
+            logging.warning(
+                "Combining can't keep up, dropping parts %s and %s", dropped_job.video_filename,
+                dropped_job.audio_filename)
+            self.dropped(dropped_job)
+            self._finish_in_order()
+
+        self._update_overloaded()
+
+    # Waits for every job queued so far to be finished
+    def wait_until_idle(self, timeout=None):
+        with self.condition:
+            last_sequence = self.next_sequence
+            return self.condition.wait_for(lambda: self.next_to_finish >= last_sequence, timeout)
+
+    def stats(self):
+        with self.condition:
+            combine_seconds = list(self.combine_seconds)
+            return {
+                "queued": len(self.queued),
+                "combining": self.combining,
+                "max_queued": self.max_queued_seen,
+                "combined": self.combined,
+                "failed": self.failed,
+                "dropped": self.dropped_count,
+                "overloaded": self.overloaded,
+                "average_seconds": sum(combine_seconds) / len(combine_seconds) if len(combine_seconds) > 0 else 0
+            }
+
+    # Jobs already queued are combined first
+    def release(self):
+        logging.info("Releasing combine queue...")
+        with self.condition:
+            self._running = False
+            self.condition.notify_all()
+
+        for worker in self.workers:
+            worker.join()
+        logging.info("Combine queue released")
+
+    def _work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.queued) > 0 or not self._running)
+                if len(self.queued) == 0:
+                    return
+
+                job = self.queued.popleft()
+                self.combining += 1
+                overloaded = self.overloaded
+
+            preset = FASTER_PRESET if overloaded and self.overload_policy == OVERLOAD_FASTER else None
+
+            start = time.time()
+            try:
+                filename = self.combine(job, preset)
+            except Exception:
+                logging.exception("Error combining %s and %s", job.video_filename, job.audio_filename)
+                filename = None
+
+            with self.condition:
+                self.combining -= 1
+                self.combine_seconds.append(time.time() - start)
+                if filename is None:
+                    self.failed += 1
+                else:
+                    self.combined += 1
+                self.done[job.sequence] = (job, filename)
+
+            self._finish_in_order()
+            self._update_overloaded()
+
+    # Only one thread hands on finished jobs at a time, so they're never handed on out of order. Jobs that become ready
+    # meanwhile are handed on by that thread too. finished is called without the lock held, so a slow one (it reads
+    # the segment and tells the webserver about it) doesn't hold up the workers or add.
+    def _finish_in_order(self):
+        with self.condition:
+            if self.finishing:
+                return
+            self.finishing = True
+
+        while True:
+            with self.condition:
+                ready = []
+                while self.next_to_finish + len(ready) in self.done:
+                    ready.append(self.done.pop(self.next_to_finish + len(ready)))
+
+                if len(ready) == 0:
+                    self.finishing = False
+                    return
+
+            for (job, filename) in ready:
+                if filename is not None:
+                    try:
+                        self.finished(job, filename)
+                    except Exception:
+                        logging.exception("Error handing on combined segment %s", filename)
+
+            with self.condition:
+                self.next_to_finish += len(ready)
+                self.condition.notify_all()
+
+    # Listeners are called with the lock held, so they always see the changes in order
+    def _update_overloaded(self):
+        with self.condition:
+            waiting = len(self.queued)
+            if not self.overloaded and waiting >= max(1, self.max_queued // 2):
+                self.overloaded = True
+                logging.warning("Combining is falling behind, %s parts waiting", waiting)
+            elif self.overloaded and waiting == 0:
+                self.overloaded = False
+                logging.info("Combining has caught up")
+            else:
+                return
+
+            for listener in self.overload_listeners:
+                listener(self.overloaded)
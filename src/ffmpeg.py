@@ -1,23 +1,33 @@
 import os
 import subprocess
 import logging
-import tempfile
 
 FFMPEG_EXE = "./ffmpeg.exe"
 
+# Raw frames carry no timestamps of their own - with these input options each is timestamped as ffmpeg receives it, so
+# frames written to ffmpeg as far apart as they were captured keep their capture times. The frame rate of a raw input is
+# also its timestamps' time base, so received times are kept to the millisecond.
+WALLCLOCK_TIMESTAMPS = ["-use_wallclock_as_timestamps", "1", "-framerate", "1000"]
 
-def combine_video_audio(video_filename, audio_filename, out_filename):
+
+# preset is the H.264 encoder preset to use (e.g. "ultrafast"), or None for ffmpeg's default. With no audio_filename
+# the video is just re-encoded. The video keeps its frames' timestamps, rather than being made constant frame rate.
+def combine_video_audio(video_filename, audio_filename, out_filename, preset=None):
     logging.debug(f"combining {video_filename} {audio_filename} into {out_filename}")
+    audio = ["-i", audio_filename] if audio_filename is not None else []
+    audio_codec = ["-c:a", "aac"] if audio_filename is not None else []
     args = [FFMPEG_EXE,
             "-hide_banner",
             "-loglevel", "panic",
             "-nostats",
             "-i", video_filename,
-            "-i", audio_filename,
+            *audio,
             "-c:v", "h264",
-            "-c:a", "aac",
+            "-fps_mode", "vfr",
+            *audio_codec,
             "-movflags", "empty_moov+default_base_moof+frag_keyframe",
             "-profile:v", "baseline",
+            *(["-preset", preset] if preset is not None else []),
             out_filename
             ]
 
@@ -34,34 +44,23 @@ def combine_video_audio(video_filename, audio_filename, out_filename):
     return success
 
 
-def append_videos(output_file, filenames):
-    logging.info(f"appending video files '{', '.join(filenames)}' to '{output_file}'")
-
-    file_content = "\n".join([f"file '{f}'" for f in filenames])
-    with tempfile.NamedTemporaryFile(delete=False) as files_to_combine_file:
-        files_to_combine_file.write(file_content.encode("utf-8"))
-
-        temp_file_name = files_to_combine_file.name
+# Copies the videos listed in a concat demuxer file (e.g. an ffconcat file) into output_file, without re-encoding them
+def concat_videos(output_file, list_filename):
+    logging.info(f"appending video files listed in '{list_filename}' to '{output_file}'")
 
     args = [FFMPEG_EXE,
             "-hide_banner",
-            # "-loglevel", "panic",
+            "-loglevel", "panic",
             "-nostats",
             "-f", "concat",
             "-safe", "0",
-            "-i", temp_file_name,
+            "-i", list_filename,
             "-c", "copy",
             output_file
             ]
 
-    try:
-        pipes = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (stdout, stderr) = pipes.communicate()
-    finally:
-        try:
-            os.remove(temp_file_name)
-        except Exception:
-            logging.warn("Could not delete temp file %s", temp_file_name)
+    pipes = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (stdout, stderr) = pipes.communicate()
 
     success = pipes.returncode == 0
 
@@ -71,3 +70,123 @@ def append_videos(output_file, filenames):
         logging.error(f"append failed - status code: {pipes.returncode} - stdout: '{stdout}' - stderr: '{stderr}'")
 
     return success
+
+
+# Starts an ffmpeg process that encodes raw BGR frames written to its stdin into an MPEG-4 part file, to be combined
+# with its audio (and re-encoded) later. Frames are timestamped as ffmpeg receives them (see WALLCLOCK_TIMESTAMPS).
+def start_part_encoder(width, height, out_filename):
+    args = [FFMPEG_EXE,
+            "-hide_banner",
+            "-loglevel", "error",
+            "-nostats",
+            "-f", "rawvideo",
+            "-pix_fmt", "bgr24",
+            "-s", f"{width}x{height}",
+            *WALLCLOCK_TIMESTAMPS,
+            "-i", "pipe:0",
+            "-c:v", "mpeg4",
+            "-q:v", "3",
+            "-fps_mode", "vfr",
+            # stdin is the video, so ffmpeg mustn't ask about overwriting
+            "-y",
+            out_filename
+            ]
+
+    return subprocess.Popen(args, stdin=subprocess.PIPE)
+
+
+# Starts an ffmpeg process that encodes raw BGR frames written to its stdin into a fragmented MP4 stream on its
+# stdout - an init segment (ftyp + moov) followed by a fragment (moof + mdat) every fragment_seconds
+def start_live_encoder(width, height, fps, fragment_seconds, keyframe_seconds):
+    args = [FFMPEG_EXE,
+            "-hide_banner",
+            "-loglevel", "error",
+            "-nostats",
+            "-f", "rawvideo",
+            "-pix_fmt", "bgr24",
+            "-s", f"{width}x{height}",
+            "-r", str(fps),
+            "-i", "pipe:0",
+            "-c:v", "libx264",
+            "-preset", "ultrafast",
+            "-tune", "zerolatency",
+            "-profile:v", "baseline",
+            "-level", "3.0",
+            "-pix_fmt", "yuv420p",
+            "-g", str(max(1, round(fps * keyframe_seconds))),
+            "-f", "mp4",
+            "-movflags", "empty_moov+default_base_moof+frag_keyframe",
+            "-frag_duration", str(int(fragment_seconds * 1000000)),
+            "-flush_packets", "1",
+            "pipe:1"
+            ]
+
+    logging.info("Starting live encoder")
+    return subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+
+# Whether start_segment_encoder can be given audio_fd - the pipe is inherited by ffmpeg, which only works on POSIX
+def segment_encoder_supports_audio():
+    return os.name == "posix"
+
+
+# Starts an ffmpeg process that encodes raw frames written to its stdin (and raw PCM audio written to audio_fd, if
+# given) into segment_seconds long MP4 files named by out_pattern, a strftime pattern for when each segment starts. The
+# name of each segment is written to its stdout, one per line, once the segment is complete. Frames are in
+# pixel_format - "bgr24" as captured, or "yuv420p" (I420) as encoded, which is half the size. With variable_frame_rate
+# each frame is timestamped when ffmpeg receives it (see WALLCLOCK_TIMESTAMPS), rather than assumed to be 1 / fps after
+# the last.
+def start_segment_encoder(width, height, fps, segment_seconds, out_pattern, audio_fd=None, audio_rate=44100,
+                          audio_channels=1, pixel_format="bgr24", variable_frame_rate=False):
+    # Raw input needs no probing, and waiting to probe it only holds up the first segment
+    raw_input = ["-thread_queue_size", "64", "-probesize", "32", "-analyzeduration", "0"]
+    frame_rate = WALLCLOCK_TIMESTAMPS if variable_frame_rate else ["-r", str(fps)]
+
+    args = [FFMPEG_EXE,
+            "-hide_banner",
+            "-loglevel", "error",
+            "-nostats",
+            *raw_input,
+            "-f", "rawvideo",
+            "-pix_fmt", pixel_format,
+            "-s", f"{width}x{height}",
+            *frame_rate,
+            "-i", "pipe:0"
+            ]
+
+    if audio_fd is not None:
+        args += [*raw_input,
+                 "-f", "s16le",
+                 "-ar", str(audio_rate),
+                 "-ac", str(audio_channels),
+                 "-i", f"pipe:{audio_fd}"
+                 ]
+
+    if variable_frame_rate:
+        args += ["-fps_mode", "vfr"]
+
+    args += ["-c:v", "libx264",
+             "-preset", "veryfast",
+             "-profile:v", "baseline",
+             "-pix_fmt", "yuv420p",
+             # Each segment has to start with a keyframe
+             "-force_key_frames", f"expr:gte(t,n_forced*{segment_seconds})"
+             ]
+
+    if audio_fd is not None:
+        args += ["-c:a", "aac"]
+
+    args += ["-f", "segment",
+             "-segment_time", str(segment_seconds),
+             "-reset_timestamps", "1",
+             "-strftime", "1",
+             "-segment_format", "mp4",
+             "-segment_format_options", "movflags=empty_moov+default_base_moof+frag_keyframe",
+             "-segment_list", "pipe:1",
+             "-segment_list_type", "flat",
+             out_pattern
+             ]
+
+    logging.info("Starting segment encoder")
+    pass_fds = () if audio_fd is None else (audio_fd,)
+    return subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, pass_fds=pass_fds)
@@ -0,0 +1,166 @@
+import struct
+import logging
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# A fixed size ring of frames in shared memory. A single writer (the capture loop) fills the slots in turn and any
+# number of readers, in any process, can look at the most recent frames without copying them.
+#
+# Layout: [ring header][slot header][slot frame][slot header][slot frame]...
+#   ring header - slot count, frame height, width and channels, sequence number of the latest complete frame
+#   slot header - sequence number and capture timestamp of the frame held in the slot (sequence 0 = being written)
+
+RING_HEADER = struct.Struct("<IIIIQ")
+RING_HEADER_SIZE = 64
+LATEST_SEQUENCE_OFFSET = struct.calcsize("<IIII")
+
+SLOT_HEADER = struct.Struct("<Qd")
+SLOT_HEADER_SIZE = 64
+
+CHANNELS = 3
+
+Frame = namedtuple("Frame", ["sequence", "timestamp", "data"])
+
+
+class FrameRing:
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        # What other processes attach to it by
+        self.name = shm.name
+
+        (self.slot_count, self.height, self.width, self.channels, _) = RING_HEADER.unpack_from(self.shm.buf, 0)
+        self.frame_size = self.height * self.width * self.channels
+        self.slot_size = SLOT_HEADER_SIZE + self.frame_size
+
+        self.slots = [
+            np.ndarray(
+                (self.height, self.width, self.channels),
+                np.uint8,
+                buffer=self.shm.buf,
+                offset=self._slot_offset(i) + SLOT_HEADER_SIZE
+            )
+            for i in range(self.slot_count)
+        ]
+
+    @staticmethod
+    def create(name, width, height, slot_count):
+        size = RING_HEADER_SIZE + slot_count * (SLOT_HEADER_SIZE + width * height * CHANNELS)
+
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a previous run that didn't shut down cleanly
+            logging.warning("Frame ring '%s' already exists - replacing it", name)
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        RING_HEADER.pack_into(shm.buf, 0, slot_count, height, width, CHANNELS, 0)
+        ring = FrameRing(shm, True)
+
+        for slot in range(slot_count):
+            SLOT_HEADER.pack_into(shm.buf, ring._slot_offset(slot), 0, 0)
+
+        return ring
+
+    # shared_tracker - whether this process shares its resource tracker with the ring's creator (see pipeline_process).
+    # The tracker only keeps one registration per name, so the creator's must be left alone.
+    @staticmethod
+    def attach(name, shared_tracker=False):
+        # Only the creating process should unlink the memory, stop this process' resource tracker from doing so on exit
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:  # track was only added in Python 3.13
+            shm = shared_memory.SharedMemory(name=name)
+            try:
+                from multiprocessing import resource_tracker
+                if not shared_tracker:
+                    resource_tracker.unregister(shm._name, "shared_memory")
+            except Exception:
+                pass
+
+        return FrameRing(shm, False)
+
+    def write(self, frame, timestamp):
+        sequence = self.latest_sequence() + 1
+        slot = sequence % self.slot_count
+        offset = self._slot_offset(slot)
+
+        SLOT_HEADER.pack_into(self.shm.buf, offset, 0, 0)
+
+        # Cameras don't always honour the requested size, only copy the region that overlaps the slot
+        height = min(frame.shape[0], self.height)
+        width = min(frame.shape[1], self.width)
+        self.slots[slot][:height, :width] = frame[:height, :width]
+
+        SLOT_HEADER.pack_into(self.shm.buf, offset, sequence, timestamp)
+        struct.pack_into("<Q", self.shm.buf, LATEST_SEQUENCE_OFFSET, sequence)
+
+        return sequence
+
+    def latest_sequence(self):
+        return struct.unpack_from("<Q", self.shm.buf, LATEST_SEQUENCE_OFFSET)[0]
+
+    def latest(self):
+        return self.get(self.latest_sequence())
+
+    # The returned frame data is a view into shared memory - it stays valid until the writer laps the ring, use
+    # is_current to check a frame wasn't overwritten while it was being used, or copy the data to keep it.
+    def get(self, sequence):
+        if sequence <= 0:
+            return None
+
+        slot = sequence % self.slot_count
+        (slot_sequence, timestamp) = SLOT_HEADER.unpack_from(self.shm.buf, self._slot_offset(slot))
+        if slot_sequence != sequence:
+            return None
+
+        return Frame(sequence, timestamp, self.slots[slot])
+
+    def is_current(self, frame):
+        slot = frame.sequence % self.slot_count
+        (slot_sequence, _) = SLOT_HEADER.unpack_from(self.shm.buf, self._slot_offset(slot))
+        return slot_sequence == frame.sequence
+
+    def release(self):
+        # The numpy views must go before the memory can be closed
+        self.slots = []
+        self.shm.close()
+
+        if self.owner:
+            self.shm.unlink()
+
+    def _slot_offset(self, slot):
+        return RING_HEADER_SIZE + slot * self.slot_size
+
+
+# Hands out each frame written to a ring exactly once, in order - rather than whatever frame happens to be the latest
+# when asked, which repeats frames when asked too often and misses them when asked too rarely. Frames the writer
+# overwrote before they were read are counted as dropped.
+class FrameReader:
+    def __init__(self, ring):
+        self.ring = ring
+        # Starts from the latest frame
+        self.last_sequence = max(0, ring.latest_sequence() - 1)
+
+        self.frames_read = 0
+        self.dropped = 0
+
+    def next_frames(self):
+        latest_sequence = self.ring.latest_sequence()
+
+        frames = []
+        for sequence in range(self.last_sequence + 1, latest_sequence + 1):
+            frame = self.ring.get(sequence)
+            if frame is None:
+                self.dropped += 1
+            else:
+                frames.append(frame)
+
+        self.last_sequence = max(self.last_sequence, latest_sequence)
+        self.frames_read += len(frames)
+        return frames
@@ -0,0 +1,126 @@
+import os
+import math
+from collections import namedtuple
+
+import mp4
+from segments import is_timestamped_name
+import settings
+
+# HLS playlists over the recorded segments, so they can be watched with any HLS player (and cached by anything that
+# understands HTTP) rather than only through the webserver's own segment polling. There's a rolling live playlist of
+# the most recent segments in the parts directory, and a playlist next to each recording's index.
+#
+# Every segment is a fragmented MP4 file with its own init segment (ftyp + moov) at the start and timestamps starting
+# from zero, so each is its own discontinuity - its init segment is given as a byte range of the file (EXT-X-MAP), and
+# the rest of the file as the media segment.
+
+LIVE_PLAYLIST_NAME = "live.m3u8"
+MASTER_PLAYLIST_NAME = "master.m3u8"
+PLAYLIST_EXTENSION = ".m3u8"
+
+# A rendition in a master playlist
+# uri - of its media playlist, relative to the master playlist
+# bandwidth - its peak bits per second
+HlsVariant = namedtuple("HlsVariant", ["uri", "bandwidth", "width", "height"])
+
+# uri - relative to the playlist
+# duration - in seconds
+# init_size - the size of the init segment at the start of the file
+# size - the size of the whole file
+HlsSegment = namedtuple("HlsSegment", ["uri", "duration", "init_size", "size"])
+
+
+# Reads what a playlist needs to know about a finished segment file
+def segment_info(filename, uri):
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    return HlsSegment(uri, mp4.fragmented_duration(data), mp4.init_segment_size(data), len(data))
+
+
+# media_sequence - the sequence number of segments[0], for live playlists that old segments drop off the start of
+# ended - no more segments will be added
+# playlist_type - "EVENT" for playlists that are only ever added to, or None
+def media_playlist(segments, media_sequence=0, ended=False, playlist_type=None):
+    target_duration = max([math.ceil(s.duration) for s in segments], default=1)
+
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:7",
+        f"#EXT-X-TARGETDURATION:{target_duration}",
+        f"#EXT-X-MEDIA-SEQUENCE:{media_sequence}",
+        # Every segment after the first is a discontinuity
+        f"#EXT-X-DISCONTINUITY-SEQUENCE:{media_sequence}",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+    ]
+    if playlist_type is not None:
+        lines.append(f"#EXT-X-PLAYLIST-TYPE:{playlist_type}")
+
+    for (i, segment) in enumerate(segments):
+        if i > 0:
+            lines.append("#EXT-X-DISCONTINUITY")
+        lines += [
+            f'#EXT-X-MAP:URI="{segment.uri}",BYTERANGE="{segment.init_size}@0"',
+            f"#EXTINF:{segment.duration:.3f},",
+            f"#EXT-X-BYTERANGE:{segment.size - segment.init_size}@{segment.init_size}",
+            segment.uri
+        ]
+
+    if ended:
+        lines.append("#EXT-X-ENDLIST")
+
+    return "\n".join(lines) + "\n"
+
+
+# The same video in several renditions, for players to pick between by their bandwidth and screen size
+def master_playlist(variants):
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:7",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+    ]
+
+    for variant in variants:
+        # Nothing has been recorded to measure a rendition's bandwidth from just after it starts, but it must be given
+        lines += [
+            f"#EXT-X-STREAM-INF:BANDWIDTH={max(1, variant.bandwidth)},RESOLUTION={variant.width}x{variant.height}",
+            variant.uri
+        ]
+
+    return "\n".join(lines) + "\n"
+
+
+# Players may fetch a playlist at any time, so it's never seen half written
+def write_playlist(filename, content):
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "w") as f:
+        f.write(content)
+    os.replace(temp_filename, filename)
+
+
+# The most recent segments, for watching live
+class LivePlaylist:
+    def __init__(self, filename, window):
+        self.filename = filename
+        self.window = window
+        self.segments = []
+        self.media_sequence = 0
+
+    def add(self, segment):
+        self.segments.append(segment)
+        if len(self.segments) > self.window:
+            self.segments.pop(0)
+            self.media_sequence += 1
+
+        write_playlist(self.filename, media_playlist(self.segments, self.media_sequence))
+
+
+# Paths (relative to the recordings directory) of the files HLS players are allowed to fetch - the live playlist,
+# recording playlists and finished segments
+def is_hls_path(path):
+    parts = path.split("/")
+    if len(parts) == 2 and parts[0] == settings.RECORDINGS_PARTS_SUBDIR_NAME:
+        return parts[1] == LIVE_PLAYLIST_NAME or \
+            is_timestamped_name(parts[1], settings.RECORDINGS_FILENAME_VIDEO_EXTENSION)
+
+    return len(parts) == 1 and is_timestamped_name(parts[0], PLAYLIST_EXTENSION)
@@ -1,302 +1,859 @@
-import base64
+import os
 import threading
 import socket
+import struct
 import time
 import uuid
 import json
 import logging
 import select
-
-BYTES_PER_PACKET_SIZE = 4
-PACKET_SIZE_ENDIANNESS = "big"
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from live_stream import LiveFragment, next_live_fragment
+from segments import next_segment_name, RECENT_SEGMENTS
+from utils import Mutex
+import settings
+
+# Every message is a fixed size header followed by an optional JSON body (small control data) and an optional raw
+# byte payload (e.g. segment data) which is sent as is.
+#   header - protocol version, message type, request id, body length, payload length
+PROTOCOL_VERSION = 2
+MESSAGE_HEADER = struct.Struct(">BB16sII")
+
+MESSAGE_TYPE_HEARTBEAT = 0
+MESSAGE_TYPE_REQUEST = 1
+MESSAGE_TYPE_RESPONSE = 2
+# Sent by the camera side when it connects to say which camera it is, so requests can be routed to it
+MESSAGE_TYPE_HELLO = 3
+# Sent by the camera side without being asked when something changes (e.g. a new segment is ready), never responded to
+MESSAGE_TYPE_EVENT = 4
 
 ID_BYTES_LEN = len(uuid.uuid4().bytes)
+NO_ID = bytes(ID_BYTES_LEN)
 
 REQUEST_KEY = "request"
+EVENT_KEY = "event"
+
+# A request the camera side couldn't complete is still responded to, with a body of ERROR_KEY (one of the errors below)
+# and ERROR_MESSAGE_KEY, which the web side raises as a RequestError
+ERROR_KEY = "error"
+ERROR_MESSAGE_KEY = "message"
+ERROR_NOT_FOUND = "not_found"
+ERROR_UNKNOWN_REQUEST = "unknown_request"
+ERROR_FAILED = "failed"
 
 REQUEST_RESPONSE_TIMEOUT = 5  # seconds
+REQUEST_WORKERS = 4
+SECONDS_BETWEEN_CONNECTION_ATTEMPTS = 1
+
+# Large enough that a multi megabyte segment moves in a handful of send/recv calls
+READ_BUFFER_SIZE = 1024 * 1024
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+MAX_BUFFERS_PER_SEND = 64
 
-HEARTBEAT_MESSAGE = b"heartbeat"
 HEARTBEATS_PER_SECOND = 1
 SECONDS_PER_HEARTBEAT = 1 / HEARTBEATS_PER_SECOND
 SECONDS_BEFORE_HEARTBEAT_TIMEOUT = 10
 
+# What decoding or handling a malformed message (a missing key, a bad header or body) raises - the connection it came
+# from is closed, rather than the error taking down every other connection too
+MALFORMED_MESSAGE_ERRORS = (KeyError, TypeError, ValueError, struct.error)
+
+
+Message = namedtuple("Message", ["type", "id", "body", "payload"])
+
+
+# Raised on the web side when the camera side responded to a request with an error - error is one of the ERROR_*s
+class RequestError(Exception):
+    def __init__(self, error, message):
+        super().__init__(message)
+        self.error = error
+
+
+def error_response(error, message):
+    return ({ERROR_KEY: error, ERROR_MESSAGE_KEY: message}, b"")
+
+
+# Raises the error the response carries, if it has one
+def check_response(response):
+    if isinstance(response.body, dict) and ERROR_KEY in response.body:
+        raise RequestError(response.body[ERROR_KEY], response.body.get(ERROR_MESSAGE_KEY, ""))
+
+    return response
+
+
+# Returns the message as a list of buffers so a large payload can be written out without being copied
+def encode_message(message_type, id=NO_ID, body=None, payload=b""):
+    body_bytes = json.dumps(body).encode("utf-8") if body is not None else b""
+    header = MESSAGE_HEADER.pack(PROTOCOL_VERSION, message_type, id, len(body_bytes), len(payload))
+
+    if len(payload) == 0:
+        return [header + body_bytes]
+
+    return [header + body_bytes, payload]
+
+
+# Returns the message type, request id, body length and payload length from the start of a message
+def decode_message_header(buffer):
+    (version, message_type, id, body_len, payload_len) = MESSAGE_HEADER.unpack_from(buffer)
+    if version != PROTOCOL_VERSION:
+        raise ConnectionError(f"Unsupported protocol version {version}")
+
+    return (message_type, id, body_len, payload_len)
+
+
+def decode_message_body(body_bytes):
+    return json.loads(bytes(body_bytes).decode("utf-8")) if len(body_bytes) > 0 else None
+
+
+# Returns the total size of the message at the start of the buffer, or None if its header hasn't arrived yet
+def peek_message_size(buffer):
+    if len(buffer) < MESSAGE_HEADER.size:
+        return None
+
+    (_, _, body_len, payload_len) = decode_message_header(buffer)
+    return MESSAGE_HEADER.size + body_len + payload_len
+
+
+# Returns the decoded message and the number of bytes it took up, or None if the buffer doesn't hold a full message yet
+def decode_message(buffer):
+    message_end = peek_message_size(buffer)
+    if message_end is None or len(buffer) < message_end:
+        return None
+
+    (message_type, id, body_len, _) = decode_message_header(buffer)
+    body_end = MESSAGE_HEADER.size + body_len
+
+    body = decode_message_body(buffer[MESSAGE_HEADER.size:body_end])
+    payload = bytes(buffer[body_end:message_end])
+
+    return (Message(message_type, id, body, payload), message_end)
+
+
+def unix_sockets_supported():
+    return hasattr(socket, "AF_UNIX")
+
+
+# Whether host refers to this machine, in which case a unix domain socket can be used instead of TCP
+def is_local_host(host):
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+        local_addresses = set(socket.gethostbyname_ex(socket.gethostname())[2])
+    except OSError:
+        return False
+
+    return all(a.startswith("127.") or a == "::1" or a in local_addresses for a in addresses)
+
+
+def is_local_socket(sock):
+    if sock.family == getattr(socket, "AF_UNIX", None):
+        return True
+
+    try:
+        return is_local_host(sock.getpeername()[0])
+    except OSError:
+        return False
+
+
+def remove_unix_socket_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# A segment finishing just as the camera connects can arrive as an event before the hello, and may or may not be in
+# the hello's list of segments too
+def add_hello_segments(recent_segments, hello_segments):
+    early = [s for s in recent_segments if s not in hello_segments]
+    recent_segments.clear()
+    recent_segments.extend(hello_segments + early)
+
+
+def segment_event(filename):
+    return ({EVENT_KEY: "segment", "filename": filename}, b"")
+
 
-def prepend_message_length(msg):
-    msg_len_bytes = len(msg).to_bytes(BYTES_PER_PACKET_SIZE, PACKET_SIZE_ENDIANNESS)
-    return msg_len_bytes + msg
+def live_init_event(init_id, init_segment):
+    return ({EVENT_KEY: "live_init", "init_id": init_id}, init_segment)
+
+
+def live_fragment_event(fragment):
+    body = {EVENT_KEY: "live_fragment"}
+    body.update(fragment._asdict())
+    del body["data"]
+    return (body, fragment.data)
+
+
+# Updates the webserver's copy of a camera's state from an event it sent, returns False for unknown events
+def apply_camera_event(connection, message):
+    event = message.body[EVENT_KEY]
+
+    if event == "segment":
+        if message.body["filename"] not in connection.recent_segments:
+            connection.recent_segments.append(message.body["filename"])
+    elif event == "live_init":
+        connection.live_init = (message.body["init_id"], message.payload)
+    elif event == "live_fragment":
+        fields = {k: v for (k, v) in message.body.items() if k != EVENT_KEY}
+        connection.live_fragments.append(LiveFragment(data=message.payload, **fields))
+    else:
+        return False
+
+    return True
+
+
+class PendingRequest:
+    def __init__(self):
+        self.completed = threading.Event()
+        self.response = None
+
+
+# A single socket along with everything needed to frame messages over it
+class Connection:
+    def __init__(self, sock):
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+        self.camera_id = None
+        self.closed = False
+        self.is_local = is_local_socket(sock)
+
+        # Names of the camera's latest segments, kept up to date by the camera side so viewers asking for the next
+        # segment don't need a round trip each. The same goes for the live stream's init segment and fragments.
+        self.recent_segments = deque(maxlen=RECENT_SEGMENTS)
+        self.live_init = None
+        self.live_fragments = deque(maxlen=settings.LIVE_FRAGMENTS_KEPT)
+
+        # Pending writes are queued as they are without concatenating them. Reads go into one reusable buffer, with
+        # read_start/read_end marking the data that hasn't been turned into messages yet.
+        self.write_queue = deque()
+        self.write_lock = threading.Lock()
+        self.read_buffer = bytearray(READ_BUFFER_SIZE)
+        self.read_start = 0
+        self.read_end = 0
+
+        # Ids of the requests sent over this connection that are still waiting on a response
+        self.pending_request_ids = set()
+
+        self.last_heartbeat_received = time.time()
+        self.last_heartbeat_sent = 0
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        self.closed = True
+        self.socket.close()
+
+    def send(self, buffers):
+        with self.write_lock:
+            self.write_queue.extend(memoryview(b) for b in buffers)
+
+    def has_data_to_send(self):
+        return len(self.write_queue) > 0
+
+    def seconds_until_next_heartbeat(self):
+        return max(0, SECONDS_PER_HEARTBEAT - (time.time() - self.last_heartbeat_sent))
+
+    def do_heartbeating(self):
+        curr_time = time.time()
+
+        if curr_time - self.last_heartbeat_received >= SECONDS_BEFORE_HEARTBEAT_TIMEOUT:
+            raise ConnectionError("Heartbeat not received")
+
+        if curr_time - self.last_heartbeat_sent >= SECONDS_PER_HEARTBEAT:
+            self.last_heartbeat_sent = curr_time
+            self.send(encode_message(MESSAGE_TYPE_HEARTBEAT))
+
+    def try_send_data(self):
+        while len(self.write_queue) > 0:
+            with self.write_lock:
+                buffers = [self.write_queue[i] for i in range(min(len(self.write_queue), MAX_BUFFERS_PER_SEND))]
+
+            try:
+                if hasattr(self.socket, "sendmsg"):
+                    sent = self.socket.sendmsg(buffers)
+                else:  # Windows has no scatter/gather send
+                    sent = self.socket.send(buffers[0])
+            except (BlockingIOError, socket.timeout):
+                return
+
+            with self.write_lock:
+                while sent > 0:
+                    buffer = self.write_queue[0]
+                    if sent >= len(buffer):
+                        self.write_queue.popleft()
+                        sent -= len(buffer)
+                    else:
+                        self.write_queue[0] = buffer[sent:]
+                        sent = 0
+
+    # Returns every complete message received, heartbeats are dealt with here
+    def try_receive_data(self):
+        messages = []
+
+        while True:
+            self._ensure_read_space()
+
+            try:
+                received = self.socket.recv_into(memoryview(self.read_buffer)[self.read_end:])
+            except (BlockingIOError, socket.timeout):
+                return messages
+
+            if received == 0:
+                logging.debug("Recieved 0 data")
+                raise ConnectionAbortedError("Connection was closed")
+
+            self.read_end += received
+            messages.extend(self._process_read_buffer())
+
+    def _ensure_read_space(self):
+        if self.read_end < len(self.read_buffer):
+            return
+
+        unread = memoryview(self.read_buffer)[self.read_start:self.read_end]
+        unread_len = len(unread)
+
+        # Make sure the whole of the message currently being received fits, otherwise just move the unread data to
+        # the start of the buffer
+        size = max(len(self.read_buffer), peek_message_size(unread) or 0)
+        if unread_len >= size:
+            size *= 2
+
+        if size == len(self.read_buffer):
+            # The unread data and where it's moved to can overlap, so it's copied out first
+            self.read_buffer[:unread_len] = bytes(unread)
+        else:
+            new_buffer = bytearray(size)
+            new_buffer[:unread_len] = unread
+            self.read_buffer = new_buffer
+
+        unread.release()
+        self.read_start = 0
+        self.read_end = unread_len
+
+    def _process_read_buffer(self):
+        messages = []
+
+        with memoryview(self.read_buffer) as view:
+            while self.read_start < self.read_end:
+                decoded = decode_message(view[self.read_start:self.read_end])
+                if decoded is None:
+                    break
+
+                (message, message_len) = decoded
+                self.read_start += message_len
+
+                if message.type == MESSAGE_TYPE_HEARTBEAT:
+                    self.last_heartbeat_received = time.time()
+                else:
+                    messages.append(message)
+
+        if self.read_start == self.read_end:
+            self.read_start = 0
+            self.read_end = 0
+
+        return messages
 
 
 class BaseConnection:
     def __init__(self, ip, port):
-        self.write_buffer = b""
-        self.unfinished_read_buffer = b""
-        self.received_messages = []
+        self.connections = Mutex([])
 
-        self.last_heartbeat_received = 0
-        self.last_heartbeat_sent = 0
+        # Requests waiting on a response, completed by the mainloop as soon as the response arrives
+        self.pending_requests = Mutex({})
+
+        # Written to by other threads to wake the mainloop up from select when there's something new to send
+        (self.wake_reader, self.wake_writer) = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
 
         self.running = True
-        self.thread = self._start_background_thread(ip, port)
+        self._start_background_thread(ip, port)
 
     def stop(self):
         self._stop_background_thread()
 
-    def _send_request_receive_response(self, data, data_type="bytes"):
-        if data_type == "json":
-            data = json.dumps(data).encode("utf-8")
+    def _send_request_receive_response(self, connection, body, payload=b""):
+        request = PendingRequest()
+        id = self._generate_id()
 
-        id = self._generate_id_and_send(data)
+        with self.pending_requests.acquire() as lock:
+            lock.value[id] = request
+            connection.pending_request_ids.add(id)
 
-        start = time.time()
-        while time.time() - start <= REQUEST_RESPONSE_TIMEOUT:
-            response = self._recv_by_id(id)
-            if response is not None:
-                break
-            time.sleep(0.1)
+        try:
+            self._send(connection, encode_message(MESSAGE_TYPE_REQUEST, id, body, payload))
 
-        if response is None:
-            raise TimeoutError("request response timeout reached")
+            if not request.completed.wait(REQUEST_RESPONSE_TIMEOUT):
+                raise TimeoutError("request response timeout reached")
+        finally:
+            with self.pending_requests.acquire() as lock:
+                del lock.value[id]
+                connection.pending_request_ids.discard(id)
 
-        if data_type == "json":
-            response = json.loads(response.decode("utf-8"))
+        if request.response is None:
+            raise ConnectionError("Connection closed before a response was received")
 
-        return response
+        return check_response(request.response)
 
-    def _generate_id_and_send(self, data):
-        id = self._generate_id()
-        self._send(id + data)
-        return id
+    def _send(self, connection, buffers):
+        connection.send(buffers)
 
-    def _send(self, data):
-        self.write_buffer += prepend_message_length(data)
+        if threading.current_thread() is not self.thread:
+            self._wake()
 
-    def _recv_by_id(self, id):
-        for (i, v) in enumerate(self.received_messages):
-            if v.startswith(id):
-                result = v[len(id):]
-                del self.received_messages[i]
-                return result
+    def _wake(self):
+        try:
+            self.wake_writer.send(b"\0")
+        except (BlockingIOError, socket.timeout):
+            pass  # Already has plenty of wake ups queued
 
-        return None
+    def _complete_request(self, message):
+        with self.pending_requests.acquire() as lock:
+            request = lock.value.get(message.id)
 
-    def _recv(self):
-        if len(self.received_messages) > 0:
-            return self.received_messages.pop()
+        if request is None:
+            logging.debug("Received response for unknown or timed out request")
+            return
 
-        return None
+        request.response = message
+        request.completed.set()
+
+    def _fail_pending_requests(self, connection):
+        with self.pending_requests.acquire() as lock:
+            requests = [lock.value[id] for id in connection.pending_request_ids if id in lock.value]
+
+        for request in requests:
+            request.completed.set()
 
     def _generate_id(self):
         return uuid.uuid4().bytes
 
     def _start_background_thread(self, ip, port):
-        t = threading.Thread(target=self._mainloop, args=(ip, port), name="IPC Mainloop")
-        t.start()
-        return t
+        # Assigned before starting so the mainloop can always tell whether it's running on its own thread
+        self.thread = threading.Thread(target=self._mainloop, args=(ip, port), name="IPC Mainloop")
+        self.thread.start()
 
     def _stop_background_thread(self):
         self.running = False
+        self._wake()
         self.thread.join()
 
     def _mainloop(self, ip, port):
         while self.running:
-            self._connect_or_accept(ip, port)
-            self.last_heartbeat_received = time.time()
+            self._maintain_connections(ip, port)
 
-            while self.running:
-                try:
-                    [ready_to_read, ready_to_write] = self._select(0.1)
+            with self.connections.acquire() as lock:
+                connections = list(lock.value)
 
-                    self._do_heartbeating()
+            heartbeat_timeouts = [c.seconds_until_next_heartbeat() for c in connections]
+            timeout = min([SECONDS_BETWEEN_CONNECTION_ATTEMPTS] + heartbeat_timeouts)
+            readers = [self.wake_reader] + self._listening_sockets() + connections
+            writers = [c for c in connections if c.has_data_to_send()]
 
-                    if ready_to_read:
-                        self._try_receive_data()
+            [ready_readers, ready_writers, ready_exc] = select.select(readers, writers, connections, timeout)
 
-                    if ready_to_write:
-                        self._try_send_data()
-                except ConnectionError as ex:
-                    logging.warning("Connection error occurred (%s) - reconnecting...", ex)
-                    break
-        self._stop()
+            if self.wake_reader in ready_readers:
+                self._drain_wake_ups()
 
-    def _connect_or_accept(self, ip, port):
-        raise NotImplementedError("Must be overridden!")
+            for listener in self._listening_sockets():
+                if listener in ready_readers:
+                    self._accept(listener)
 
-    def _select(self, timeout_seconds=None):
-        readers = [self.socket]
-        writers = [self.socket] if len(self.write_buffer) > 0 else []
-        exceptionals = [self.socket]
+            for connection in connections:
+                if connection.closed:  # Replaced while handling an earlier connection's messages
+                    continue
 
-        [ready_readers, ready_writers, ready_exc] = select.select(readers, writers, exceptionals, timeout_seconds)
-        if len(ready_exc) > 0:
-            raise ConnectionError("Socket is in an exceptional state")
+                try:
+                    if connection in ready_exc:
+                        raise ConnectionError("Socket is in an exceptional state")
 
-        return [len(ready_readers) > 0, len(ready_writers) > 0]
+                    connection.do_heartbeating()
 
-    def _do_heartbeating(self):
-        curr_time = time.time()
+                    if connection in ready_readers:
+                        for message in connection.try_receive_data():
+                            self._handle_message(connection, message)
 
-        if HEARTBEAT_MESSAGE in self.received_messages:
-            self.last_heartbeat_received = curr_time
+                    # Anything queued while we were waiting can be sent straight away, no need to wait for select
+                    if connection in ready_writers or connection.has_data_to_send():
+                        connection.try_send_data()
+                except ConnectionError as ex:
+                    logging.warning("Connection error occurred (%s) - closing connection", ex)
+                    self._remove_connection(connection)
+                except MALFORMED_MESSAGE_ERRORS as ex:
+                    logging.warning("Malformed message received (%r) - closing connection", ex)
+                    self._remove_connection(connection)
 
-        self.received_messages = [i for i in self.received_messages if i != HEARTBEAT_MESSAGE]
+        with self.connections.acquire() as lock:
+            connections = list(lock.value)
+        for connection in connections:
+            self._remove_connection(connection)
 
-        if curr_time - self.last_heartbeat_received >= SECONDS_BEFORE_HEARTBEAT_TIMEOUT:
-            raise ConnectionError("Heartbeat not received")
+        self._stop()
+        self.wake_reader.close()
+        self.wake_writer.close()
 
-        if curr_time - self.last_heartbeat_sent >= SECONDS_PER_HEARTBEAT:
-            self.last_heartbeat_sent = curr_time
-            self._send(HEARTBEAT_MESSAGE)
+    def _maintain_connections(self, ip, port):
+        pass
 
-    def _stop(self):
+    def _listening_sockets(self):
+        return []
+
+    def _accept(self, listener):
         pass
 
-    def _try_send_data(self):
-        if len(self.write_buffer) > 0:
-            try:
-                sent = self.socket.send(self.write_buffer)
-                self.write_buffer = self.write_buffer[sent:]
-            except (BlockingIOError, socket.timeout):
-                pass
+    def _add_connection(self, connection):
+        with self.connections.acquire() as lock:
+            lock.value.append(connection)
 
-    def _try_receive_data(self):
-        try:
-            raw = self.socket.recv(4096)
+    def _remove_connection(self, connection):
+        with self.connections.acquire() as lock:
+            if connection in lock.value:
+                lock.value.remove(connection)
 
-            if len(raw) == 0:
-                logging.debug("Recieved 0 data")
-                raise ConnectionAbortedError("Connection was closed")
+        connection.close()
+        self._fail_pending_requests(connection)
+        self._connection_removed(connection)
+
+    def _connection_removed(self, connection):
+        pass
 
-            self.unfinished_read_buffer += raw
+    def _drain_wake_ups(self):
+        try:
+            while len(self.wake_reader.recv(4096)) > 0:
+                pass
         except (BlockingIOError, socket.timeout):
             pass
 
-        while len(self.unfinished_read_buffer) > 0:
-            if len(self.unfinished_read_buffer) < BYTES_PER_PACKET_SIZE:
-                return
-
-            packet_size = int.from_bytes(self.unfinished_read_buffer[:BYTES_PER_PACKET_SIZE], PACKET_SIZE_ENDIANNESS)
-            raw_packet_size = packet_size + BYTES_PER_PACKET_SIZE
-            if len(self.unfinished_read_buffer) < raw_packet_size:
-                return
-
-            raw_msg = self.unfinished_read_buffer[:raw_packet_size]
-            self.unfinished_read_buffer = self.unfinished_read_buffer[raw_packet_size:]
-            message = raw_msg[BYTES_PER_PACKET_SIZE:]
+    def _stop(self):
+        pass
 
-            if not self._process_message_on_receive(message):
-                self.received_messages.append(message)
+    def _handle_message(self, connection, message):
+        if message.type == MESSAGE_TYPE_RESPONSE:
+            self._complete_request(message)
+        elif not self._process_message_on_receive(connection, message):
+            logging.warning("Unhandled message of type %s received", message.type)
 
-    def _process_message_on_receive(self, msg_bytes):
+    def _process_message_on_receive(self, connection, message):
         return False
 
 
 class WebServerSide(BaseConnection):
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, unix_socket_path=None):
         self.srv_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.srv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.srv_socket.bind((ip, port))
         self.srv_socket.listen()
+        self.srv_socket.setblocking(False)
+
+        # Camera processes on the same machine connect here instead, skipping the TCP loopback overhead
+        self.unix_socket_path = unix_socket_path if unix_sockets_supported() else None
+        self.unix_srv_socket = None
+        if self.unix_socket_path is not None:
+            remove_unix_socket_file(self.unix_socket_path)
+            self.unix_srv_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.unix_srv_socket.bind(self.unix_socket_path)
+            self.unix_srv_socket.listen()
+            self.unix_srv_socket.setblocking(False)
+
+        # Connections that have said which camera they are, by camera id, in the order they connected
+        self.cameras = Mutex({})
 
-        self.socket = None
+        # Notified whenever a camera has a new segment or live fragment, or a camera connects or disconnects
+        self.camera_updated = threading.Condition()
 
         super().__init__(ip, port)
 
-    def is_recording(self):
+    def camera_ids(self):
+        with self.cameras.acquire() as lock:
+            return list(lock.value.keys())
+
+    def is_recording(self, camera_id=None):
         request = {REQUEST_KEY: "is_recording"}
-        response = self._send_request_receive_response(request, "json")
-        return response["value"]
+        response = self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.body["value"]
 
-    def start_recording(self):
+    def start_recording(self, camera_id=None):
         request = {REQUEST_KEY: "start_recording"}
-        response = self._send_request_receive_response(request, "json")
-        return response["value"]
+        response = self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.body["value"]
 
-    def stop_recording(self):
+    def stop_recording(self, camera_id=None):
         request = {REQUEST_KEY: "stop_recording"}
-        response = self._send_request_receive_response(request, "json")
-        return response["value"]
-
-    def segment(self, last_received):
+        response = self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.body["value"]
+
+    # The motion score of each of the camera host's cameras, by camera id
+    def motion_scores(self, camera_id=None):
+        request = {REQUEST_KEY: "motion_scores"}
+        response = self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.body["value"]
+
+    # The renditions the camera can be watched in, as dicts of camera_id (the camera each is served as), width, height,
+    # bandwidth (peak bits per second, 0 if not known yet) and audio (whether it has sound)
+    def renditions(self, camera_id=None):
+        request = {REQUEST_KEY: "renditions"}
+        response = self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.body["value"]
+
+    def segment(self, last_received, camera_id=None):
         request = {REQUEST_KEY: "segment", "last_received": last_received}
-        response = self._send_request_receive_response(request, "json")
-        buf = base64.b64decode(response["value"].encode("utf-8"))
-        return (response["filename"], buf)
+        response = self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return (response.body["filename"], response.payload)
 
-    def _connect_or_accept(self, ip, port):
-        logging.info("Waiting for connection...")
-        self.srv_socket.settimeout(1)
-        while self.running:
-            try:
-                if self.socket is not None:
-                    self.socket.close()
-                    self.socket = None
-
-                [self.socket, self.clnt_ip] = self.srv_socket.accept()
-                logging.info("Connection received.")
-                self.socket.setblocking(False)
-                break
-            except socket.timeout:
-                pass
+    def segment_name(self, last_received, camera_id=None):
+        return next_segment_name(list(self._camera_connection(camera_id).recent_segments), last_received)
+
+    # Like segment_name, but waits up to timeout seconds for a new segment if there isn't one yet
+    def wait_for_segment_name(self, last_received, camera_id=None, timeout=None):
+        return self._wait_for(lambda: self.segment_name(last_received, camera_id), timeout)
+
+    # Returns (init_id, init_segment) for the camera's live stream, or None if it doesn't have one
+    def live_init_segment(self, camera_id=None):
+        return self._camera_connection(camera_id).live_init
+
+    # The live fragment to send after last_sequence (None for a new viewer), waiting up to timeout seconds for it.
+    # Returns None if it still isn't there.
+    def wait_for_live_fragment(self, last_sequence, camera_id=None, timeout=None):
+        return self._wait_for(
+            lambda: next_live_fragment(list(self._camera_connection(camera_id).live_fragments), last_sequence),
+            timeout)
+
+    # Waits for get to return something truthy, checking each time a camera is updated
+    def _wait_for(self, get, timeout):
+        with self.camera_updated:
+            self.camera_updated.wait_for(get, timeout)
+
+        return get()
+
+    def segment_data(self, filename, camera_id=None):
+        request = {REQUEST_KEY: "segment_data", "filename": filename}
+        response = self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.payload
+
+    # An HLS playlist or segment, by its path in the recordings directory (see hls.is_hls_path)
+    def hls_file(self, path, camera_id=None):
+        request = {REQUEST_KEY: "hls_file", "path": path}
+        response = self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.payload
+
+    # Whether the camera process runs on this machine, and so shares its recordings directory with us
+    def is_local_camera(self, camera_id=None):
+        return self._camera_connection(camera_id).is_local
+
+    # The id of the camera requests for camera_id go to, i.e. the default camera's when it's None
+    def resolve_camera_id(self, camera_id=None):
+        return self._camera_connection(camera_id).camera_id
+
+    # With no camera id given, the camera that has been connected the longest is used
+    def _camera_connection(self, camera_id):
+        with self.cameras.acquire() as lock:
+            if camera_id is None and len(lock.value) > 0:
+                return next(iter(lock.value.values()))
+
+            if camera_id in lock.value:
+                return lock.value[camera_id]
+
+        raise ConnectionError(f"Camera '{camera_id}' is not connected" if camera_id else "No camera is connected")
+
+    def _listening_sockets(self):
+        return [s for s in [self.srv_socket, self.unix_srv_socket] if s is not None]
+
+    def _accept(self, listener):
+        try:
+            (sock, address) = listener.accept()
+        except (BlockingIOError, socket.timeout):
+            return
+
+        logging.info("Connection received from %s", address)
+        self._add_connection(Connection(sock))
+
+    def _process_message_on_receive(self, connection, message):
+        if message.type == MESSAGE_TYPE_EVENT:
+            if not apply_camera_event(connection, message):
+                return False
+
+            self._notify_camera_updated()
+            return True
+
+        if message.type != MESSAGE_TYPE_HELLO:
+            return False
+
+        camera_id = message.body["camera_id"]
+        logging.info("Camera '%s' connected", camera_id)
+        add_hello_segments(connection.recent_segments, message.body.get("segments", []))
+
+        with self.cameras.acquire() as lock:
+            # A camera reconnecting before its old connection timed out replaces it
+            previous = lock.value.pop(camera_id, None)
+            connection.camera_id = camera_id
+            lock.value[camera_id] = connection
+
+        if previous is not None and previous is not connection:
+            self._remove_connection(previous)
+
+        self._notify_camera_updated()
+        return True
+
+    def _notify_camera_updated(self):
+        with self.camera_updated:
+            self.camera_updated.notify_all()
+
+    def _connection_removed(self, connection):
+        with self.cameras.acquire() as lock:
+            if lock.value.get(connection.camera_id) is connection:
+                del lock.value[connection.camera_id]
+                logging.info("Camera '%s' disconnected", connection.camera_id)
+
+        self._notify_camera_updated()
 
     def _stop(self):
         self.srv_socket.close()
 
+        if self.unix_srv_socket is not None:
+            self.unix_srv_socket.close()
+            remove_unix_socket_file(self.unix_socket_path)
+
 
 class CameraClientSide(BaseConnection):
-    def __init__(self, camera_manager, ip, port):
-        self.socket = None
+    def __init__(self, camera_manager, ip, port, camera_id, unix_socket_path=None):
         self.camera_manager = camera_manager
+        self.camera_id = camera_id
+        self.last_connection_attempt = 0
+
+        use_unix_socket = unix_socket_path is not None and unix_sockets_supported() and is_local_host(ip)
+        self.unix_socket_path = unix_socket_path if use_unix_socket else None
+
+        # Requests are handled off the mainloop so a slow request doesn't hold up heartbeats or other requests
+        self.request_executor = ThreadPoolExecutor(max_workers=REQUEST_WORKERS, thread_name_prefix="IPC Request")
 
         super().__init__(ip, port)
 
-    def _connect_or_accept(self, ip, port):
-        while self.running:
+        camera_manager.add_segment_listener(self._segment_added)
+        camera_manager.add_live_listener(self._live_init_added, self._live_fragment_added)
+
+    def stop(self):
+        super().stop()
+        self.request_executor.shutdown()
+
+    # These are called by the recorder's and live stream's threads - the webserver is told about each segment and
+    # fragment once, however many viewers it has
+    def _segment_added(self, filename):
+        self._send_event(*segment_event(filename))
+
+    def _live_init_added(self, init_id, init_segment):
+        self._send_event(*live_init_event(init_id, init_segment))
+
+    def _live_fragment_added(self, fragment):
+        self._send_event(*live_fragment_event(fragment))
+
+    def _send_event(self, body, payload):
+        with self.connections.acquire() as lock:
+            connections = list(lock.value)
+
+        for connection in connections:
+            self._send(connection, encode_message(MESSAGE_TYPE_EVENT, body=body, payload=payload))
+
+    def _maintain_connections(self, ip, port):
+        with self.connections.acquire() as lock:
+            if len(lock.value) > 0:
+                return
+
+        if time.time() - self.last_connection_attempt < SECONDS_BETWEEN_CONNECTION_ATTEMPTS:
+            return
+        self.last_connection_attempt = time.time()
+
+        sock = self._connect_unix_socket()
+        if sock is None:
             try:
-                if self.socket is not None:
-                    self.socket.close()
-                    self.socket = None
-
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socket.connect((ip, port))
-                logging.info("Socket connected")
-                break
+                sock = socket.create_connection((ip, port), timeout=SECONDS_BETWEEN_CONNECTION_ATTEMPTS)
             except (ConnectionError, OSError):
-                time.sleep(1)
+                return
 
-        self.socket.setblocking(False)
+        logging.info("Socket connected (%s)", "unix" if sock.family == getattr(socket, "AF_UNIX", None) else "tcp")
+        connection = Connection(sock)
+        # Added first so no segment finishing in between is missed - the webserver gets it as an event instead
+        self._add_connection(connection)
+        hello = {"camera_id": self.camera_id, "segments": self.camera_manager.recent_segment_names()}
+        connection.send(encode_message(MESSAGE_TYPE_HELLO, body=hello))
+
+        live_init = self.camera_manager.live_init_segment()
+        if live_init is not None:
+            (body, payload) = live_init_event(*live_init)
+            connection.send(encode_message(MESSAGE_TYPE_EVENT, body=body, payload=payload))
 
-    def _process_message_on_receive(self, msg_bytes):
-        [msg_id, msg_bytes] = [msg_bytes[:ID_BYTES_LEN], msg_bytes[ID_BYTES_LEN:]]
+    # Falls back to TCP if the webserver isn't listening on the unix socket (e.g. it's an older version)
+    def _connect_unix_socket(self):
+        if self.unix_socket_path is None:
+            return None
 
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         try:
-            msg = json.loads(msg_bytes.decode("utf-8"))
-        except json.decoder.JSONDecodeError:
+            sock.settimeout(SECONDS_BETWEEN_CONNECTION_ATTEMPTS)
+            sock.connect(self.unix_socket_path)
+            return sock
+        except (ConnectionError, OSError):
+            sock.close()
+            return None
+
+    def _process_message_on_receive(self, connection, message):
+        if message.type != MESSAGE_TYPE_REQUEST or message.body is None or REQUEST_KEY not in message.body:
             return False
 
-        if REQUEST_KEY in msg:
-            response = self._process_message(msg)
-            if response is not None:
-                res_bytes = json.dumps(response).encode("utf-8")
-                self._send(msg_id + res_bytes)
-                return True
-
-        return False
-
-    def _process_message(self, message):
-        req = message[REQUEST_KEY]
-        # logging.debug("Recieved: " + req)
-
-        if req == "is_recording":
-            return {"value": self.camera_manager.is_recording()}
-        elif req == "start_recording":
-            self.camera_manager.start_recording()
-            return {"value": True}
-        elif req == "stop_recording":
-            self.camera_manager.stop_recording()
-            return {"value": True}
-        elif req == "segment":
-            last_received = message["last_received"]
-            (filename, buf) = self.camera_manager.segment(last_received)
-            data = base64.b64encode(buf).decode("utf-8")
-            return {"value": data, "filename": filename}
+        self.request_executor.submit(self._respond, connection, message)
+        return True
+
+    def _respond(self, connection, message):
+        (body, payload) = respond_to_request(self.camera_manager, message.body)
+        self._send(connection, encode_message(MESSAGE_TYPE_RESPONSE, message.id, body, payload))
+
+
+# Returns the JSON body and raw payload to respond to a request with - an error response if it couldn't be completed, so
+# the web side isn't left waiting for a response that never comes
+def respond_to_request(camera_manager, message):
+    try:
+        response = process_request(camera_manager, message)
+    except FileNotFoundError as ex:
+        logging.warning("Request '%s' for a missing file: %s", message[REQUEST_KEY], ex)
+        return error_response(ERROR_NOT_FOUND, str(ex))
+    except Exception as ex:
+        logging.exception("Error processing request '%s'", message[REQUEST_KEY])
+        return error_response(ERROR_FAILED, str(ex))
+
+    if response is None:
+        logging.warning("Unknown request '%s'", message[REQUEST_KEY])
+        return error_response(ERROR_UNKNOWN_REQUEST, f"Unknown request '{message[REQUEST_KEY]}'")
+
+    return response
+
+
+# Returns the JSON body and raw payload to respond with, or None for an unknown request
+def process_request(camera_manager, message):
+    req = message[REQUEST_KEY]
+    # logging.debug("Recieved: " + req)
+
+    if req == "is_recording":
+        return ({"value": camera_manager.is_recording()}, b"")
+    elif req == "start_recording":
+        camera_manager.start_recording()
+        return ({"value": True}, b"")
+    elif req == "stop_recording":
+        camera_manager.stop_recording()
+        return ({"value": True}, b"")
+    elif req == "motion_scores":
+        return ({"value": camera_manager.motion_scores()}, b"")
+    elif req == "renditions":
+        return ({"value": camera_manager.renditions()}, b"")
+    elif req == "segment":
+        last_received = message["last_received"]
+        (filename, buf) = camera_manager.segment(last_received)
+        return ({"filename": filename}, buf)
+    elif req == "segment_data":
+        return ({}, camera_manager.segment_data(message["filename"]))
+    elif req == "hls_file":
+        return ({}, camera_manager.hls_file(message["path"]))
@@ -0,0 +1,529 @@
+import asyncio
+import socket
+import threading
+import time
+import uuid
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from interprocess_communication import (
+    Message, MESSAGE_HEADER, MESSAGE_TYPE_HEARTBEAT, MESSAGE_TYPE_REQUEST, MESSAGE_TYPE_RESPONSE, MESSAGE_TYPE_HELLO,
+    MESSAGE_TYPE_EVENT, REQUEST_KEY, REQUEST_RESPONSE_TIMEOUT, REQUEST_WORKERS,
+    SECONDS_BETWEEN_CONNECTION_ATTEMPTS, SECONDS_PER_HEARTBEAT, SECONDS_BEFORE_HEARTBEAT_TIMEOUT, SOCKET_BUFFER_SIZE,
+    MALFORMED_MESSAGE_ERRORS, encode_message, decode_message_header, decode_message_body, check_response,
+    respond_to_request, unix_sockets_supported, is_local_host, is_local_socket, remove_unix_socket_file,
+    add_hello_segments, apply_camera_event, segment_event, live_init_event, live_fragment_event
+)
+from live_stream import next_live_fragment
+from segments import next_segment_name, RECENT_SEGMENTS
+import settings
+
+# The same protocol and API as interprocess_communication, but every connection, heartbeat and pending request is
+# handled by a single asyncio event loop running on a background thread rather than a hand rolled select loop.
+#
+# The blocking methods (is_recording, segment, ...) can be called from any thread. Code already running on the event
+# loop can await the *_async versions instead, which don't tie up a thread per request.
+
+
+class Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.write_lock = asyncio.Lock()
+
+        self.camera_id = None
+        self.closed = False
+        self.is_local = False
+
+        # Names of the camera's latest segments and its live stream, kept up to date by the camera side
+        self.recent_segments = deque(maxlen=RECENT_SEGMENTS)
+        self.live_init = None
+        self.live_fragments = deque(maxlen=settings.LIVE_FRAGMENTS_KEPT)
+
+        # Futures for the requests sent over this connection that are still waiting on a response, by request id
+        self.pending_requests = {}
+
+        self.last_heartbeat_received = time.time()
+
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            self.is_local = is_local_socket(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+    async def send(self, buffers):
+        async with self.write_lock:
+            self.writer.writelines(buffers)
+            await self.writer.drain()
+
+    async def receive(self):
+        header = await self.reader.readexactly(MESSAGE_HEADER.size)
+        (message_type, id, body_len, payload_len) = decode_message_header(header)
+
+        body = decode_message_body(await self.reader.readexactly(body_len)) if body_len > 0 else None
+        payload = await self.reader.readexactly(payload_len) if payload_len > 0 else b""
+
+        return Message(message_type, id, body, payload)
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.writer.close()
+
+        for future in self.pending_requests.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed before a response was received"))
+
+
+class BaseConnection:
+    def __init__(self, ip, port):
+        self.connections = []
+
+        self.loop = asyncio.new_event_loop()
+        self.running = True
+        self.started = threading.Event()
+        # What starting up raised (e.g. the port already being in use), raised again here like the legacy transport
+        self.start_error = None
+
+        self.thread = threading.Thread(target=self._run_loop, args=(ip, port), name="IPC Event Loop")
+        self.thread.start()
+        self.started.wait()
+
+        if self.start_error is not None:
+            self.thread.join()
+            raise self.start_error
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._stop_async(), self.loop).result()
+        self.thread.join()
+
+    def _run_loop(self, ip, port):
+        asyncio.set_event_loop(self.loop)
+
+        try:
+            self.loop.run_until_complete(self._start(ip, port))
+        except Exception as ex:
+            self.start_error = ex
+            self.loop.close()
+            self.started.set()
+            return
+
+        self.main_task = self.loop.create_task(self._main(ip, port))
+        self.started.set()
+
+        try:
+            self.loop.run_until_complete(self.main_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # Let connection and request tasks finish being cancelled before the loop goes away
+            remaining = asyncio.all_tasks(self.loop)
+            for task in remaining:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*remaining, return_exceptions=True))
+            self.loop.close()
+
+    # Anything that has to be done before the constructor returns
+    async def _start(self, ip, port):
+        pass
+
+    async def _main(self, ip, port):
+        raise NotImplementedError("Must be overridden!")
+
+    async def _stop_async(self):
+        self.running = False
+        self.main_task.cancel()
+
+        for connection in list(self.connections):
+            connection.close()
+
+    # Runs a request to completion from a thread that isn't the event loop's
+    def _request(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        return future.result()
+
+    async def _send_request_receive_response(self, connection, body, payload=b""):
+        id = uuid.uuid4().bytes
+        future = self.loop.create_future()
+        connection.pending_requests[id] = future
+
+        try:
+            await connection.send(encode_message(MESSAGE_TYPE_REQUEST, id, body, payload))
+            return check_response(await asyncio.wait_for(future, REQUEST_RESPONSE_TIMEOUT))
+        except asyncio.TimeoutError:
+            raise TimeoutError("request response timeout reached")
+        finally:
+            connection.pending_requests.pop(id, None)
+
+    async def _serve_connection(self, connection):
+        self.connections.append(connection)
+        heartbeat_task = self.loop.create_task(self._heartbeat(connection))
+
+        try:
+            await self._connection_added(connection)
+
+            while not connection.closed:
+                message = await connection.receive()
+
+                if message.type == MESSAGE_TYPE_HEARTBEAT:
+                    connection.last_heartbeat_received = time.time()
+                elif message.type == MESSAGE_TYPE_RESPONSE:
+                    future = connection.pending_requests.get(message.id)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+                elif not self._process_message_on_receive(connection, message):
+                    logging.warning("Unhandled message of type %s received", message.type)
+        except (ConnectionError, asyncio.IncompleteReadError, OSError) as ex:
+            if not connection.closed:
+                logging.warning("Connection error occurred (%s) - closing connection", ex)
+        except MALFORMED_MESSAGE_ERRORS as ex:
+            logging.warning("Malformed message received (%r) - closing connection", ex)
+        finally:
+            heartbeat_task.cancel()
+            connection.close()
+            self.connections.remove(connection)
+            self._connection_removed(connection)
+
+    async def _heartbeat(self, connection):
+        try:
+            while not connection.closed:
+                if time.time() - connection.last_heartbeat_received >= SECONDS_BEFORE_HEARTBEAT_TIMEOUT:
+                    logging.warning("Heartbeat not received - closing connection")
+                    connection.close()
+                    return
+
+                await connection.send(encode_message(MESSAGE_TYPE_HEARTBEAT))
+                await asyncio.sleep(SECONDS_PER_HEARTBEAT)
+        except (ConnectionError, OSError):
+            connection.close()
+
+    async def _connection_added(self, connection):
+        pass
+
+    def _process_message_on_receive(self, connection, message):
+        return False
+
+    def _connection_removed(self, connection):
+        pass
+
+
+class WebServerSide(BaseConnection):
+    def __init__(self, ip, port, unix_socket_path=None):
+        # Connections that have said which camera they are, by camera id, in the order they connected
+        self.cameras = {}
+
+        # Notified whenever a camera has a new segment or live fragment, or a camera connects or disconnects - one for
+        # threads waiting in wait_for_* and one for coroutines waiting in wait_for_*_async, made in _start as it has to
+        # belong to the event loop
+        self.camera_updated = threading.Condition()
+        self.camera_updated_async = None
+
+        # Camera processes on the same machine connect here instead, skipping the TCP loopback overhead
+        self.unix_socket_path = unix_socket_path if unix_sockets_supported() else None
+
+        super().__init__(ip, port)
+
+    def camera_ids(self):
+        return list(self.cameras.copy().keys())
+
+    def is_recording(self, camera_id=None):
+        return self._request(self.is_recording_async(camera_id))
+
+    def start_recording(self, camera_id=None):
+        return self._request(self.start_recording_async(camera_id))
+
+    def stop_recording(self, camera_id=None):
+        return self._request(self.stop_recording_async(camera_id))
+
+    # The motion score of each of the camera host's cameras, by camera id
+    def motion_scores(self, camera_id=None):
+        return self._request(self.motion_scores_async(camera_id))
+
+    # The renditions the camera can be watched in, as dicts of camera_id (the camera each is served as), width, height,
+    # bandwidth (peak bits per second, 0 if not known yet) and audio (whether it has sound)
+    def renditions(self, camera_id=None):
+        return self._request(self.renditions_async(camera_id))
+
+    def segment(self, last_received, camera_id=None):
+        return self._request(self.segment_async(last_received, camera_id))
+
+    def segment_name(self, last_received, camera_id=None):
+        return next_segment_name(list(self._camera_connection(camera_id).recent_segments), last_received)
+
+    # Like segment_name, but waits up to timeout seconds for a new segment if there isn't one yet
+    def wait_for_segment_name(self, last_received, camera_id=None, timeout=None):
+        return self._wait_for(lambda: self.segment_name(last_received, camera_id), timeout)
+
+    # Returns (init_id, init_segment) for the camera's live stream, or None if it doesn't have one
+    def live_init_segment(self, camera_id=None):
+        return self._camera_connection(camera_id).live_init
+
+    # The live fragment to send after last_sequence (None for a new viewer), waiting up to timeout seconds for it.
+    # Returns None if it still isn't there.
+    def wait_for_live_fragment(self, last_sequence, camera_id=None, timeout=None):
+        return self._wait_for(self._next_live_fragment_getter(last_sequence, camera_id), timeout)
+
+    def segment_data(self, filename, camera_id=None):
+        return self._request(self.segment_data_async(filename, camera_id))
+
+    # An HLS playlist or segment, by its path in the recordings directory (see hls.is_hls_path)
+    def hls_file(self, path, camera_id=None):
+        return self._request(self.hls_file_async(path, camera_id))
+
+    # Whether the camera process runs on this machine, and so shares its recordings directory with us
+    def is_local_camera(self, camera_id=None):
+        return self._camera_connection(camera_id).is_local
+
+    # The id of the camera requests for camera_id go to, i.e. the default camera's when it's None
+    def resolve_camera_id(self, camera_id=None):
+        return self._camera_connection(camera_id).camera_id
+
+    async def is_recording_async(self, camera_id=None):
+        request = {REQUEST_KEY: "is_recording"}
+        response = await self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.body["value"]
+
+    async def start_recording_async(self, camera_id=None):
+        request = {REQUEST_KEY: "start_recording"}
+        response = await self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.body["value"]
+
+    async def stop_recording_async(self, camera_id=None):
+        request = {REQUEST_KEY: "stop_recording"}
+        response = await self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.body["value"]
+
+    async def motion_scores_async(self, camera_id=None):
+        request = {REQUEST_KEY: "motion_scores"}
+        response = await self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.body["value"]
+
+    async def renditions_async(self, camera_id=None):
+        request = {REQUEST_KEY: "renditions"}
+        response = await self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.body["value"]
+
+    async def segment_async(self, last_received, camera_id=None):
+        request = {REQUEST_KEY: "segment", "last_received": last_received}
+        response = await self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return (response.body["filename"], response.payload)
+
+    async def segment_name_async(self, last_received, camera_id=None):
+        return self.segment_name(last_received, camera_id)
+
+    async def wait_for_segment_name_async(self, last_received, camera_id=None, timeout=None):
+        return await self._wait_for_async(lambda: self.segment_name(last_received, camera_id), timeout)
+
+    async def wait_for_live_fragment_async(self, last_sequence, camera_id=None, timeout=None):
+        return await self._wait_for_async(self._next_live_fragment_getter(last_sequence, camera_id), timeout)
+
+    def _next_live_fragment_getter(self, last_sequence, camera_id):
+        return lambda: next_live_fragment(list(self._camera_connection(camera_id).live_fragments), last_sequence)
+
+    # Waits for get to return something truthy, checking each time a camera is updated
+    def _wait_for(self, get, timeout):
+        with self.camera_updated:
+            self.camera_updated.wait_for(get, timeout)
+
+        return get()
+
+    async def _wait_for_async(self, get, timeout):
+        try:
+            async with self.camera_updated_async:
+                await asyncio.wait_for(self.camera_updated_async.wait_for(get), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        return get()
+
+    async def segment_data_async(self, filename, camera_id=None):
+        request = {REQUEST_KEY: "segment_data", "filename": filename}
+        response = await self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.payload
+
+    async def hls_file_async(self, path, camera_id=None):
+        request = {REQUEST_KEY: "hls_file", "path": path}
+        response = await self._send_request_receive_response(self._camera_connection(camera_id), request)
+        return response.payload
+
+    # With no camera id given, the camera that has been connected the longest is used
+    def _camera_connection(self, camera_id):
+        if camera_id is None and len(self.cameras) > 0:
+            return next(iter(self.cameras.values()))
+
+        if camera_id in self.cameras:
+            return self.cameras[camera_id]
+
+        raise ConnectionError(f"Camera '{camera_id}' is not connected" if camera_id else "No camera is connected")
+
+    # Listening before the constructor returns, so it raises if the port is already in use
+    async def _start(self, ip, port):
+        self.camera_updated_async = asyncio.Condition()
+        self.servers = [await asyncio.start_server(self._accept, ip, port, reuse_address=True)]
+
+        if self.unix_socket_path is not None:
+            remove_unix_socket_file(self.unix_socket_path)
+            try:
+                self.servers.append(await asyncio.start_unix_server(self._accept, self.unix_socket_path))
+            except OSError:
+                self.servers[0].close()
+                raise
+
+    async def _main(self, ip, port):
+        logging.info("Waiting for connections...")
+
+        try:
+            await asyncio.gather(*[server.serve_forever() for server in self.servers])
+        finally:
+            for server in self.servers:
+                server.close()
+
+            if self.unix_socket_path is not None:
+                remove_unix_socket_file(self.unix_socket_path)
+
+    async def _accept(self, reader, writer):
+        logging.info("Connection received from %s", writer.get_extra_info("peername"))
+        await self._serve_connection(Connection(reader, writer))
+
+    def _process_message_on_receive(self, connection, message):
+        if message.type == MESSAGE_TYPE_EVENT:
+            if not apply_camera_event(connection, message):
+                return False
+
+            self._notify_camera_updated()
+            return True
+
+        if message.type != MESSAGE_TYPE_HELLO:
+            return False
+
+        camera_id = message.body["camera_id"]
+        logging.info("Camera '%s' connected", camera_id)
+        add_hello_segments(connection.recent_segments, message.body.get("segments", []))
+
+        # A camera reconnecting before its old connection timed out replaces it
+        previous = self.cameras.pop(camera_id, None)
+        connection.camera_id = camera_id
+        self.cameras[camera_id] = connection
+
+        if previous is not None and previous is not connection:
+            previous.close()
+
+        self._notify_camera_updated()
+        return True
+
+    def _connection_removed(self, connection):
+        if self.cameras.get(connection.camera_id) is connection:
+            del self.cameras[connection.camera_id]
+            logging.info("Camera '%s' disconnected", connection.camera_id)
+
+        self._notify_camera_updated()
+
+    def _notify_camera_updated(self):
+        with self.camera_updated:
+            self.camera_updated.notify_all()
+
+        if self.running:
+            self.loop.create_task(self._notify_camera_updated_async())
+
+    async def _notify_camera_updated_async(self):
+        async with self.camera_updated_async:
+            self.camera_updated_async.notify_all()
+
+
+class CameraClientSide(BaseConnection):
+    def __init__(self, camera_manager, ip, port, camera_id, unix_socket_path=None):
+        self.camera_manager = camera_manager
+        self.camera_id = camera_id
+
+        use_unix_socket = unix_socket_path is not None and unix_sockets_supported() and is_local_host(ip)
+        self.unix_socket_path = unix_socket_path if use_unix_socket else None
+
+        # camera_manager calls block, so they're run off the event loop
+        self.request_executor = ThreadPoolExecutor(max_workers=REQUEST_WORKERS, thread_name_prefix="IPC Request")
+
+        super().__init__(ip, port)
+
+        camera_manager.add_segment_listener(self._segment_added)
+        camera_manager.add_live_listener(self._live_init_added, self._live_fragment_added)
+
+    def stop(self):
+        super().stop()
+        self.request_executor.shutdown()
+
+    # These are called by the recorder's and live stream's threads - the webserver is told about each segment and
+    # fragment once, however many viewers it has
+    def _segment_added(self, filename):
+        self._send_event_threadsafe(*segment_event(filename))
+
+    def _live_init_added(self, init_id, init_segment):
+        self._send_event_threadsafe(*live_init_event(init_id, init_segment))
+
+    def _live_fragment_added(self, fragment):
+        self._send_event_threadsafe(*live_fragment_event(fragment))
+
+    def _send_event_threadsafe(self, body, payload):
+        coroutine = self._send_event(body, payload)
+        try:
+            asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        except RuntimeError:  # The event loop has already been stopped
+            coroutine.close()
+
+    async def _send_event(self, body, payload):
+        for connection in list(self.connections):
+            try:
+                await connection.send(encode_message(MESSAGE_TYPE_EVENT, body=body, payload=payload))
+            except (ConnectionError, OSError):
+                pass  # The connection is cleaned up by the task reading from it
+
+    async def _main(self, ip, port):
+        while self.running:
+            try:
+                (reader, writer) = await self._open_connection(ip, port)
+            except (ConnectionError, OSError):
+                await asyncio.sleep(SECONDS_BETWEEN_CONNECTION_ATTEMPTS)
+                continue
+
+            await self._serve_connection(Connection(reader, writer))
+
+    # Sent once the connection is being served so no segment finishing in between is missed
+    async def _connection_added(self, connection):
+        hello = {"camera_id": self.camera_id, "segments": self.camera_manager.recent_segment_names()}
+        await connection.send(encode_message(MESSAGE_TYPE_HELLO, body=hello))
+
+        live_init = self.camera_manager.live_init_segment()
+        if live_init is not None:
+            (body, payload) = live_init_event(*live_init)
+            await connection.send(encode_message(MESSAGE_TYPE_EVENT, body=body, payload=payload))
+
+    # Falls back to TCP if the webserver isn't listening on the unix socket (e.g. it's an older version)
+    async def _open_connection(self, ip, port):
+        if self.unix_socket_path is not None:
+            try:
+                connection = await asyncio.open_unix_connection(self.unix_socket_path)
+                logging.info("Socket connected (unix)")
+                return connection
+            except (ConnectionError, OSError):
+                pass
+
+        connection = await asyncio.open_connection(ip, port)
+        logging.info("Socket connected (tcp)")
+        return connection
+
+    def _process_message_on_receive(self, connection, message):
+        if message.type != MESSAGE_TYPE_REQUEST or message.body is None or REQUEST_KEY not in message.body:
+            return False
+
+        self.loop.create_task(self._respond(connection, message))
+        return True
+
+    async def _respond(self, connection, message):
+        (body, payload) = await self.loop.run_in_executor(
+            self.request_executor, respond_to_request, self.camera_manager, message.body)
+
+        try:
+            await connection.send(encode_message(MESSAGE_TYPE_RESPONSE, message.id, body, payload))
+        except (ConnectionError, OSError):
+            pass  # The connection is cleaned up by the task reading from it
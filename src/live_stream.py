@@ -0,0 +1,252 @@
+import time
+import logging
+import threading
+from collections import namedtuple, deque
+
+import ffmpeg
+import mp4
+import settings
+
+# A low latency alternative to the recorded segments for watching live. Frames from the frame ring are piped into one
+# long running ffmpeg process, which encodes them into a fragmented MP4 stream - an init segment, then a short
+# fragment every LIVE_FRAGMENT_SECONDS. Fragments are handed to listeners as soon as ffmpeg writes them out.
+#
+# Each fragment carries the capture time of its first frame, found from its decode time (tfdt) - frames are fed to
+# ffmpeg at a constant rate, so frame n has a decode time of n / fps. Viewers use it to work out their end to end
+# latency.
+
+# sequence - increases by one each fragment, across encoder restarts
+# init_id - which init segment the fragment goes with, changes whenever the encoder is restarted
+# media_time - decode time of the fragment's first frame, in seconds
+# timestamp - capture time of the fragment's first frame
+# keyframe - whether the fragment starts with a keyframe, i.e. whether a viewer can start watching from it
+LiveFragment = namedtuple("LiveFragment", ["sequence", "init_id", "media_time", "timestamp", "keyframe", "data"])
+
+SECONDS_BETWEEN_ENCODER_STARTS = 5
+
+
+# The fragment to send a viewer after last_sequence, or None if there isn't one yet. Viewers that are just starting,
+# or have fallen so far behind that the fragments they need are gone, skip to the latest keyframe.
+def next_live_fragment(fragments, last_sequence):
+    if len(fragments) == 0:
+        return None
+
+    if last_sequence is not None and fragments[0].sequence <= last_sequence + 1 <= fragments[-1].sequence:
+        return fragments[last_sequence + 1 - fragments[0].sequence]
+
+    if last_sequence is not None and last_sequence >= fragments[-1].sequence:
+        return None
+
+    for fragment in reversed(fragments):
+        if fragment.keyframe and (last_sequence is None or fragment.sequence > last_sequence):
+            return fragment
+
+    return None
+
+
+class LiveStream:
+    def __init__(self, frame_ring):
+        self.frame_ring = frame_ring
+        self.fps = settings.CAMERA_FPS
+
+        # Called with (init_id, init_segment) and with each LiveFragment
+        self.init_listeners = []
+        self.fragment_listeners = []
+
+        self.process = None
+        self.init_id = 0
+        # (init_id, init_segment) once the current encoder has written its init segment
+        self.init = None
+        self.last_encoder_start = 0
+        self.sequence = 0
+
+        # Capture time of each frame fed to the current encoder, by frame number, for as long as it could still be
+        # waiting to come out in a fragment
+        self.frame_timestamps = {}
+        self.frame_numbers = deque()
+        self.frames_fed = 0
+
+        self.latencies = deque(maxlen=100)
+
+        # While paused the encoder is stopped, leaving its CPU time to whatever needs it more
+        self.paused = False
+
+        self._running = True
+        self.writer_thread = threading.Thread(target=self._write_frames, name="Live Stream Writer")
+        self.writer_thread.start()
+
+    def add_listener(self, init_listener, fragment_listener):
+        self.init_listeners.append(init_listener)
+        self.fragment_listeners.append(fragment_listener)
+
+    # Returns (init_id, init_segment), or None if the encoder hasn't written one yet
+    def current_init_segment(self):
+        return self.init
+
+    def set_paused(self, paused):
+        if paused != self.paused:
+            logging.info("Live stream %s", "paused" if paused else "resumed")
+        self.paused = paused
+
+    # How long fragments are taking from their first frame being captured to being handed to listeners
+    def stats(self):
+        latencies = list(self.latencies)
+        return {
+            "fragments": self.sequence,
+            "encoder_starts": self.init_id,
+            "average_latency": sum(latencies) / len(latencies) if len(latencies) > 0 else 0,
+            "max_latency": max(latencies, default=0)
+        }
+
+    def release(self):
+        logging.info("Releasing live stream...")
+        self._running = False
+        self.writer_thread.join()
+        self._stop_encoder()
+        logging.info("Live stream released")
+
+    def _start_encoder(self):
+        self.last_encoder_start = time.time()
+        self.frame_timestamps = {}
+        self.frame_numbers = deque()
+        self.frames_fed = 0
+
+        try:
+            process = ffmpeg.start_live_encoder(
+                self.frame_ring.width, self.frame_ring.height, self.fps,
+                settings.LIVE_FRAGMENT_SECONDS, settings.LIVE_KEYFRAME_SECONDS)
+        except OSError as ex:
+            logging.error("Could not start live encoder: %s", ex)
+            return
+
+        self.process = process
+        self.init = None
+        self.init_id += 1
+
+        reader = threading.Thread(
+            target=self._read_fragments, args=(process, self.init_id), name="Live Stream Reader", daemon=True)
+        reader.start()
+
+    def _stop_encoder(self):
+        if self.process is None:
+            return
+
+        process = self.process
+        self.process = None
+
+        try:
+            process.stdin.close()
+            process.wait(SECONDS_BETWEEN_ENCODER_STARTS)
+        except Exception:
+            process.kill()
+
+    def _write_frames(self):
+        start_time = time.time()
+        seconds_per_frame = 1 / self.fps
+
+        while self._running:
+            if self.paused:
+                self._stop_encoder()
+            elif self.process is None or self.process.poll() is not None:
+                if self.process is not None:
+                    logging.warning("Live encoder exited with status %s", self.process.returncode)
+                    self.process = None
+
+                if time.time() - self.last_encoder_start >= SECONDS_BETWEEN_ENCODER_STARTS:
+                    self._start_encoder()
+
+            frame = self.frame_ring.latest()
+            if frame is not None and self.process is not None:
+                self._write_frame(frame)
+
+            current_time = time.time()
+            time_since_start = current_time - start_time
+            sleep_time = seconds_per_frame - (time_since_start % seconds_per_frame)
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+
+    # The same frame is written again if the camera hasn't produced a new one, ffmpeg is expecting a constant rate
+    def _write_frame(self, frame):
+        frame_number = self.frames_fed
+        self.frames_fed += 1
+
+        self.frame_timestamps[frame_number] = frame.timestamp
+        self.frame_numbers.append(frame_number)
+        while len(self.frame_numbers) > self.fps * 10:
+            del self.frame_timestamps[self.frame_numbers.popleft()]
+
+        try:
+            self.process.stdin.write(frame.data)
+            self.process.stdin.flush()
+        except (OSError, ValueError) as ex:
+            logging.warning("Could not write to live encoder: %s", ex)
+            self._stop_encoder()
+
+    def _read_fragments(self, process, init_id):
+        init_segment = b""
+        timescale = None
+        trex_sample_flags = 0
+        moof = None
+
+        while True:
+            box = _read_box(process.stdout)
+            if box is None:
+                break
+
+            box_type = box[4:8]
+
+            if timescale is None:
+                init_segment += box
+                if box_type != b"moov":
+                    continue
+
+                timescale = mp4.timescale(init_segment)
+                trex_sample_flags = mp4.default_sample_flags(init_segment)
+                self.init = (init_id, init_segment)
+                for listener in self.init_listeners:
+                    listener(init_id, init_segment)
+            elif box_type == b"moof":
+                moof = box
+            elif box_type == b"mdat" and moof is not None:
+                self._publish_fragment(init_id, moof, box, timescale, trex_sample_flags)
+                moof = None
+
+        logging.info("Live encoder output ended")
+
+    def _publish_fragment(self, init_id, moof, mdat, timescale, trex_sample_flags):
+        media_time = mp4.fragment_decode_time(moof) / timescale
+        timestamp = self.frame_timestamps.get(round(media_time * self.fps), 0)
+
+        self.sequence += 1
+        fragment = LiveFragment(
+            self.sequence, init_id, media_time, timestamp,
+            mp4.fragment_starts_with_keyframe(moof, trex_sample_flags), moof + mdat)
+
+        if timestamp > 0:
+            self.latencies.append(time.time() - timestamp)
+
+        for listener in self.fragment_listeners:
+            listener(fragment)
+
+
+# Returns the next whole box (header included) from a stream, or None at the end of it
+def _read_box(stream):
+    header = stream.read(mp4.BOX_HEADER.size)
+    if len(header) < mp4.BOX_HEADER.size:
+        return None
+
+    (size, _) = mp4.BOX_HEADER.unpack(header)
+    if size == 1:
+        large_size = stream.read(mp4.LARGE_SIZE.size)
+        if len(large_size) < mp4.LARGE_SIZE.size:
+            return None
+        header += large_size
+        size = mp4.LARGE_SIZE.unpack(large_size)[0]
+    elif size == 0:
+        return header + stream.read()
+
+    content = stream.read(size - len(header))
+    if len(content) < size - len(header):
+        return None
+
+    return header + content
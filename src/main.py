@@ -6,7 +6,6 @@ import traceback
 import logging
 
 import settings
-import interprocess_communication as ipc
 
 
 # Ensure the current directory is the file path of the main file - helps make code simpler
@@ -31,18 +30,34 @@ def custom_except_hook(exc_type, exc_obj, tb):
 sys.excepthook = custom_except_hook
 
 
+def _ipc_module():
+    if settings.IPC_TRANSPORT == "asyncio":
+        import interprocess_communication_asyncio as ipc
+    else:
+        import interprocess_communication as ipc
+
+    return ipc
+
+
 def start_cameras(pipe):
     import camera_manager
 
     logging.info("Starting camera process...")
     logging.info("Setting up camera IPC...")
-    comm = ipc.CameraClientSide(camera_manager, settings.CONNECT_TO_IP, settings.PORT)
+    ipc = _ipc_module()
+    comms = [ipc.CameraClientSide(
+        camera_manager, settings.CONNECT_TO_IP, settings.PORT, settings.CAMERA_ID, settings.IPC_UNIX_SOCKET_PATH)]
+    # Each camera recorded on its own, and the thumbnail grid, is a camera of its own to the webserver
+    for pipeline in camera_manager.camera_pipelines():
+        comms.append(ipc.CameraClientSide(
+            pipeline, settings.CONNECT_TO_IP, settings.PORT, pipeline.camera_id, settings.IPC_UNIX_SOCKET_PATH))
     logging.info("Camera IPC set up")
     logging.info("Starting reader")
     camera_manager.start_reader(pipe)
     logging.info("Reader stopped")
     logging.info("Stopping camera IPC")
-    comm.stop()
+    for comm in comms:
+        comm.stop()
     logging.info("Camera process finished successfully")
 
 
@@ -51,7 +66,8 @@ def start_webserver(pipe):
 
     logging.info("Starting webserver process...")
     logging.info("Setting up webserver IPC...")
-    comm = ipc.WebServerSide(settings.BIND_IP, settings.PORT)
+    ipc = _ipc_module()
+    comm = ipc.WebServerSide(settings.BIND_IP, settings.PORT, settings.IPC_UNIX_SOCKET_PATH)
     logging.info("Webserver IPC set up")
     logging.info("Starting server")
     webserver.start_server(pipe, comm)
@@ -0,0 +1,90 @@
+import time
+import logging
+
+import cv2
+import numpy as np
+
+# Finds motion in each camera's part of the composed frame by comparing a small grayscale copy of it against a slowly
+# updated background - the whole frame is shrunk and compared at once, and each camera's score is the fraction of its
+# pixels that changed by more than pixel_threshold.
+
+
+class MotionDetector:
+    # regions - (camera id, x, y, width, height) of each camera in the frames, see camera.camera_regions
+    def __init__(self, regions, downscale, pixel_threshold, background_rate):
+        self.downscale = max(1, downscale)
+        self.pixel_threshold = pixel_threshold
+        self.background_rate = background_rate
+
+        self.regions = [
+            (camera_id, x // self.downscale, y // self.downscale, max(1, width // self.downscale),
+             max(1, height // self.downscale))
+            for (camera_id, x, y, width, height) in regions
+        ]
+
+        self.background = None
+        self.scores = {camera_id: 0.0 for (camera_id, _, _, _, _) in regions}
+
+    # Returns the score of each camera, by camera id
+    def update(self, frame):
+        gray = cv2.cvtColor(self._shrink(frame), cv2.COLOR_BGR2GRAY)
+
+        if self.background is None:
+            self.background = gray.astype(np.float32)
+            return self.scores
+
+        changed = cv2.absdiff(gray, cv2.convertScaleAbs(self.background)) > self.pixel_threshold
+        cv2.accumulateWeighted(gray, self.background, self.background_rate)
+
+        self.scores = {
+            camera_id: float(changed[y:y + height, x:x + width].mean())
+            for (camera_id, x, y, width, height) in self.regions
+        }
+        return self.scores
+
+    # An INTER_AREA resize straight down is slow for anything but exact multiples, so the frame is shrunk to twice the
+    # size with a linear resize (which only samples it) and then each 2x2 block is averaged - several times quicker
+    def _shrink(self, frame):
+        if self.downscale < 2:
+            return frame
+
+        width = max(1, frame.shape[1] // self.downscale)
+        height = max(1, frame.shape[0] // self.downscale)
+        cropped = frame[:height * self.downscale, :width * self.downscale]
+
+        half = cv2.resize(cropped, (width * 2, height * 2), interpolation=cv2.INTER_LINEAR)
+        return cv2.resize(half, (width, height), interpolation=cv2.INTER_AREA)
+
+
+# Starts a recording when there's motion, and stops it once there's been none for post_roll_seconds. Recordings started
+# by hand are left alone.
+class MotionTrigger:
+    def __init__(self, recorder, score_threshold, pre_roll_seconds, post_roll_seconds):
+        self.recorder = recorder
+        self.score_threshold = score_threshold
+        self.pre_roll_seconds = pre_roll_seconds
+        self.post_roll_seconds = post_roll_seconds
+
+        self.last_motion = 0
+        self.recording = False
+
+    def update(self, scores, now=None):
+        now = time.time() if now is None else now
+
+        moving = [camera_id for (camera_id, score) in scores.items() if score >= self.score_threshold]
+        if len(moving) > 0:
+            self.last_motion = now
+
+            if not self.recording and not self.recorder.is_recording():
+                logging.info("Motion on %s, starting recording", ", ".join(str(c) for c in moving))
+                self.recorder.start_recording(self.pre_roll_seconds)
+                self.recording = True
+
+        elif self.recording and now - self.last_motion >= self.post_roll_seconds:
+            logging.info("No motion for %ss, stopping recording", self.post_roll_seconds)
+            self.recorder.stop_recording()
+            self.recording = False
+
+    # Recording was started or stopped by hand - it's no longer ours to stop
+    def recording_changed_by_hand(self):
+        self.recording = False
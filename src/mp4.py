@@ -0,0 +1,237 @@
+import struct
+
+# Just enough MP4 box parsing to split a fragmented MP4 stream up and find out about each fragment. An MP4 file is a
+# sequence of boxes - a 32 bit size (including the header) and a 4 character type, followed by the box's content, which
+# for container boxes (moov, trak, moof, traf, ...) is more boxes.
+
+BOX_HEADER = struct.Struct(">I4s")
+LARGE_SIZE = struct.Struct(">Q")
+FULL_BOX_HEADER = struct.Struct(">B3s")
+
+# Set in a sample's flags when it isn't a sync sample (keyframe)
+SAMPLE_IS_NON_SYNC = 0x00010000
+
+VISUAL_SAMPLE_ENTRY_SIZE = 78
+
+
+# Yields the type, content start and end of each box in data[start:end]
+def iterate_boxes(data, start=0, end=None):
+    end = len(data) if end is None else end
+    offset = start
+
+    while offset + BOX_HEADER.size <= end:
+        (size, box_type) = BOX_HEADER.unpack_from(data, offset)
+        content_start = offset + BOX_HEADER.size
+
+        if size == 1:
+            size = LARGE_SIZE.unpack_from(data, content_start)[0]
+            content_start += LARGE_SIZE.size
+        elif size == 0:  # Runs to the end of the data
+            size = end - offset
+
+        if size < content_start - offset or offset + size > end:
+            raise ValueError(f"Invalid size for '{box_type}' box")
+
+        yield (box_type, content_start, offset + size)
+        offset += size
+
+
+# Returns the content start and end of the first box found by following path (e.g. [b"moov", b"trak", b"mdia"]) down
+# from data[start:end], or None if there isn't one
+def find_box(data, path, start=0, end=None):
+    for (box_type, content_start, content_end) in iterate_boxes(data, start, end):
+        if box_type != path[0]:
+            continue
+
+        if len(path) == 1:
+            return (content_start, content_end)
+
+        return find_box(data, path[1:], content_start, content_end)
+
+    return None
+
+
+def full_box_version_and_flags(data, start):
+    (version, flags) = FULL_BOX_HEADER.unpack_from(data, start)
+    return (version, int.from_bytes(flags, "big"), start + FULL_BOX_HEADER.size)
+
+
+# The number of media time units per second, from an init segment (moov of the first track)
+def timescale(init_segment):
+    mdhd = find_box(init_segment, [b"moov", b"trak", b"mdia", b"mdhd"])
+    if mdhd is None:
+        raise ValueError("No mdhd box in init segment")
+
+    (version, _, offset) = full_box_version_and_flags(init_segment, mdhd[0])
+    offset += 16 if version == 1 else 8  # Creation and modification times
+    return struct.unpack_from(">I", init_segment, offset)[0]
+
+
+# The flags samples have when fragments don't say otherwise, from an init segment (trex of the first track)
+def default_sample_flags(init_segment):
+    trex = find_box(init_segment, [b"moov", b"mvex", b"trex"])
+    if trex is None:
+        return 0
+
+    (_, _, offset) = full_box_version_and_flags(init_segment, trex[0])
+    # Track id, sample description index, duration and size come first
+    return struct.unpack_from(">I", init_segment, offset + 16)[0]
+
+
+# The decode time (in the init segment's timescale) of the first sample in a moof
+def fragment_decode_time(moof):
+    tfdt = find_box(moof, [b"moof", b"traf", b"tfdt"])
+    if tfdt is None:
+        raise ValueError("No tfdt box in fragment")
+
+    (version, _, offset) = full_box_version_and_flags(moof, tfdt[0])
+    return struct.unpack_from(">Q" if version == 1 else ">I", moof, offset)[0]
+
+
+# Whether the first sample in a moof is a keyframe, i.e. whether a decoder can start from this fragment
+def fragment_starts_with_keyframe(moof, trex_sample_flags=0):
+    traf = find_box(moof, [b"moof", b"traf"])
+    if traf is None:
+        raise ValueError("No traf box in fragment")
+
+    sample_flags = trex_sample_flags
+
+    tfhd = find_box(moof, [b"tfhd"], *traf)
+    if tfhd is not None:
+        (_, flags, offset) = full_box_version_and_flags(moof, tfhd[0])
+        offset += 4  # Track id
+        for (flag, size) in [(0x01, 8), (0x02, 4), (0x08, 4), (0x10, 4)]:
+            if flags & flag:
+                offset += size
+        if flags & 0x20:
+            sample_flags = struct.unpack_from(">I", moof, offset)[0]
+
+    trun = find_box(moof, [b"trun"], *traf)
+    if trun is not None:
+        (_, flags, offset) = full_box_version_and_flags(moof, trun[0])
+        offset += 4  # Sample count
+        if flags & 0x01:  # Data offset
+            offset += 4
+
+        if flags & 0x04:
+            sample_flags = struct.unpack_from(">I", moof, offset)[0]
+        elif flags & 0x400:  # Every sample has its own flags, after its duration and size
+            offset += (4 if flags & 0x100 else 0) + (4 if flags & 0x200 else 0)
+            sample_flags = struct.unpack_from(">I", moof, offset)[0]
+
+    return not sample_flags & SAMPLE_IS_NON_SYNC
+
+
+# The codecs parameter for the init segment's video track (e.g. "avc1.42C01E"), as needed by MediaSource
+def avc_codec_string(init_segment):
+    stsd = find_box(init_segment, [b"moov", b"trak", b"mdia", b"minf", b"stbl", b"stsd"])
+    if stsd is None:
+        raise ValueError("No stsd box in init segment")
+
+    (_, _, offset) = full_box_version_and_flags(init_segment, stsd[0])
+    offset += 4  # Entry count
+    # The visual sample entry's fields come before its child boxes
+    avc1 = find_box(init_segment, [b"avc1"], offset, stsd[1])
+    avcc = find_box(init_segment, [b"avcC"], avc1[0] + VISUAL_SAMPLE_ENTRY_SIZE, avc1[1]) if avc1 else None
+    if avcc is None:
+        raise ValueError("No avcC box in init segment")
+
+    (profile, compatibility, level) = init_segment[avcc[0] + 1:avcc[0] + 4]
+    return f"avc1.{profile:02X}{compatibility:02X}{level:02X}"
+
+
+# The size of the init segment (everything before the first fragment) at the start of a fragmented MP4 file
+def init_segment_size(data):
+    for (box_type, content_start, content_end) in iterate_boxes(data):
+        if box_type == b"moof":
+            return content_start - BOX_HEADER.size
+
+    raise ValueError("No moof box in file")
+
+
+# The duration in seconds of the first track of a fragmented MP4 file, from the end of its last sample to the start of
+# its first
+def fragmented_duration(data):
+    init_size = init_segment_size(data)
+    track_timescale = timescale(data[:init_size])
+
+    tkhd = find_box(data, [b"moov", b"trak", b"tkhd"], 0, init_size)
+    (version, _, offset) = full_box_version_and_flags(data, tkhd[0])
+    offset += 16 if version == 1 else 8  # Creation and modification times
+    track_id = struct.unpack_from(">I", data, offset)[0]
+
+    default_duration = 0
+    mvex = find_box(data, [b"moov", b"mvex"], 0, init_size)
+    for (box_type, content_start, _) in iterate_boxes(data, *mvex) if mvex is not None else []:
+        if box_type != b"trex":
+            continue
+
+        (_, _, offset) = full_box_version_and_flags(data, content_start)
+        (trex_track_id, _, trex_duration) = struct.unpack_from(">III", data, offset)
+        if trex_track_id == track_id:
+            default_duration = trex_duration
+
+    start = None
+    end = 0
+    for (box_type, content_start, content_end) in iterate_boxes(data, init_size):
+        if box_type != b"moof":
+            continue
+
+        for (traf_type, traf_start, traf_end) in iterate_boxes(data, content_start, content_end):
+            if traf_type != b"traf":
+                continue
+
+            traf_info = _traf_times(data, traf_start, traf_end, default_duration)
+            if traf_info is None or traf_info[0] != track_id:
+                continue
+
+            (_, decode_time, duration) = traf_info
+            start = decode_time if start is None else min(start, decode_time)
+            end = max(end, decode_time + duration)
+
+    return (end - (start or 0)) / track_timescale
+
+
+# (track id, decode time, total sample duration) of a traf, or None if it doesn't have a tfhd
+def _traf_times(data, start, end, default_duration):
+    tfhd = find_box(data, [b"tfhd"], start, end)
+    if tfhd is None:
+        return None
+
+    (_, flags, offset) = full_box_version_and_flags(data, tfhd[0])
+    track_id = struct.unpack_from(">I", data, offset)[0]
+    offset += 4
+    for (flag, size) in [(0x01, 8), (0x02, 4)]:
+        if flags & flag:
+            offset += size
+    if flags & 0x08:
+        default_duration = struct.unpack_from(">I", data, offset)[0]
+
+    decode_time = 0
+    tfdt = find_box(data, [b"tfdt"], start, end)
+    if tfdt is not None:
+        (version, _, offset) = full_box_version_and_flags(data, tfdt[0])
+        decode_time = struct.unpack_from(">Q" if version == 1 else ">I", data, offset)[0]
+
+    duration = 0
+    for (box_type, content_start, _) in iterate_boxes(data, start, end):
+        if box_type != b"trun":
+            continue
+
+        (_, flags, offset) = full_box_version_and_flags(data, content_start)
+        sample_count = struct.unpack_from(">I", data, offset)[0]
+        offset += 4
+        for flag in [0x01, 0x04]:  # Data offset, first sample flags
+            if flags & flag:
+                offset += 4
+
+        if not flags & 0x100:
+            duration += sample_count * default_duration
+            continue
+
+        # Each sample has a duration, then whichever of size, flags and composition time offset are present
+        sample_size = 4 * sum(1 for flag in [0x100, 0x200, 0x400, 0x800] if flags & flag)
+        for i in range(sample_count):
+            duration += struct.unpack_from(">I", data, offset + i * sample_size)[0]
+
+    return (track_id, decode_time, duration)
@@ -0,0 +1,36 @@
+import importlib
+import multiprocessing
+
+import settings
+
+# With settings.CAMERA_PROCESSES, cameras are captured and recordings' video is encoded in processes of their own,
+# connected to the camera process by frame rings, so a rig of several cameras can use every core rather than sharing
+# the camera process (and its GIL).
+#
+# They're started fresh ("spawn") rather than forked from the camera process, whose other threads could be holding
+# locks at the time. Being fresh they'd only see the settings file, so they're handed the camera process' settings -
+# before the function they run is imported, as some modules look at settings when they're imported.
+#
+# They share the camera process' resource tracker, so frame rings one of them creates and another attaches to are
+# attached to with shared_tracker (see FrameRing.attach).
+
+_context = multiprocessing.get_context("spawn")
+
+
+# Runs function_name from module_name in a new process, with one end of a pipe added to its arguments - returns the
+# process and the other end of the pipe
+def start(module_name, function_name, args, name):
+    (conn, child_conn) = _context.Pipe()
+
+    values = {key: value for (key, value) in vars(settings).items() if key.isupper()}
+    process = _context.Process(
+        target=_run, args=(values, module_name, function_name, (*args, child_conn)), name=name, daemon=True)
+    process.start()
+    child_conn.close()
+
+    return (process, conn)
+
+
+def _run(values, module_name, function_name, args):
+    vars(settings).update(values)
+    getattr(importlib.import_module(module_name), function_name)(*args)
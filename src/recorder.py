@@ -1,12 +1,19 @@
 import os
+import math
 import time
 import wave
 import threading
 import logging
+from collections import deque
 
 import cv2
 
 import ffmpeg
+import hls
+from combine_queue import CombineQueue
+from frame_ring import FrameRing, FrameReader
+import pipeline_process
+from segments import RECENT_SEGMENTS
 from utils import Mutex
 import settings
 
@@ -14,49 +21,114 @@ if settings.RECORD_AUDIO:
     import pyaudio
 
 
+# name_suffix - added to the name of every file recorded, when several recorders share the recordings directory
+# record_audio - whether to record the microphone too (if settings.RECORD_AUDIO) - only one recorder can have it open
 class Recorder:
-    def __init__(self, camera):
-        self.video = VideoRecorder(camera, self.video_frame_written)
-        self.audio = AudioRecorder()
+    def __init__(self, frame_ring, name_suffix="", record_audio=True):
+        self.audio = AudioRecorder(name_suffix) if record_audio and settings.RECORD_AUDIO else None
+
+        # Either one long running ffmpeg process encodes and segments everything, or video and audio are written to a
+        # pair of part files at a time, which are combined into a segment once finished
+        self.encoder = None
+        self.video = None
+        self.combine_queue = None
+        use_encoder = settings.RECORDINGS_PERSISTENT_ENCODER
+        if use_encoder and self.audio is not None and not ffmpeg.segment_encoder_supports_audio():
+            logging.warning("The segment encoder can't be sent audio on this platform, recording part files instead")
+            use_encoder = False
+
+        if use_encoder:
+            self.encoder = SegmentEncoder(
+                frame_ring, self.audio, lambda out_filename: self._segment_finished(out_filename, self.recording),
+                name_suffix)
+        else:
+            if settings.CAMERA_PROCESSES:
+                self.video = VideoRecorderProcess(frame_ring, self.video_part_finished, name_suffix)
+            else:
+                self.video = VideoRecorder(frame_ring, self.video_frame_written, name_suffix)
+            self.combine_queue = CombineQueue(
+                settings.RECORDINGS_COMBINE_WORKERS, settings.RECORDINGS_COMBINE_QUEUE_MAX,
+                settings.RECORDINGS_COMBINE_OVERLOAD, self._combine, self._combined, self._combine_dropped)
 
-        self.combining_threads = []
         self.all_combined_segments = []
-        self.recording_combined_segments = []
-
-        self.recording = False
+        # (filename, HlsSegment) of the most recent segments, for recordings that start from before they're started
+        self.recent_segments = deque(maxlen=RECENT_SEGMENTS)
+        self.segment_listeners = []
+        self.finishing_threads = []
+
+        (live_playlist_name, ext) = os.path.splitext(hls.LIVE_PLAYLIST_NAME)
+        self.live_playlist = hls.LivePlaylist(
+            os.path.join(
+                settings.RECORDINGS_DIRECTORY, settings.RECORDINGS_PARTS_SUBDIR_NAME,
+                live_playlist_name + name_suffix + ext),
+            RECENT_SEGMENTS)
+
+        # The RecordingIndex of the recording in progress, or None when not recording
+        self.recording = None
         self.frame_count = 0
 
-        self.video.start_recording()
-        self.audio.start_recording()
+        if self.encoder is not None:
+            self.encoder.start()
+        else:
+            self.video.start_recording()
+            if self.audio is not None:
+                self.audio.start_recording()
 
-    def start_recording(self):
-        self.recording = True
+    # The recording starts with the segments finished in the last pre_roll_seconds (rounded up to whole segments)
+    def start_recording(self, pre_roll_seconds=0):
+        if self.recording is not None:
+            return
 
-    def stop_recording(self):
-        self.recording = False
-        self.stitch_together_segments()
-        self.recording_combined_segments = []
+        recording = RecordingIndex()
+        if pre_roll_seconds > 0 and settings.RECORDINGS_FRAMES_PER_FILE > 0:
+            segment_count = math.ceil(pre_roll_seconds / (settings.RECORDINGS_FRAMES_PER_FILE / settings.CAMERA_FPS))
+            for (filename, hls_segment) in list(self.recent_segments)[-segment_count:]:
+                recording.add(filename, hls_segment)
 
-    def is_recording(self):
-        return self.recording
+        self.recording = recording
 
-    def stitch_together_segments(self):
-        if len(self.recording_combined_segments) == 0:
+    # Quick however long the recording - its index is already complete up to the last segment finished, and it's
+    # finished off (and stitched together into one file) in the background
+    def stop_recording(self):
+        recording = self.recording
+        self.recording = None
+        if recording is None:
             return
 
+        thread = threading.Thread(target=self._finish_recording, args=(recording,), name="Finish Recording Background")
+        self.finishing_threads.append(thread)
+        thread.start()
+
+    def is_recording(self):
+        return self.recording is not None
+
+    def _finish_recording(self, recording):
         try:
-            if len(self.combining_threads) > 0:
-                self.combining_threads[0].join()
-        except Exception as ex:
-            logging.warn("Error while waiting for single combining thread:\n%s", ex)
+            # Parts recorded before recording stopped may still be waiting to be combined
+            if self.combine_queue is not None and not self.combine_queue.wait_until_idle(STITCH_WAIT_SECONDS):
+                logging.warning("Combining hasn't caught up, finishing the recording with the segments combined so far")
+
+            recording.finish()
 
-        out_filename = main_filename_from_video_filename(self.recording_combined_segments[0])
-        if not ffmpeg.append_videos(out_filename, self.recording_combined_segments):
+            if settings.RECORDINGS_STITCH:
+                self.stitch_together_segments(recording)
+        finally:
+            self.finishing_threads.remove(threading.current_thread())
+
+    def stitch_together_segments(self, recording):
+        if len(recording.segments) == 0:
             return
 
+        out_filename = main_filename_from_video_filename(recording.segments[0])
+        if not ffmpeg.concat_videos(in_progress_filename_from_filename(out_filename), recording.filename):
+            return
+        os.replace(in_progress_filename_from_filename(out_filename), out_filename)
+
         if not settings.RECORDINGS_KEEP_PARTS:
-            for f in self.recording_combined_segments:
+            for f in recording.segments:
                 os.remove(f)
+            os.remove(recording.filename)
+            os.remove(recording.playlist_filename)
 
     def video_frame_written(self):
         if settings.RECORDINGS_FRAMES_PER_FILE < 0:
@@ -67,54 +139,292 @@ class Recorder:
         if self.frame_count >= settings.RECORDINGS_FRAMES_PER_FILE:
             self.frame_count = 0
             v_file = self.video.stop_recording()
-            a_file = self.audio.stop_recording()
             self.video.start_recording()
+            self.video_part_finished(v_file)
+
+    # Called with each finished video part, once the next one has been started
+    def video_part_finished(self, v_file):
+        a_file = None
+        if self.audio is not None:
+            a_file = self.audio.stop_recording()
             self.audio.start_recording()
 
-            self.combine_video_audio_background(v_file, a_file)
+        self.combine_queue.add(v_file, a_file, self.recording)
 
     def release(self):
         logging.info("Releasing recorder...")
-        self.video.release()
-        self.audio.release()
+        if self.encoder is not None:
+            self.encoder.release()
+        else:
+            self.video.release()
+            self.combine_queue.release()
+        if self.audio is not None:
+            self.audio.release()
+
+        for thread in list(self.finishing_threads):
+            thread.join()
         logging.info("Recorder released")
 
-    def combine_video_audio_background(self, video_filename, audio_filename):
-        def func():
+    # Called by the combine queue's workers
+    def _combine(self, job, preset):
+        out_filename = combined_filename_from_video_filename(job.video_filename)
+
+        # Written under a temporary name so a file with the segment's name is always complete and can be served (and
+        # cached) as is
+        in_progress_filename = in_progress_filename_from_filename(out_filename)
+        if not ffmpeg.combine_video_audio(job.video_filename, job.audio_filename, in_progress_filename, preset):
+            return None
+        os.replace(in_progress_filename, out_filename)
+
+        if not settings.RECORDINGS_KEEP_PARTS:
+            os.remove(job.video_filename)
+            if job.audio_filename is not None:
+                os.remove(job.audio_filename)
+
+        return out_filename
+
+    def _combined(self, job, out_filename):
+        self._segment_finished(out_filename, job.recording)
+
+    def _combine_dropped(self, job):
+        if not settings.RECORDINGS_KEEP_PARTS:
+            os.remove(job.video_filename)
+            if job.audio_filename is not None:
+                os.remove(job.audio_filename)
+
+    # How the frames captured have been written - frames_written, duplicated and dropped (see CaptureClock)
+    def frame_stats(self):
+        return self.encoder.stats() if self.encoder is not None else self.video.stats()
+
+    def _segment_finished(self, out_filename, recording):
+        self.all_combined_segments.append(out_filename)
+
+        try:
+            hls_segment = hls.segment_info(out_filename, os.path.basename(out_filename))
+        except (OSError, ValueError) as ex:
+            logging.error("Could not read segment %s for playlists: %s", out_filename, ex)
+            hls_segment = None
+
+        if hls_segment is not None:
+            self.live_playlist.add(hls_segment)
+        self.recent_segments.append((out_filename, hls_segment))
+
+        if recording is not None:
+            recording.add(out_filename, hls_segment)
+
+        for listener in self.segment_listeners:
+            listener(out_filename)
+
+
+SECONDS_BETWEEN_ENCODER_STARTS = 5
+STITCH_WAIT_SECONDS = 60
+
+# How many times each frame interval the frame ring is checked for new frames
+FRAME_POLLS_PER_FRAME = 4
+
+
+# Raw frames are timestamped as ffmpeg receives them (see ffmpeg.WALLCLOCK_TIMESTAMPS), so each captured frame is
+# written once, a frame interval after it was captured - frames are then as far apart in the video as they were when
+# captured, and the video has the camera's (variable) frame rate. A frame the writer has fallen further behind on is
+# written straight away. Captures no newer than the last one written are counted as duplicated, and ones overwritten in
+# the frame ring while waiting as dropped - neither is written.
+class CaptureClock:
+    def __init__(self, frame_ring, fps):
+        self.frame_ring = frame_ring
+        self.delay = 1 / fps
+        self.last_timestamp = None
+
+        self.duplicated = 0
+        self.dropped = 0
+
+    # Waits until frame is due to be written, returns False if it isn't to be written at all
+    def wait_until_due(self, frame):
+        if self.last_timestamp is not None and frame.timestamp <= self.last_timestamp:
+            self.duplicated += 1
+            return False
+
+        wait = frame.timestamp + self.delay - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        if not self.frame_ring.is_current(frame):
+            self.dropped += 1
+            return False
+
+        self.last_timestamp = frame.timestamp
+        return True
+
+
+# Feeds each frame captured into the frame ring, and audio, into one long running ffmpeg process that encodes them
+# straight to H.264/AAC segments, rather than writing mp4v and wav parts that then each need a new ffmpeg process to
+# combine and re-encode them. Each frame is written once, paced by when it was captured (see CaptureClock). ffmpeg
+# writes each segment under its in progress name, and says when it has finished one - it's then renamed and handed to
+# segment_finished_callback.
+class SegmentEncoder:
+    def __init__(self, frame_ring, audio, segment_finished_callback, name_suffix=""):
+        self.frame_ring = frame_ring
+        self.audio = audio
+        self.segment_finished_callback = segment_finished_callback
+        self.name_suffix = name_suffix
+        self.fps = settings.CAMERA_FPS
+
+        self.process = None
+        self.reader_thread = None
+        self.last_encoder_start = 0
+
+        self.frame_reader = FrameReader(frame_ring)
+        self.clock = CaptureClock(frame_ring, self.fps)
+        self.frames_written = 0
+
+        self._running = True
+        self.writer_thread = threading.Thread(target=self._write_frames, name="Segment Encoder Writer")
+
+    def start(self):
+        self.writer_thread.start()
+
+    def release(self):
+        logging.info("Releasing segment encoder...")
+        self._running = False
+        if self.writer_thread.is_alive():
+            self.writer_thread.join()
+        self._stop_encoder()
+        logging.info("Segment encoder released")
+
+    def stats(self):
+        return {
+            "frames_written": self.frames_written,
+            "duplicated": self.clock.duplicated,
+            "dropped": self.frame_reader.dropped + self.clock.dropped
+        }
+
+    def _segment_seconds(self):
+        if settings.RECORDINGS_FRAMES_PER_FILE < 0:
+            return 24 * 60 * 60
+
+        return settings.RECORDINGS_FRAMES_PER_FILE / self.fps
+
+    def _start_encoder(self):
+        self.last_encoder_start = time.time()
+
+        directory = os.path.join(settings.RECORDINGS_DIRECTORY, settings.RECORDINGS_PARTS_SUBDIR_NAME)
+        out_pattern = os.path.join(
+            directory.replace("%", "%%"),
+            settings.RECORDINGS_FILENAME_FORMAT + self.name_suffix + IN_PROGRESS_SUFFIX +
+            settings.RECORDINGS_FILENAME_VIDEO_EXTENSION)
+
+        (audio_read, audio_write) = os.pipe() if self.audio is not None else (None, None)
+        try:
+            process = ffmpeg.start_segment_encoder(
+                self.frame_ring.width, self.frame_ring.height, self.fps, self._segment_seconds(), out_pattern,
+                audio_read, RATE, CHANNELS, settings.RECORDINGS_ENCODER_PIXEL_FORMAT, variable_frame_rate=True)
+        except OSError as ex:
+            logging.error("Could not start segment encoder: %s", ex)
+            if audio_write is not None:
+                os.close(audio_write)
+            return
+        finally:
+            if audio_read is not None:
+                os.close(audio_read)
+
+        self.process = process
+        if self.audio is not None:
+            self.audio.stream_to(RawAudioWriter(audio_write))
+
+        self.reader_thread = threading.Thread(
+            target=self._read_segments, args=(process, directory), name="Segment Encoder Reader")
+        self.reader_thread.start()
+
+    def _stop_encoder(self):
+        if self.process is None:
+            return
+
+        process = self.process
+        self.process = None
+
+        # Closing both inputs has ffmpeg finish the segment it's on
+        if self.audio is not None:
+            self.audio.stop_recording()
+        try:
+            process.stdin.close()
+            process.wait(SECONDS_BETWEEN_ENCODER_STARTS)
+        except Exception:
+            process.kill()
+
+        self.reader_thread.join()
+
+    def _write_frames(self):
+        while self._running:
+            if self.process is None or self.process.poll() is not None:
+                if self.process is not None:
+                    logging.warning("Segment encoder exited with status %s", self.process.returncode)
+                    self._stop_encoder()
+
+                if time.time() - self.last_encoder_start >= SECONDS_BETWEEN_ENCODER_STARTS:
+                    self._start_encoder()
+
+            for frame in self.frame_reader.next_frames():
+                if self.process is not None:
+                    self._write_frame(frame)
+
+            time.sleep(1 / self.fps / FRAME_POLLS_PER_FRAME)
+
+    def _write_frame(self, frame):
+        if not self.clock.wait_until_due(frame):
+            return
+
+        try:
+            self.process.stdin.write(encoder_frame(frame.data, settings.RECORDINGS_ENCODER_PIXEL_FORMAT))
+            self.process.stdin.flush()
+            self.frames_written += 1
+        except (OSError, ValueError) as ex:
+            logging.warning("Could not write to segment encoder: %s", ex)
+            self._stop_encoder()
+
+    def _read_segments(self, process, directory):
+        for line in process.stdout:
+            name = os.fsdecode(line.strip())
+            in_progress_filename = os.path.join(directory, name)
+            out_filename = os.path.join(directory, name.replace(IN_PROGRESS_SUFFIX, ""))
+
             try:
-                out_filename = combined_filename_from_video_filename(video_filename)
-                if not ffmpeg.combine_video_audio(video_filename, audio_filename, out_filename):
-                    return
+                os.replace(in_progress_filename, out_filename)
+            except OSError as ex:
+                logging.error("Could not rename finished segment %s: %s", in_progress_filename, ex)
+                continue
 
-                self.all_combined_segments.append(out_filename)
-                if self.recording:
-                    self.recording_combined_segments.append(out_filename)
+            self.segment_finished_callback(out_filename)
 
-                if not settings.RECORDINGS_KEEP_PARTS:
-                    os.remove(video_filename)
-                    os.remove(audio_filename)
-            finally:
-                self.combining_threads.remove(thread)
+        logging.info("Segment encoder output ended")
 
-        thread = threading.Thread(target=func, name="Combine AV Background")
-        self.combining_threads.append(thread)
 
-        thread.start()
+# A captured (BGR) frame in the pixel format the segment encoder is expecting - converting to I420 here halves what
+# goes down the pipe, and is the conversion ffmpeg would otherwise do before encoding
+def encoder_frame(frame, pixel_format):
+    if pixel_format == "yuv420p":
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
+
+    return frame
 
 
-VIDEO_FORMAT = "mp4v"
 VIDEO_SUFFIX = "-video"
+IN_PROGRESS_SUFFIX = "-in-progress"
 
 
+# Writes the frames captured into MPEG-4 part files, each encoded by an ffmpeg process of its own, one at a time
 class VideoRecorder:
-    def __init__(self, camera, frame_written_callback=None):
+    def __init__(self, frame_ring, frame_written_callback=None, name_suffix=""):
         self.out_file = Mutex(None)
         self.filename = ""
-        self.size = (camera.width, camera.height)
-        self.camera = camera
+        self.name_suffix = name_suffix
+        self.size = (frame_ring.width, frame_ring.height)
+        self.frame_ring = frame_ring
 
         self.frame_written_callback = frame_written_callback
 
+        self.frame_reader = FrameReader(frame_ring)
+        self.clock = CaptureClock(frame_ring, self._determine_fps())
+        self.frames_written = 0
+
         self._background_reader_running = True
         self.background_thread = threading.Thread(target=self._write_in_background, name="Video Background Writer")
 
@@ -128,10 +438,12 @@ class VideoRecorder:
 
         self._stop_recording(lock)
 
-        fourcc = cv2.VideoWriter_fourcc(*VIDEO_FORMAT)
-        fps = self._determine_fps()
-        self.filename = parts_filename(VIDEO_SUFFIX, settings.RECORDINGS_FILENAME_VIDEO_EXTENSION)
-        lock.value = cv2.VideoWriter(self.filename, fourcc, fps, self.size)
+        self.filename = parts_filename(self.name_suffix + VIDEO_SUFFIX, settings.RECORDINGS_FILENAME_VIDEO_EXTENSION)
+        try:
+            lock.value = ffmpeg.start_part_encoder(self.size[0], self.size[1], self.filename)
+        except OSError as ex:
+            logging.error("Could not start part encoder: %s", ex)
+            self.filename = ""
 
     def stop_recording(self):
         with self.out_file.acquire() as lock:
@@ -143,9 +455,16 @@ class VideoRecorder:
         if lock.value is not None:
             filename = self.filename
             self.filename = ""
-            lock.value.release()
+            process = lock.value
             lock.value = None
 
+            # Closing its input has ffmpeg finish the file
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+            process.wait()
+
         return filename
 
     def write_frame(self, frame):
@@ -153,7 +472,11 @@ class VideoRecorder:
             if lock.value is None:
                 return
 
-            lock.value.write(frame)
+            try:
+                lock.value.stdin.write(frame)
+                lock.value.stdin.flush()
+            except (OSError, ValueError) as ex:
+                logging.warning("Could not write to part encoder: %s", ex)
 
     def release(self):
         logging.info("Releasing video recorder...")
@@ -162,25 +485,121 @@ class VideoRecorder:
         self.background_thread.join()
         logging.info("Video recorder released")
 
+    def stats(self):
+        return {
+            "frames_written": self.frames_written,
+            "duplicated": self.clock.duplicated,
+            "dropped": self.frame_reader.dropped + self.clock.dropped
+        }
+
     def _determine_fps(self):
         return settings.CAMERA_FPS
 
     def _write_in_background(self):
-        start_time = time.time()
-        seconds_per_frame = 1 / settings.CAMERA_FPS
+        seconds_per_frame = 1 / self._determine_fps()
 
         while self._background_reader_running:
-            frame = self.camera.current_frame
-            if frame is not None:
-                self.write_frame(frame)
-                if self.frame_written_callback is not None:
-                    self.frame_written_callback()
+            for frame in self.frame_reader.next_frames():
+                self._write_captured_frame(frame)
+
+            time.sleep(seconds_per_frame / FRAME_POLLS_PER_FRAME)
+
+    def _write_captured_frame(self, frame):
+        if not self.clock.wait_until_due(frame):
+            return
+
+        self.write_frame(frame.data)
+        self.frames_written += 1
+        if self.frame_written_callback is not None:
+            self.frame_written_callback()
+
+
+# Like VideoRecorder, but the video is encoded by a process of its own (see pipeline_process), reading frames from the
+# same frame ring. It starts a new part every settings.RECORDINGS_FRAMES_PER_FILE frames, and part_finished_callback is
+# called with the name of each part it finishes.
+class VideoRecorderProcess:
+    def __init__(self, frame_ring, part_finished_callback, name_suffix=""):
+        self.frame_ring_name = frame_ring.name
+        self.part_finished_callback = part_finished_callback
+        self.name_suffix = name_suffix
+
+        self.process = None
+        self.conn = None
+        self.reader_thread = None
+        self.last_stats = {"frames_written": 0, "duplicated": 0, "dropped": 0}
+
+    def start_recording(self):
+        if self.process is not None:
+            return
+
+        (self.process, self.conn) = pipeline_process.start(
+            __name__, "record_video_in_process", (self.frame_ring_name, self.name_suffix), "Video Recorder")
+        self.reader_thread = threading.Thread(target=self._read_messages, name="Video Recorder Process Reader")
+        self.reader_thread.start()
+
+    def release(self):
+        logging.info("Releasing video recorder process...")
+        if self.process is not None:
+            self.conn.send("terminate")
+            self.reader_thread.join()
+            self.process.join()
+            self.conn.close()
+            self.process = None
+        logging.info("Video recorder process released")
+
+    # As of the last time the process sent them - about once a second
+    def stats(self):
+        return dict(self.last_stats)
+
+    def _read_messages(self):
+        while True:
+            try:
+                (kind, value) = self.conn.recv()
+            except (EOFError, OSError):
+                logging.warning("Video recorder process ended unexpectedly")
+                return
+
+            if kind == "part":
+                self.part_finished_callback(value)
+            elif kind == "stats":
+                self.last_stats = value
+            elif kind == "stopped":
+                self.last_stats = value
+                return
+
+
+# Run by VideoRecorderProcess' process, until told to stop
+def record_video_in_process(frame_ring_name, name_suffix, conn):
+    ring = FrameRing.attach(frame_ring_name, shared_tracker=True)
+    # Parts are sent from the writer thread, stats from this one
+    send_lock = threading.Lock()
+    frame_count = 0
+
+    def send(kind, value):
+        with send_lock:
+            conn.send((kind, value))
 
-            current_time = time.time()
-            time_since_start = current_time - start_time
-            sleep_time = seconds_per_frame - (time_since_start % seconds_per_frame)
-            if sleep_time > 0:
-                time.sleep(sleep_time)
+    def frame_written():
+        nonlocal frame_count
+        if settings.RECORDINGS_FRAMES_PER_FILE < 0:
+            return
+
+        frame_count += 1
+        if frame_count >= settings.RECORDINGS_FRAMES_PER_FILE:
+            frame_count = 0
+            filename = video.stop_recording()
+            video.start_recording()
+            send("part", filename)
+
+    video = VideoRecorder(ring, frame_written, name_suffix)
+    video.start_recording()
+
+    while not conn.poll(1):
+        send("stats", video.stats())
+
+    video.release()
+    send("stopped", video.stats())
+    ring.release()
 
 
 WIDTH = 2
@@ -191,7 +610,8 @@ AUDIO_SUFFIX = "-audio"
 
 
 class AudioRecorder:
-    def __init__(self):
+    def __init__(self, name_suffix=""):
+        self.name_suffix = name_suffix
         self.pyaudio = pyaudio.PyAudio()
         self.outfile = Mutex(None)
 
@@ -206,7 +626,8 @@ class AudioRecorder:
         self.stream.start_stream()
 
     def start_recording(self):
-        f = wave.open(parts_filename(AUDIO_SUFFIX, settings.RECORDINGS_FILENAME_AUDIO_EXTENSION), "wb")
+        filename = parts_filename(self.name_suffix + AUDIO_SUFFIX, settings.RECORDINGS_FILENAME_AUDIO_EXTENSION)
+        f = wave.open(filename, "wb")
         f.setnchannels(CHANNELS)
         f.setsampwidth(self.pyaudio.get_sample_size(AUDIO_FORMAT))
         f.setframerate(RATE)
@@ -214,12 +635,19 @@ class AudioRecorder:
         with self.outfile.acquire() as lock:
             lock.value = f
 
+    # Sends the audio to writer (e.g. a RawAudioWriter) from now on, rather than to a file
+    def stream_to(self, writer):
+        with self.outfile.acquire() as lock:
+            if lock.value is not None:
+                lock.value.close()
+            lock.value = writer
+
     def stop_recording(self):
         with self.outfile.acquire() as lock:
             if lock.value is None:
                 return ""
 
-            filename = lock.value._file.name
+            filename = lock.value._file.name if isinstance(lock.value, wave.Wave_write) else ""
             lock.value.close()
             lock.value = None
 
@@ -245,6 +673,78 @@ class AudioRecorder:
         return (None, pyaudio.paContinue)
 
 
+# Writes raw PCM audio to a pipe, given as a file descriptor. Audio is dropped once whatever is reading it has gone.
+class RawAudioWriter:
+    def __init__(self, fd):
+        self.file = os.fdopen(fd, "wb", 0)
+        self.broken = False
+
+    def writeframes(self, data):
+        if self.broken:
+            return
+
+        try:
+            self.file.write(data)
+        except (BrokenPipeError, ValueError):
+            self.broken = True
+
+    def close(self):
+        try:
+            self.file.close()
+        except BrokenPipeError:
+            pass
+
+
+# A recording's segments, listed in an ffconcat file and an HLS playlist (in the recordings directory, named like the
+# recording) that are added to as each one is finished - so a recording can be watched (e.g. "ffplay -safe 0 <index>",
+# or any HLS player) or copied into one file as soon as it's stopped, and stopping it doesn't have to wait on anything
+class RecordingIndex:
+    def __init__(self):
+        self.segments = []
+        self.hls_segments = []
+        self.filename = None
+        self.playlist_filename = None
+        self.ended = False
+        self.lock = threading.Lock()
+
+    # hls_segment is None if the segment couldn't be read, it's then left out of the playlist
+    def add(self, segment_filename, hls_segment=None):
+        with self.lock:
+            if self.filename is None:
+                (path, _) = os.path.splitext(main_filename_from_video_filename(segment_filename))
+                self.filename = path + INDEX_EXTENSION
+                self.playlist_filename = path + hls.PLAYLIST_EXTENSION
+                with open(self.filename, "w") as f:
+                    f.write("ffconcat version 1.0\n")
+
+            self.segments.append(segment_filename)
+
+            relative_filename = os.path.relpath(segment_filename, os.path.dirname(self.filename))
+            with open(self.filename, "a") as f:
+                f.write(f"file '{_escape_ffconcat(relative_filename)}'\n")
+
+            if hls_segment is not None:
+                self.hls_segments.append(hls_segment._replace(uri=relative_filename.replace(os.sep, "/")))
+                self._write_playlist()
+
+    # No more segments will be added
+    def finish(self):
+        with self.lock:
+            self.ended = True
+            if self.playlist_filename is not None:
+                self._write_playlist()
+
+    def _write_playlist(self):
+        hls.write_playlist(self.playlist_filename, hls.media_playlist(self.hls_segments, 0, self.ended, "EVENT"))
+
+
+INDEX_EXTENSION = ".ffconcat"
+
+
+def _escape_ffconcat(filename):
+    return filename.replace("\\", "/").replace("'", "'\\''")
+
+
 def parts_filename(suffix, extension):
     return os.path.join(
         settings.RECORDINGS_DIRECTORY,
@@ -263,6 +763,11 @@ def combined_filename_from_video_filename(filename):
     )
 
 
+def in_progress_filename_from_filename(filename):
+    (path, ext) = os.path.splitext(filename)
+    return path + IN_PROGRESS_SUFFIX + ext
+
+
 def main_filename_from_video_filename(filename):
     (path, ext) = os.path.splitext(filename)
     filename = os.path.split(path)[1].replace(VIDEO_SUFFIX, "")
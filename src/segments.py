@@ -0,0 +1,126 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import settings
+
+# How many of the most recent segments a viewer can be working its way through
+RECENT_SEGMENTS = 10
+
+
+# When each camera is recorded on its own (see settings.RECORDINGS_PER_CAMERA), its files are named by when they
+# started followed by "-<camera name>", e.g. 2024-01-02-03-04-05-cam1.mp4 - as are the thumbnail grid's (see
+# settings.THUMBNAIL_GRID_DOWNSCALE), with THUMBNAIL_NAME
+THUMBNAIL_NAME = "thumb"
+CAMERA_NAME_SUFFIX = re.compile(rf"-(cam\d+|{THUMBNAIL_NAME})$")
+
+
+def camera_name(camera_id):
+    return f"cam{camera_id}"
+
+
+# Whether filename is the name (not a path) of a segment or recording file with the given extension
+def is_timestamped_name(filename, extension):
+    (name, ext) = os.path.splitext(filename)
+    if os.path.basename(filename) != filename or ext != extension:
+        return False
+
+    try:
+        time.strptime(CAMERA_NAME_SUFFIX.sub("", name), settings.RECORDINGS_FILENAME_FORMAT)
+        return True
+    except ValueError:
+        return False
+
+
+# The name of the segment to serve after last_received, or an empty string if there's nothing new
+def next_segment_name(recent_segments, last_received):
+    if len(recent_segments) == 0:
+        logging.debug("No segments exist, returning empty segment name")
+        return ""
+
+    recent_segments = recent_segments[-RECENT_SEGMENTS:]
+
+    if last_received == recent_segments[-1]:
+        logging.debug("Last received segment is most recent segment, returning empty segment name")
+        return ""
+
+    if last_received in recent_segments:
+        index_to_serve = recent_segments.index(last_received) + 1
+    else:
+        index_to_serve = max(len(recent_segments) - 2, 0)
+        logging.debug("last_segment cannot be found '%s' - serving %s", last_received, recent_segments[index_to_serve])
+
+    return recent_segments[index_to_serve]
+
+
+# Keeps the most recently used segments in memory, up to max_bytes in total, so however many viewers are watching
+# each segment is only fetched from the camera process once. Viewers asking for a segment that is already being
+# fetched wait for that fetch rather than starting their own.
+class SegmentCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.segments = OrderedDict()
+        self.fetching = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    # fetch is called to get the segment if it isn't cached, an empty result (unknown segment) is not cached
+    def get(self, key, fetch):
+        with self.lock:
+            if key in self.segments:
+                self.segments.move_to_end(key)
+                self.hits += 1
+                return self.segments[key]
+
+            future = self.fetching.get(key)
+            is_fetcher = future is None
+            if is_fetcher:
+                future = Future()
+                self.fetching[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not is_fetcher:
+            return future.result()
+
+        try:
+            data = fetch()
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(data)
+            self._add(key, data)
+        finally:
+            with self.lock:
+                del self.fetching[key]
+
+        return data
+
+    def stats(self):
+        with self.lock:
+            return {
+                "segments": len(self.segments), "bytes": self.size, "hits": self.hits, "misses": self.misses,
+                "coalesced": self.coalesced
+            }
+
+    def _add(self, key, data):
+        if len(data) == 0 or len(data) > self.max_bytes:
+            return
+
+        with self.lock:
+            self.segments[key] = data
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                (_, evicted) = self.segments.popitem(last=False)
+                self.size -= len(evicted)
@@ -1,8 +1,11 @@
 import os
+import socket
+import tempfile
 
 CAMERA_WIDTH = 640
 CAMERA_HEIGHT = 480
 CAMERA_FPS = 10
+CAMERA_STATS_LOG_SECONDS = 60
 
 RECORD_AUDIO = True
 
@@ -13,6 +16,62 @@ RECORDINGS_FILENAME_VIDEO_EXTENSION = ".mp4"
 RECORDINGS_FILENAME_AUDIO_EXTENSION = ".wav"
 RECORDINGS_FRAMES_PER_FILE = 2 * CAMERA_FPS
 RECORDINGS_KEEP_PARTS = True
+# Each recording is listed in an ffconcat index as it goes - also copy it into one video file (in the background) once
+# it's stopped. Without this the parts are kept, as the index refers to them.
+RECORDINGS_STITCH = True
+# Encode segments with one long running ffmpeg process (fed raw frames and audio) rather than writing video and audio
+# part files and starting an ffmpeg process to combine each pair - needs an ffmpeg with libx264. Audio is sent to it
+# down an inherited pipe, which only POSIX systems (not Windows) can do - elsewhere, recordings with audio use parts.
+RECORDINGS_PERSISTENT_ENCODER = False
+# The pixel format frames are sent to the persistent encoder in - "yuv420p" (converted as they're sent, half the size)
+# or "bgr24" (as captured, left to ffmpeg to convert). The camera width and height must be even for "yuv420p".
+RECORDINGS_ENCODER_PIXEL_FORMAT = "yuv420p"
+# Record (and serve) each camera on its own, as a camera of its own named "<CAMERA_ID>-cam<n>", rather than the grid
+# of every camera - smaller recordings that can be encoded in parallel, and each at the rate its camera gives frames.
+# The grid is still put together for the live overview (the live stream and /frame.jpg), but isn't recorded. Only the
+# first camera's recordings have audio.
+RECORDINGS_PER_CAMERA = False
+# Also record (and serve) a copy of the grid this many times smaller each way, as a camera of its own named
+# "<CAMERA_ID>-thumb" - for viewers on small screens or slow connections, the page picks it for them. It's only for
+# watching, recordings aren't made of it. 0 for none; 2, 4 or 8 are quickest to shrink to.
+THUMBNAIL_GRID_DOWNSCALE = 0
+# How many part pairs are combined into segments at once, and how many can be waiting before the oldest is dropped
+RECORDINGS_COMBINE_WORKERS = 2
+RECORDINGS_COMBINE_QUEUE_MAX = 10
+# What else to do when combining falls behind (half the queue is waiting) - "drop" (nothing else), "faster" (combine
+# with a faster, lower quality encoder preset) or "pause_live" (pause the live stream until combining catches up)
+RECORDINGS_COMBINE_OVERLOAD = "drop"
+
+# Start recording when something moves in front of a camera, and stop once nothing has for MOTION_POST_ROLL_SECONDS.
+# Frames are shrunk by MOTION_DOWNSCALE and compared against a background that follows the picture at
+# MOTION_BACKGROUND_RATE - a camera's motion score is the fraction of its pixels that differ by more than
+# MOTION_PIXEL_THRESHOLD (out of 255), and it has motion at MOTION_SCORE_THRESHOLD or more.
+MOTION_DETECTION = False
+MOTION_DOWNSCALE = 8
+MOTION_PIXEL_THRESHOLD = 25
+MOTION_BACKGROUND_RATE = 0.05
+MOTION_SCORE_THRESHOLD = 0.01
+# Recordings start with the segments from this long before the motion (rounded up to whole segments)
+MOTION_PRE_ROLL_SECONDS = 4
+MOTION_POST_ROLL_SECONDS = 10
+
+# Watch a low latency live stream (a fragment every LIVE_FRAGMENT_SECONDS from one long running ffmpeg process) rather
+# than the recorded segments - video only, and needs an ffmpeg with libx264
+LIVE_STREAM = False
+LIVE_FRAGMENT_SECONDS = 0.2
+# Viewers can only start watching from a keyframe
+LIVE_KEYFRAME_SECONDS = 1
+# How many fragments the webserver keeps for viewers that are catching up
+LIVE_FRAGMENTS_KEPT = 50
+
+# Shared memory ring the camera process publishes captured frames into for the recorder and webserver to read
+FRAME_RING_NAME = "camera-streamer-frames"
+FRAME_RING_SLOTS = 8
+
+# Capture each camera, and encode recordings' video (when it isn't RECORDINGS_PERSISTENT_ENCODER's ffmpeg doing so), in
+# processes of their own - connected to the camera process, which puts the frames together, by frame rings in shared
+# memory. Lets a rig of several cameras use every core, rather than sharing one Python process.
+CAMERA_PROCESSES = False
 
 USE_MOCK_CAMERAS = False
 MOCK_CAMERA_COUNT = 4
@@ -21,11 +80,32 @@ RUN_CAMERAS = True
 RUN_WEBSERVER = True
 
 WEBSERVER_PORT = 8080
+# Number of connections the webserver handles at once (0 to handle requests one at a time, like plain wsgiref) - a
+# viewer's kept alive connection holds on to a worker until it's idle for WEBSERVER_KEEP_ALIVE_SECONDS
+WEBSERVER_WORKERS = 32
+# How long an idle browser connection is kept open for its next request
+WEBSERVER_KEEP_ALIVE_SECONDS = 5
+# Serve segments straight from the recordings directory when the camera process is on the same machine, rather than
+# fetching them over IPC
+SERVE_SEGMENTS_FROM_DISK = True
+# Memory the webserver can use to keep segments fetched over IPC, so each is only fetched once however many viewers
+SEGMENT_CACHE_BYTES = 64 * 1024 * 1024
+# How long a viewer waiting for the next segment (or live fragment) is held before being told there isn't one (it then
+# asks again) - each waiting viewer holds one of the WEBSERVER_WORKERS
+LONG_POLL_SECONDS = 20
 
 # -- Interprocess communication data -- #
+# "legacy" for the select loop based transport, "asyncio" for the asyncio based one - both speak the same protocol
+IPC_TRANSPORT = "legacy"
 # The IP for the socket in the camera process to connect to
 CONNECT_TO_IP = "localhost"
 # The IP for the server socket to listen on
 BIND_IP = "0.0.0.0"
 # The port for the server socket to listen on and the camera socket to connect to
 PORT = 26349
+# When the camera process runs on the same machine as the webserver, it connects over this unix domain socket instead
+# of TCP (where the platform supports them) - set to None to always use TCP
+IPC_UNIX_SOCKET_PATH = os.path.join(tempfile.gettempdir(), f"camera-streamer-{PORT}.sock")
+# How this camera process identifies itself to the webserver - must be unique when several camera hosts connect to one
+# webserver
+CAMERA_ID = socket.gethostname()
@@ -2,6 +2,25 @@
 
 /** @type number */
 var segmentLengthSeconds = window["segmentLengthSeconds"];
+/** @type boolean */
+var liveStream = window["liveStream"];
+/** @type string */
+var livePlaylist = window["livePlaylist"];
+/** @type {{camera_id: string, width: number, height: number, bandwidth: number, audio: boolean}[]} */
+var renditions = window["renditions"];
+
+// Live playback is kept at most this far behind the newest fragment received
+const maxLiveBufferSeconds = 1;
+// How much already played live video is kept around
+const keptLiveSeconds = 30;
+
+// Keeps requests going to the camera picked on the page (?camera=<id>)
+const cameraQuery = window.location.search;
+
+// Only renditions whose bandwidth is this much less than what's available are picked
+const bandwidthHeadroom = 1.5;
+// A rendition whose segments take longer than this fraction of their length to download is given up on
+const maxDownloadFraction = 0.5;
 
 window.addEventListener("load", () => {
     const toggleRecording = document.getElementById("toggleRecording");
@@ -13,7 +32,7 @@ window.addEventListener("load", () => {
         const isStarting = toggleRecording.innerHTML.toUpperCase().indexOf("START") >= 0;
 
         toggleRecording.disabled = true;
-        const result = await fetch("recording/" + (isStarting ? "start" : "stop"));
+        const result = await fetch("recording/" + (isStarting ? "start" : "stop") + cameraQuery);
         toggleRecording.disabled = false;
 
         if (!result.ok) {
@@ -28,54 +47,282 @@ window.addEventListener("load", () => {
         throw new Error("#camera is not a video!");
     }
 
+    if (liveStream) {
+        playLive(video, pickRendition(initialBandwidth()));
+        return;
+    }
+
+    // Browsers that can play HLS themselves can just be given the playlist of every rendition, and pick for themselves
+    if (video.canPlayType("application/vnd.apple.mpegurl")) {
+        video.src = livePlaylist;
+        return;
+    }
+
+    playSegments(video);
+});
+
+/**
+ * Plays the recorded segments, starting over with a smaller rendition if downloading them can't keep up
+ * @param {HTMLVideoElement} video
+ */
+async function playSegments(video) {
+    let rendition = pickRendition(initialBandwidth());
+
+    while (true) {
+        rendition = await playRenditionSegments(video, rendition);
+    }
+}
+
+/**
+ * Returns the smaller rendition to switch to when a segment takes too long to download
+ * @param {HTMLVideoElement} video
+ * @param {{camera_id: string, width: number, audio: boolean} | undefined} rendition
+ */
+async function playRenditionSegments(video, rendition) {
+    const query = renditionQuery(rendition);
+
+    const ms = new MediaSource();
+    video.src = URL.createObjectURL(ms);
+    await new Promise(res => ms.addEventListener("sourceopen", res, { once: true }));
+
+    const codecs = rendition && !rendition.audio ? "avc1.640016" : "avc1.640016, mp4a.40.2";
+    const sb = ms.addSourceBuffer(`video/mp4; codecs="${codecs}"`);
+    sb.addEventListener("updateend", () => sb.timestampOffset += segmentLengthSeconds);
+
+    let lastReceivedSegment = "";
+
+    // Returns whether there was a segment, or the bandwidth measured if it took too long to download
+    async function appendSegment() {
+        /** @type Record<string, string> */
+        const headers = {};
+        if (lastReceivedSegment) {
+            headers["X-last-received-segment"] = lastReceivedSegment;
+        }
+
+        // Held open by the server until there's a new segment, so there's no need to wait between requests
+        const res = await fetch("segment/next" + query, {
+            headers: headers,
+        });
+        if (!res.ok) {
+            throw new Error("Error fetching segment: " + res.status);
+        }
+
+        const segName = res.headers.get("X-segment-name");
+        if (lastReceivedSegment === segName) {
+            return false;
+        }
+
+        // The response starts as soon as the segment is ready, from then on it's just the download
+        const downloadStart = performance.now();
+        const buf = await res.arrayBuffer();
+        const downloadSeconds = (performance.now() - downloadStart) / 1000;
+        if (buf.byteLength === 0) {
+            return false;
+        }
+
+        lastReceivedSegment = segName;
+
+        sb.appendBuffer(buf);
+
+        if (downloadSeconds > segmentLengthSeconds * maxDownloadFraction) {
+            return buf.byteLength * 8 / downloadSeconds;
+        }
+        return true;
+    }
+
+    while (true) {
+        try {
+            const result = await appendSegment();
+            if (typeof result === "number") {
+                const smaller = pickRendition(result);
+                if (smaller && rendition && smaller.width < rendition.width) {
+                    return smaller;
+                }
+            }
+
+            // Only empty after a long poll times out, or if the server can't hold requests open - in which case
+            // fall back to polling
+            if (!result) {
+                await delay(segmentLengthSeconds * 250);
+            }
+        } catch (e) {
+            // Don't hammer the server while it (or the camera) is unavailable
+            console.error(e);
+            await delay(segmentLengthSeconds * 1000);
+        }
+    }
+}
+
+/**
+ * The smallest rendition at least as wide as the screen can show, or the biggest there is - out of those that need
+ * less than the bandwidth available (or the smallest, if none do)
+ * @param {number} bandwidth bits per second
+ */
+function pickRendition(bandwidth) {
+    const bySize = [...renditions].sort((a, b) => a.width - b.width);
+    const affordable = bySize.filter(r => r.bandwidth * bandwidthHeadroom <= bandwidth);
+    const candidates = affordable.length > 0 ? affordable : bySize.slice(0, 1);
+
+    const wanted = window.innerWidth * window.devicePixelRatio;
+    return candidates.find(r => r.width >= wanted) || candidates[candidates.length - 1];
+}
+
+// What the browser thinks the connection can do, in bits per second - going by the screen alone if it doesn't know
+function initialBandwidth() {
+    const connection = navigator["connection"];
+    if (connection && connection.saveData) {
+        return 0;
+    }
+
+    return connection && connection.downlink ? connection.downlink * 1000000 : Infinity;
+}
+
+/**
+ * Requests go to the camera the rendition is served as, or the camera picked on the page if there aren't any
+ * @param {{camera_id: string} | undefined} rendition
+ */
+function renditionQuery(rendition) {
+    return rendition ? "?camera=" + encodeURIComponent(rendition.camera_id) : cameraQuery;
+}
+
+/**
+ * Plays the low latency live stream, starting over whenever the camera's live encoder restarts
+ * @param {HTMLVideoElement} video
+ * @param {{camera_id: string} | undefined} rendition
+ */
+async function playLive(video, rendition) {
+    // Live video has no sound, and muted video is allowed to start playing by itself
+    video.muted = true;
+
+    while (true) {
+        try {
+            await playLiveStream(video, renditionQuery(rendition));
+        } catch (e) {
+            console.error(e);
+            await delay(1000);
+        }
+    }
+}
+
+/**
+ * Returns when the live stream's init segment changes
+ * @param {HTMLVideoElement} video
+ * @param {string} query picks the camera
+ */
+async function playLiveStream(video, query) {
+    const initRes = await fetch("live/init.mp4" + query);
+    if (!initRes.ok) {
+        throw new Error("Error fetching live stream: " + initRes.status);
+    }
+    const initId = initRes.headers.get("X-live-init");
+    const codecs = initRes.headers.get("X-live-codecs");
+    const init = await initRes.arrayBuffer();
+
     const ms = new MediaSource();
-    const url = URL.createObjectURL(ms);
-    video.src = url;
+    video.src = URL.createObjectURL(ms);
+    await new Promise(res => ms.addEventListener("sourceopen", res, { once: true }));
 
-    ms.addEventListener("sourceopen", async() => {
-        const sb = ms.addSourceBuffer('video/mp4; codecs="avc1.640016, mp4a.40.2"');
-        sb.addEventListener("updateend", () => sb.timestampOffset += segmentLengthSeconds);
+    const sb = ms.addSourceBuffer(`video/mp4; codecs="${codecs}"`);
+    await appendBuffer(sb, init);
 
-        let lastReceivedSegment = "";
+    // When the first frame of each fragment was captured, by its media time, in server time
+    /** @type {{mediaTime: number, timestamp: number}[]} */
+    const fragmentTimes = [];
+    let clockOffset = 0;
+    const latency = document.getElementById("latency");
+    const showLatency = () => {
+        const fragment = fragmentTimes.filter(f => f.mediaTime <= video.currentTime).pop();
+        if (fragment && latency) {
+            const capturedAt = fragment.timestamp + (video.currentTime - fragment.mediaTime);
+            const seconds = (Date.now() + clockOffset) / 1000 - capturedAt;
+            latency.textContent = `Latency: ${seconds.toFixed(2)}s`;
+        }
+    };
+    video.addEventListener("timeupdate", showLatency);
 
-        async function appendSegment() {
+    let lastFragment = "";
+    try {
+        while (true) {
             /** @type Record<string, string> */
             const headers = {};
-            if (lastReceivedSegment) {
-                headers["X-last-received-segment"] = lastReceivedSegment;
+            if (lastFragment) {
+                headers["X-last-fragment"] = lastFragment;
             }
 
-            const res = await fetch("segment", {
-                headers: headers,
-            });
-            
-            const segName = res.headers.get("X-segment-name");
-            if (lastReceivedSegment === segName) {
-                return false;
+            // Held open by the server until there's a new fragment
+            const res = await fetch("live/fragment" + query, { headers: headers });
+            if (!res.ok) {
+                throw new Error("Error fetching live fragment: " + res.status);
+            }
+
+            const sequence = res.headers.get("X-fragment-sequence");
+            if (!sequence) {
+                continue;
+            }
+            if (res.headers.get("X-live-init") !== initId) {
+                return;
             }
 
             const buf = await res.arrayBuffer();
-            if (buf.byteLength === 0) {
-                return false;
+            // Close enough - the response was sent just before it arrived
+            clockOffset = parseFloat(res.headers.get("X-server-time") || "0") * 1000 - Date.now();
+            lastFragment = sequence;
+
+            fragmentTimes.push({
+                mediaTime: parseFloat(res.headers.get("X-fragment-media-time") || "0"),
+                timestamp: parseFloat(res.headers.get("X-fragment-timestamp") || "0"),
+            });
+            if (fragmentTimes.length > 100) {
+                fragmentTimes.shift();
             }
-            
-            lastReceivedSegment = segName;
 
-            sb.appendBuffer(buf);
-            return true;
+            await appendBuffer(sb, buf);
+            await keepUpWithLive(video, sb);
         }
+    } finally {
+        video.removeEventListener("timeupdate", showLatency);
+    }
+}
 
-        while (true) {
-            const startTime = Date.now();
-            await appendSegment();
-            const endTime = Date.now();
-            const totalTimeTaken = endTime - startTime;
+/**
+ * Skips ahead if playback has fallen behind (or has a gap from fragments being missed), and drops old video
+ * @param {HTMLVideoElement} video
+ * @param {SourceBuffer} sb
+ */
+async function keepUpWithLive(video, sb) {
+    if (sb.buffered.length === 0) {
+        return;
+    }
 
-            const delayMs = segmentLengthSeconds * 250;
-            await delay(delayMs - totalTimeTaken);
-        }
+    const end = sb.buffered.end(sb.buffered.length - 1);
+    if (end - video.currentTime > maxLiveBufferSeconds || video.currentTime < sb.buffered.start(0)) {
+        video.currentTime = Math.max(sb.buffered.start(sb.buffered.length - 1), end - maxLiveBufferSeconds / 2);
+    }
+
+    if (video.paused) {
+        video.play().catch(e => console.error(e));
+    }
+
+    const start = sb.buffered.start(0);
+    if (video.currentTime - start > keptLiveSeconds * 2) {
+        await new Promise(res => {
+            sb.addEventListener("updateend", res, { once: true });
+            sb.remove(start, video.currentTime - keptLiveSeconds);
+        });
+    }
+}
+
+/**
+ * @param {SourceBuffer} sb
+ * @param {ArrayBuffer} buf
+ */
+function appendBuffer(sb, buf) {
+    return new Promise((res, rej) => {
+        sb.addEventListener("updateend", res, { once: true });
+        sb.addEventListener("error", rej, { once: true });
+        sb.appendBuffer(buf);
     });
-});
+}
 
 /**
  * @param {number} ms 
@@ -6,6 +6,9 @@
 
         <script>
             var segmentLengthSeconds = {{ segmentLengthSeconds }};
+            var liveStream = {{ "true" if liveStream else "false" }};
+            var livePlaylist = "{{ livePlaylist }}";
+            var renditions = {{! renditions }};
         </script>
         <script src="static/app.js"></script>
 
@@ -27,7 +30,17 @@
     </head>
 
     <body>
+        % if len(cameraIds) > 1:
+        <nav id="cameras">
+            % for id in cameraIds:
+            <a href="?camera={{ id }}">{{ id }}</a>
+            % end
+        </nav>
+        % end
+
         <video id="camera" controls=""></video>
+        <div id="latency"></div>
+        <a id="livePlaylist" href="{{ livePlaylist }}">Live playlist (HLS)</a>
             
         <button id="toggleRecording">
             {{ "Stop" if isRecording else "Start" }} Recording
@@ -1,10 +1,48 @@
+import os
+import json
+import time
+import socket
 import threading
 import logging
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 
-from bottle import route, view, static_file, run, ServerAdapter, request, response
+import cv2
+from bottle import route, view, static_file, run, install, ServerAdapter, request, response, HTTPError, HTTPResponse, \
+    parse_range_header
 
+from frame_ring import FrameRing
+from interprocess_communication import RequestError, ERROR_NOT_FOUND
+import hls
+import mp4
+from segments import SegmentCache, is_timestamped_name
 import settings
 
+FRAME_READ_ATTEMPTS = 3
+
+# Finished segments never change, so they can be cached forever by browsers and proxies
+SEGMENT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+HLS_PLAYLIST_CONTENT_TYPE = "application/vnd.apple.mpegurl"
+
+# Long polls wait this long at a time, so they notice the server stopping
+LONG_POLL_CHECK_SECONDS = 1
+
+# How long the frame ring can go without a new frame before it's attached to again - the camera process replaces it
+# with a new one when it restarts, and the old one would keep its last frame forever
+FRAME_RING_STALE_SECONDS = 3
+
+_frame_ring = None
+_frame_ring_lock = threading.Lock()
+# The frame ring's latest sequence number when it was last checked, and when it last changed
+_frame_ring_sequence = 0
+_frame_ring_advanced = 0
+
+# Segments fetched over IPC, shared by every viewer
+_segment_cache = SegmentCache(settings.SEGMENT_CACHE_BYTES)
+
+_stopping = threading.Event()
+
 
 def start_server(pipe, cam_comm):
     setup(cam_comm)
@@ -13,6 +51,7 @@ def start_server(pipe, cam_comm):
     start_listening()
     logging.info("Web server stopped!")
     t.join()
+    _release_frame_ring()
     logging.info("Server terminated.")
 
 
@@ -31,49 +70,458 @@ def _stopper_listener(pipe):
         msg = pipe.recv()
         if isinstance(msg, str) and msg == "terminate":
             logging.info("Received terminate command - stopping")
+            _stopping.set()
             server.stop()
             break
 
 
+# The camera process may not have started yet (or may be on another machine), so attach to its frames when needed
+def _get_frame_ring():
+    global _frame_ring, _frame_ring_sequence, _frame_ring_advanced
+
+    with _frame_ring_lock:
+        if _frame_ring is not None:
+            sequence = _frame_ring.latest_sequence()
+            if sequence != _frame_ring_sequence:
+                _frame_ring_sequence = sequence
+                _frame_ring_advanced = time.time()
+            elif time.time() - _frame_ring_advanced >= FRAME_RING_STALE_SECONDS:
+                _drop_frame_ring()
+
+        if _frame_ring is None:
+            try:
+                _frame_ring = FrameRing.attach(settings.FRAME_RING_NAME)
+            except (FileNotFoundError, ValueError):  # Not created yet, or still being set up
+                return None
+
+            _frame_ring_sequence = _frame_ring.latest_sequence()
+            _frame_ring_advanced = time.time()
+
+        return _frame_ring
+
+
+def _release_frame_ring():
+    with _frame_ring_lock:
+        _drop_frame_ring()
+
+
+def _drop_frame_ring():
+    global _frame_ring
+
+    if _frame_ring is None:
+        return
+
+    try:
+        _frame_ring.release()
+    except BufferError:
+        pass  # A frame from it is still being sent - the memory is let go of once it's done with
+    _frame_ring = None
+
+
+# Several camera hosts can be connected at once, requests pick one with ?camera=<id> (or get the first one connected)
+def _requested_camera_id():
+    return request.query.camera or None
+
+
+def _parts_directory():
+    return os.path.join(settings.RECORDINGS_DIRECTORY, settings.RECORDINGS_PARTS_SUBDIR_NAME)
+
+
+# Only combined segments are served - not the raw parts they're made from, or any other file
+def _is_segment_name(filename):
+    return is_timestamped_name(filename, settings.RECORDINGS_FILENAME_VIDEO_EXTENSION)
+
+
+def _serve_segment(cam_comm, filename, camera_id):
+    if not _is_segment_name(filename):
+        return HTTPError(404, "Unknown segment")
+
+    # When the camera process is on this machine the file can be sent straight from disk (see SendfileServerHandler)
+    path = os.path.join(_parts_directory(), filename)
+    if settings.SERVE_SEGMENTS_FROM_DISK and cam_comm.is_local_camera(camera_id) and os.path.isfile(path):
+        stats = os.stat(path)
+        etag = f'"{filename}-{stats.st_size}-{int(stats.st_mtime)}"'
+        if request.get_header("If-None-Match") == etag:
+            return HTTPResponse(status=304, ETag=etag)
+
+        result = static_file(filename, root=_parts_directory())
+    else:
+        camera_id = cam_comm.resolve_camera_id(camera_id)
+        data = _segment_cache.get((camera_id, filename), lambda: cam_comm.segment_data(filename, camera_id))
+        if len(data) == 0:
+            return HTTPError(404, "Unknown segment")
+
+        etag = f'"{filename}-{len(data)}"'
+        if request.get_header("If-None-Match") == etag:
+            return HTTPResponse(status=304, ETag=etag)
+
+        result = HTTPResponse(data)
+        result.content_type = "video/mp4"
+        result.set_header("Content-Length", str(len(data)))
+
+    result.set_header("ETag", etag)
+    return result
+
+
+# HLS players fetch each segment as two byte ranges (its init segment and the rest), so both ways of serving files
+# support Range requests - static_file already does
+def _serve_hls_file(cam_comm, path, camera_id):
+    if not hls.is_hls_path(path):
+        return HTTPError(404, "Unknown file")
+
+    is_playlist = path.endswith(hls.PLAYLIST_EXTENSION)
+    content_type = HLS_PLAYLIST_CONTENT_TYPE if is_playlist else "video/mp4"
+
+    # Playlists always come from the camera process, which knows which of its live playlists is the camera's
+    if settings.SERVE_SEGMENTS_FROM_DISK and cam_comm.is_local_camera(camera_id) and not is_playlist:
+        result = static_file(path, root=settings.RECORDINGS_DIRECTORY, mimetype=content_type)
+    else:
+        # Playlists change as segments are added, segments never do - they're cached alongside the ones fetched for
+        # /segments/<filename>
+        if is_playlist:
+            data = cam_comm.hls_file(path, camera_id)
+        else:
+            data = _segment_cache.get((camera_id, path.split("/")[-1]), lambda: cam_comm.hls_file(path, camera_id))
+        if len(data) == 0:
+            return HTTPError(404, "Unknown file")
+
+        result = _byte_range_response(data, content_type)
+
+    if result.status_code in (200, 206, 304):
+        result.set_header("Cache-Control", "no-cache" if is_playlist else SEGMENT_CACHE_CONTROL)
+    return result
+
+
+def _serve_master_playlist(cam_comm, camera_id):
+    variants = [
+        hls.HlsVariant(
+            f"../{quote(r['camera_id'])}/{settings.RECORDINGS_PARTS_SUBDIR_NAME}/{hls.LIVE_PLAYLIST_NAME}",
+            r["bandwidth"], r["width"], r["height"])
+        for r in cam_comm.renditions(camera_id)
+    ]
+    if len(variants) == 0:
+        return HTTPError(404, "Unknown file")
+
+    result = HTTPResponse(hls.master_playlist(variants))
+    result.content_type = HLS_PLAYLIST_CONTENT_TYPE
+    result.set_header("Cache-Control", "no-cache")
+    return result
+
+
+def _byte_range_response(data, content_type):
+    ranges = list(parse_range_header(request.environ.get("HTTP_RANGE", ""), len(data)))
+    if request.environ.get("HTTP_RANGE") and len(ranges) == 0:
+        return HTTPError(416, "Requested Range Not Satisfiable")
+
+    result = HTTPResponse(data)
+    if len(ranges) > 0:
+        (start, end) = ranges[0]
+        result = HTTPResponse(data[start:end], status=206)
+        result.set_header("Content-Range", f"bytes {start}-{end - 1}/{len(data)}")
+
+    result.content_type = content_type
+    result.set_header("Content-Length", str(len(result.body)))
+    result.set_header("Accept-Ranges", "bytes")
+    return result
+
+
+# Calls wait with a timeout until it returns something (or the long poll times out, returning what it last returned).
+# Without a thread pool waiting would hold up every other request, so there's no waiting at all.
+def _long_poll(wait):
+    seconds = settings.LONG_POLL_SECONDS if settings.WEBSERVER_WORKERS > 0 else 0
+    deadline = time.time() + seconds
+
+    while True:
+        timeout = min(LONG_POLL_CHECK_SECONDS, deadline - time.time())
+        result = wait(max(timeout, 0))
+        if result or timeout <= 0 or _stopping.is_set():
+            return result
+
+
+def _last_fragment_sequence():
+    try:
+        return int(request.get_header("X-last-fragment"))
+    except (TypeError, ValueError):
+        return None
+
+
+# Requests the camera process responded to with an error - a file it doesn't have is a 404, anything else a 500
+def _camera_request_errors(callback):
+    def wrapper(*args, **kwargs):
+        try:
+            return callback(*args, **kwargs)
+        except RequestError as ex:
+            return HTTPError(404 if ex.error == ERROR_NOT_FOUND else 500, str(ex))
+
+    return wrapper
+
+
+def _segment_response(cam_comm, filename, camera_id):
+    result = _serve_segment(cam_comm, filename, camera_id) if filename != "" else HTTPResponse(b"")
+    result.set_header("X-segment-name", filename)
+    # The same URL returns a different segment each time, only /segments/<name> can be cached
+    result.set_header("Cache-Control", "no-cache")
+    return result
+
+
 def setup(cam_comm):
+    install(_camera_request_errors)
+
     @route("/")
     @view("main")
     def main():
+        camera_id = _requested_camera_id()
         return {
-            "isRecording": cam_comm.is_recording(),
-            "segmentLengthSeconds": settings.RECORDINGS_FRAMES_PER_FILE / settings.CAMERA_FPS
+            "isRecording": cam_comm.is_recording(camera_id),
+            "segmentLengthSeconds": settings.RECORDINGS_FRAMES_PER_FILE / settings.CAMERA_FPS,
+            "cameraIds": cam_comm.camera_ids(),
+            "cameraId": camera_id,
+            "liveStream": settings.LIVE_STREAM,
+            "livePlaylist": f"hls/{quote(cam_comm.resolve_camera_id(camera_id))}/{hls.MASTER_PLAYLIST_NAME}",
+            # Embedded in a script - keep anything in it from closing the script
+            "renditions": json.dumps(cam_comm.renditions(camera_id)).replace("</", "<\\/")
         }
 
     @route("/segment")
     def segment():
+        camera_id = _requested_camera_id()
+        last_received = request.get_header("X-last-received-segment")
+        filename = cam_comm.segment_name(last_received, camera_id)
+        return _segment_response(cam_comm, filename, camera_id)
+
+    # Long poll version of /segment - responds as soon as there's a new segment rather than straight away
+    @route("/segment/next")
+    def next_segment():
+        camera_id = _requested_camera_id()
         last_received = request.get_header("X-last-received-segment")
-        (filename, segment) = cam_comm.segment(last_received)
-        response.set_header("X-segment-name", filename)
-        return segment
+        filename = _long_poll(lambda timeout: cam_comm.wait_for_segment_name(last_received, camera_id, timeout))
+        return _segment_response(cam_comm, filename, camera_id)
+
+    @route("/live/init.mp4")
+    def live_init():
+        live_init = cam_comm.live_init_segment(_requested_camera_id())
+        if live_init is None:
+            return HTTPError(503, "No live stream available")
+
+        (init_id, data) = live_init
+        result = HTTPResponse(data)
+        result.content_type = "video/mp4"
+        result.set_header("X-live-init", str(init_id))
+        result.set_header("X-live-codecs", mp4.avc_codec_string(data))
+        result.set_header("Cache-Control", "no-cache")
+        return result
+
+    # Long polls for the live fragment after X-last-fragment, along with when its first frame was captured so viewers
+    # can tell how far behind they are
+    @route("/live/fragment")
+    def live_fragment():
+        camera_id = _requested_camera_id()
+        last_sequence = _last_fragment_sequence()
+        fragment = _long_poll(lambda timeout: cam_comm.wait_for_live_fragment(last_sequence, camera_id, timeout))
+
+        if fragment is None:
+            result = HTTPResponse(b"")
+        else:
+            result = HTTPResponse(fragment.data)
+            result.content_type = "video/mp4"
+            result.set_header("X-live-init", str(fragment.init_id))
+            result.set_header("X-fragment-sequence", str(fragment.sequence))
+            result.set_header("X-fragment-media-time", str(fragment.media_time))
+            result.set_header("X-fragment-timestamp", str(fragment.timestamp))
+
+        result.set_header("X-server-time", str(time.time()))
+        result.set_header("Cache-Control", "no-cache")
+        return result
+
+    @route("/segments/<filename>")
+    def segment_by_name(filename):
+        result = _serve_segment(cam_comm, filename, _requested_camera_id())
+        if result.status_code in (200, 206, 304):
+            result.set_header("Cache-Control", SEGMENT_CACHE_CONTROL)
+        return result
+
+    # The live playlist is hls/<camera id>/parts/live.m3u8, a recording's is hls/<camera id>/<recording name>.m3u8.
+    # hls/<camera id>/master.m3u8 lists the live playlists of each of the camera's renditions.
+    @route("/hls/<camera_id>/<path:path>")
+    def hls_file(camera_id, path):
+        if path == hls.MASTER_PLAYLIST_NAME:
+            return _serve_master_playlist(cam_comm, camera_id)
+
+        return _serve_hls_file(cam_comm, path, cam_comm.resolve_camera_id(camera_id))
+
+    @route("/frame.jpg")
+    def frame():
+        ring = _get_frame_ring()
+        if ring is None:
+            return HTTPError(503, "No frames available")
+
+        for _ in range(FRAME_READ_ATTEMPTS):
+            latest = ring.latest()
+            if latest is None:
+                continue
+
+            (success, jpg) = cv2.imencode(".jpg", latest.data)
+
+            # The frame is read straight out of shared memory, make sure it wasn't overwritten while encoding
+            if success and ring.is_current(latest):
+                response.content_type = "image/jpeg"
+                response.set_header("Cache-Control", "no-store")
+                response.set_header("X-frame-sequence", str(latest.sequence))
+                response.set_header("X-frame-timestamp", str(latest.timestamp))
+                return jpg.tobytes()
+
+        return HTTPError(503, "No frames available")
 
     @route("/recording/start")
     def start_recording():
-        cam_comm.start_recording()
+        cam_comm.start_recording(_requested_camera_id())
 
     @route("/recording/stop")
     def stop_recording():
-        cam_comm.stop_recording()
+        cam_comm.stop_recording(_requested_camera_id())
+
+    # How much each camera's picture is changing (0 to 1), by camera id - empty if motion detection is turned off
+    @route("/motion")
+    def motion():
+        response.set_header("Cache-Control", "no-store")
+        return cam_comm.motion_scores(_requested_camera_id())
 
     @route("/static/<name>")
     def static(name):
         return static_file(name, root="./static")
 
 
+# Like socketserver.ThreadingMixIn, but with a fixed number of threads so a burst of viewers can't start an unbounded
+# number of them. A slow client only ties up one worker rather than the whole server.
+class ThreadPoolMixIn:
+    executor = None
+    stopping = False
+
+    def process_request(self, request, client_address):
+        if self.executor is None:
+            self.connections = set()
+            self.connections_lock = threading.Lock()
+            self.executor = ThreadPoolExecutor(
+                max_workers=settings.WEBSERVER_WORKERS, thread_name_prefix="Webserver Worker")
+
+        self.executor.submit(self._process_request_in_worker, request, client_address)
+
+    def _process_request_in_worker(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections.discard(request)
+            self.shutdown_request(request)
+
+    # Called once serve_forever has returned - lets requests in progress finish, but wakes up kept alive connections
+    # waiting for their next request so they close instead
+    def drain(self):
+        self.stopping = True
+        if self.executor is None:
+            return
+
+        with self.connections_lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+
+        self.executor.shutdown(wait=True)
+
+
 class MyWSGIRefServer(ServerAdapter):
     def run(self, app):  # pragma: no cover
-        from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+        from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, ServerHandler
         from wsgiref.simple_server import make_server
-        import socket
+
+        # wsgiref copies files through Python by default - hand them to the kernel with sendfile where possible
+        class SendfileServerHandler(ServerHandler):
+            http_version = "1.1"
+
+            # wsgiref can't do chunked encoding, so only responses with a known length can leave the connection open.
+            # Without a thread pool a kept alive connection would hold up everyone else, so they're always closed.
+            def cleanup_headers(self):
+                ServerHandler.cleanup_headers(self)
+
+                server = self.request_handler.server
+                keep_alive = isinstance(server, ThreadPoolMixIn) and not server.stopping
+                has_length = "Content-Length" in self.headers or self.status[:3] in ("204", "304")
+                if not keep_alive or not has_length or self.request_handler.close_connection:
+                    self.request_handler.close_connection = True
+                    self.headers["Connection"] = "close"
+
+            def sendfile(self):
+                if not hasattr(os, "sendfile"):
+                    return False
+
+                try:
+                    self.result.filelike.fileno()
+                    offset = self.result.filelike.tell()
+                except (AttributeError, OSError):
+                    return False
+
+                if not self.headers_sent:
+                    self.send_headers()
+                self._flush()
+
+                # socket.sendfile rather than os.sendfile, as it copes with the keep alive timeout making the socket
+                # non-blocking
+                self.bytes_sent += self.request_handler.connection.sendfile(self.result.filelike, offset)
+                return True
 
         class FixedHandler(WSGIRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # How long a kept alive connection can sit idle waiting for its next request
+            timeout = settings.WEBSERVER_KEEP_ALIVE_SECONDS
+
             def address_string(self):  # Prevent reverse DNS lookups please.
                 return self.client_address[0]
 
+            def handle(self):
+                self.close_connection = True
+                self.handle_one_request()
+                while not self.close_connection:
+                    self.handle_one_request()
+
+            # Same as WSGIRequestHandler.handle, only using SendfileServerHandler and keeping the connection open
+            def handle_one_request(self):
+                try:
+                    self.raw_requestline = self.rfile.readline(65537)
+                except OSError:  # Including the keep alive timeout running out
+                    self.close_connection = True
+                    return
+
+                if not self.raw_requestline:
+                    self.close_connection = True
+                    return
+
+                if len(self.raw_requestline) > 65536:
+                    self.requestline = ''
+                    self.request_version = ''
+                    self.command = ''
+                    self.send_error(414)
+                    return
+
+                if not self.parse_request():
+                    return
+
+                # Nothing here reads request bodies, so there'd be no telling where the next request starts
+                if self.headers.get("Content-Length", "0") != "0" or "Transfer-Encoding" in self.headers:
+                    self.close_connection = True
+
+                handler = SendfileServerHandler(
+                    self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+                    multithread=settings.WEBSERVER_WORKERS > 0)
+                handler.request_handler = self
+                handler.run(self.server.get_app())
+
             def log_request(*args, **kw):
                 if not self.quiet:
                     return WSGIRequestHandler.log_request(*args, **kw)
@@ -81,13 +529,23 @@ class MyWSGIRefServer(ServerAdapter):
         handler_cls = self.options.get('handler_class', FixedHandler)
         server_cls = self.options.get('server_class', WSGIServer)
 
+        if settings.WEBSERVER_WORKERS > 0:
+            class server_cls(ThreadPoolMixIn, server_cls):
+                pass
+
         if ':' in self.host:  # Fix wsgiref for IPv6 addresses.
             if getattr(server_cls, 'address_family') == socket.AF_INET:
                 class server_cls(server_cls):
                     address_family = socket.AF_INET6
 
         self.server = make_server(self.host, self.port, app, server_cls, handler_cls)
-        self.server.serve_forever()
+        try:
+            self.server.serve_forever()
+        finally:
+            if isinstance(self.server, ThreadPoolMixIn):
+                logging.info("Waiting for in progress web requests to finish...")
+                self.server.drain()
+            self.server.server_close()
 
     def stop(self):
         # self.server.server_close() <--- alternative but causes bad fd exception
@@ -0,0 +1,9 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+import settings  # noqa: E402
+
+# pyaudio is only needed (and imported by recorder) when recording audio
+settings.RECORD_AUDIO = False
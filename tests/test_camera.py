@@ -0,0 +1,245 @@
+import time
+import uuid
+
+import cv2
+import numpy as np
+import pytest
+
+from camera import CurrentTimeCamera, FrameBuffers, GridCamera, ProcessCamera, ThreadedCamera
+
+
+def wait_for(condition):
+    deadline = time.time() + 10
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+# Shows whatever frame the test gives it
+class FakeCamera:
+    def __init__(self, camera_id, width, height):
+        self.camera_id = camera_id
+        self.width = width
+        self.height = height
+        self.current_frame = None
+
+    def show(self, value, width=None, height=None):
+        self.current_frame = np.full((height or self.height, width or self.width, 3), value, np.uint8)
+
+    def update_frame(self):
+        pass
+
+    def release(self):
+        pass
+
+    def stats(self):
+        return []
+
+
+# Each read is the next frame number, or no frame at all while failing, and takes read_seconds
+class CountingCamera(FakeCamera):
+    def __init__(self, read_seconds=0):
+        super().__init__(0, 4, 2)
+        self.read_seconds = read_seconds
+        self.failing = False
+        self.count = 0
+        self.show(0)
+
+    def update_frame(self):
+        time.sleep(self.read_seconds)
+        if self.failing:
+            self.current_frame = None
+        else:
+            self.count += 1
+            self.show(self.count)
+
+
+@pytest.fixture
+def threaded_camera(request):
+    camera = ThreadedCamera(CountingCamera(getattr(request, "param", 0)), 100)
+    yield camera
+    camera.release()
+
+
+def test_threaded_camera_picks_up_the_latest_frame(threaded_camera):
+    wait_for(lambda: threaded_camera.frames_read >= 3)
+
+    threaded_camera.update_frame()
+
+    assert threaded_camera.current_frame[0, 0, 0] >= 3
+    assert threaded_camera.stats()[0]["frames_read"] >= 3
+
+
+def test_threaded_camera_keeps_the_last_frame_through_failed_reads(threaded_camera):
+    wait_for(lambda: threaded_camera.frames_read >= 1)
+    threaded_camera.camera.failing = True
+    wait_for(lambda: threaded_camera.dropped_reads >= 2)
+
+    threaded_camera.update_frame()
+
+    assert threaded_camera.current_frame is not None
+    assert threaded_camera.current_frame[0, 0, 0] == threaded_camera.camera.count
+
+
+@pytest.mark.parametrize("threaded_camera", [0.5], indirect=True)
+def test_slow_camera_does_not_hold_up_updates(threaded_camera):
+    start = time.time()
+    for _ in range(10):
+        threaded_camera.update_frame()
+
+    assert time.time() - start < 0.25
+
+
+def test_frame_buffers_alternate():
+    buffers = FrameBuffers(4, 2)
+
+    (first, second) = (buffers.next(), buffers.next())
+
+    assert first is not second
+    assert first.shape == (2, 4, 3)
+    assert buffers.next() is first
+
+
+def test_grid_draws_each_camera_into_its_tile():
+    cameras = [FakeCamera(i, 4, 2) for i in range(3)]
+    grid = GridCamera(cameras)
+    for (i, camera) in enumerate(cameras):
+        camera.show(i + 1)
+
+    grid.update_frame()
+
+    assert grid.current_frame.shape == (4, 8, 3)
+    assert (grid.current_frame[:2, :4] == 1).all()
+    assert (grid.current_frame[:2, 4:] == 2).all()
+    assert (grid.current_frame[2:, :4] == 3).all()
+    assert (grid.current_frame[2:, 4:] == 0).all()
+
+
+def test_grid_frames_are_not_drawn_over_by_the_next():
+    camera = FakeCamera(0, 4, 2)
+    grid = GridCamera([camera])
+
+    camera.show(1)
+    grid.update_frame()
+    previous = grid.current_frame
+
+    camera.show(2)
+    grid.update_frame()
+
+    assert grid.current_frame is not previous
+    assert (previous == 1).all()
+    assert (grid.current_frame == 2).all()
+
+
+def test_camera_without_a_frame_is_cleared():
+    camera = FakeCamera(0, 4, 2)
+    grid = GridCamera([camera])
+
+    for value in (1, 2):
+        camera.show(value)
+        grid.update_frame()
+
+    # Drawn into the buffer that held the first frame
+    camera.current_frame = None
+    grid.update_frame()
+
+    assert (grid.current_frame == 0).all()
+
+
+def test_smaller_frame_leaves_the_rest_of_its_tile_clear():
+    camera = FakeCamera(0, 4, 2)
+    grid = GridCamera([camera])
+
+    for value in (1, 2):
+        camera.show(value)
+        grid.update_frame()
+
+    camera.show(3, width=2, height=1)
+    grid.update_frame()
+
+    assert (grid.current_frame[:1, :2] == 3).all()
+    assert grid.current_frame.sum() == 3 * 2 * 3
+
+
+def test_wrapped_grid_is_drawn_into_the_wrappers_frame():
+    camera = FakeCamera(0, 4, 2)
+    camera.show(5)
+    current_time = CurrentTimeCamera(GridCamera([camera]))
+    status_bar_height = current_time._determine_status_bar_height()
+
+    assert current_time.current_frame.shape == (status_bar_height + 2, 4, 3)
+    assert (current_time.current_frame[status_bar_height:] == 5).all()
+    assert np.shares_memory(current_time.camera.current_frame, current_time.current_frame)
+
+
+def test_status_bar_is_only_rendered_when_its_text_changes(monkeypatch):
+    text = "2020-01-01 00:00:00"
+    monkeypatch.setattr(time, "strftime", lambda format: text)
+    rendered = []
+    put_text = cv2.putText
+    monkeypatch.setattr(cv2, "putText", lambda image, *args: rendered.append(args[0]) or put_text(image, *args))
+
+    camera = FakeCamera(0, 400, 2)
+    camera.show(5)
+    current_time = CurrentTimeCamera(camera)
+    status_bar_height = current_time._determine_status_bar_height()
+    first_status_bar = current_time.current_frame[:status_bar_height].copy()
+
+    for _ in range(3):
+        current_time.update_frame()
+
+    assert rendered == [text]
+    assert (current_time.current_frame[:status_bar_height] == first_status_bar).all()
+    assert first_status_bar.any()
+    assert (current_time.current_frame[status_bar_height:] == 5).all()
+
+    text = "2020-01-01 00:00:01"
+    current_time.update_frame()
+
+    assert rendered == ["2020-01-01 00:00:00", text]
+    assert (current_time.current_frame[:status_bar_height] != first_status_bar).any()
+
+
+@pytest.fixture
+def process_camera():
+    camera = ProcessCamera(0, 160, 120, 20, f"camera-streamer-test-{uuid.uuid4().hex[:8]}", mock=True)
+    yield camera
+    camera.release()
+
+
+def update_to_next_frame(camera):
+    sequence = camera.ring.latest_sequence()
+    wait_for(lambda: camera.ring.latest_sequence() > sequence)
+    camera.update_frame()
+
+
+def test_process_camera_frames_are_new_objects(process_camera):
+    wait_for(lambda: process_camera.current_frame is not None or process_camera.update_frame())
+    previous = process_camera.current_frame
+    previous_data = previous.copy()
+
+    update_to_next_frame(process_camera)
+
+    assert process_camera.current_frame is not previous
+    assert (previous == previous_data).all()
+
+
+def test_process_camera_keeps_the_current_frame_when_a_copy_is_torn(process_camera, monkeypatch):
+    wait_for(lambda: process_camera.current_frame is not None or process_camera.update_frame())
+    current = process_camera.current_frame
+    current_data = current.copy()
+    sequence = process_camera.sequence
+
+    monkeypatch.setattr(process_camera.ring, "is_current", lambda frame: False)
+    update_to_next_frame(process_camera)
+
+    assert process_camera.current_frame is current
+    assert process_camera.sequence == sequence
+    assert (current == current_data).all()
+
+    monkeypatch.undo()
+    update_to_next_frame(process_camera)
+
+    assert process_camera.current_frame is not current
+    assert process_camera.sequence > sequence
+    assert (current == current_data).all()
@@ -0,0 +1,154 @@
+import threading
+import time
+
+import pytest
+
+from combine_queue import CombineQueue, OVERLOAD_DROP, OVERLOAD_FASTER, FASTER_PRESET
+
+
+class Recorder:
+    def __init__(self, combine=None):
+        self.finished = []
+        self.dropped = []
+        self.presets = []
+        self.combine_job = combine or (lambda job: f"{job.video_filename}.mp4")
+
+    def combine(self, job, preset):
+        self.presets.append(preset)
+        return self.combine_job(job)
+
+    def queue(self, workers=1, max_queued=10, policy=OVERLOAD_DROP):
+        return CombineQueue(
+            workers, max_queued, policy, self.combine, lambda job, filename: self.finished.append(filename),
+            self.dropped.append)
+
+
+def wait_for(condition):
+    deadline = time.time() + 5
+    while not condition() and time.time() < deadline:
+        time.sleep(0.001)
+    assert condition()
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        Recorder().queue(policy="unknown")
+
+
+def test_segments_are_finished_in_order():
+    # The earliest parts take the longest to combine
+    def combine(job):
+        time.sleep(0.01 * (5 - job.sequence))
+        return f"{job.video_filename}.mp4"
+
+    recorder = Recorder(combine)
+    queue = recorder.queue(workers=3)
+    try:
+        for i in range(6):
+            queue.add(f"v{i}", f"a{i}", None)
+        assert queue.wait_until_idle(5)
+    finally:
+        queue.release()
+
+    assert recorder.finished == [f"v{i}.mp4" for i in range(6)]
+    assert queue.stats()["combined"] == 6
+
+
+def test_failed_segments_are_skipped():
+    def combine(job):
+        if job.sequence == 1:
+            raise RuntimeError("ffmpeg failed")
+        return None if job.sequence == 2 else f"{job.video_filename}.mp4"
+
+    recorder = Recorder(combine)
+    queue = recorder.queue(workers=2)
+    try:
+        for i in range(4):
+            queue.add(f"v{i}", f"a{i}", None)
+        assert queue.wait_until_idle(5)
+    finally:
+        queue.release()
+
+    assert recorder.finished == ["v0.mp4", "v3.mp4"]
+    assert queue.stats()["failed"] == 2
+
+
+def test_overflow_drops_the_oldest_waiting_parts():
+    release = threading.Event()
+
+    def combine(job):
+        release.wait(5)
+        return f"{job.video_filename}.mp4"
+
+    recorder = Recorder(combine)
+    queue = recorder.queue(workers=1, max_queued=2)
+    try:
+        queue.add("v0", "a0", None)
+        wait_for(lambda: queue.stats()["combining"] == 1)
+
+        for i in range(1, 5):
+            queue.add(f"v{i}", f"a{i}", None)
+
+        assert [job.video_filename for job in recorder.dropped] == ["v1", "v2"]
+        assert queue.stats()["queued"] == 2
+
+        release.set()
+        assert queue.wait_until_idle(5)
+    finally:
+        release.set()
+        queue.release()
+
+    assert recorder.finished == ["v0.mp4", "v3.mp4", "v4.mp4"]
+    assert queue.stats()["dropped"] == 2
+
+
+def test_faster_preset_while_overloaded():
+    release = threading.Event()
+
+    def combine(job):
+        release.wait(5)
+        return f"{job.video_filename}.mp4"
+
+    recorder = Recorder(combine)
+    queue = recorder.queue(workers=1, max_queued=4, policy=OVERLOAD_FASTER)
+    overloaded = []
+    queue.overload_listeners.append(overloaded.append)
+    try:
+        queue.add("v0", "a0", None)
+        wait_for(lambda: queue.stats()["combining"] == 1)
+        queue.add("v1", "a1", None)
+        queue.add("v2", "a2", None)
+
+        release.set()
+        assert queue.wait_until_idle(5)
+    finally:
+        release.set()
+        queue.release()
+
+    assert recorder.presets == [None, FASTER_PRESET, FASTER_PRESET]
+    assert overloaded == [True, False]
+
+
+def test_slow_finished_does_not_block_add():
+    handing_on = threading.Event()
+    release = threading.Event()
+
+    def finished(job, filename):
+        handing_on.set()
+        release.wait(5)
+
+    queue = CombineQueue(2, 10, OVERLOAD_DROP, lambda job, preset: "out.mp4", finished, lambda job: None)
+    try:
+        queue.add("v0", "a0", None)
+        assert handing_on.wait(5)
+
+        start = time.time()
+        queue.add("v1", "a1", None)
+        queue.stats()
+        assert time.time() - start < 1
+
+        release.set()
+        assert queue.wait_until_idle(5)
+    finally:
+        release.set()
+        queue.release()
@@ -0,0 +1,101 @@
+import uuid
+
+import numpy as np
+import pytest
+
+from frame_ring import FrameRing, FrameReader
+
+
+@pytest.fixture
+def ring():
+    ring = FrameRing.create(f"camera-streamer-test-{uuid.uuid4().hex[:8]}", 4, 3, 4)
+    yield ring
+    ring.release()
+
+
+def frame(value, width=4, height=3):
+    return np.full((height, width, 3), value, np.uint8)
+
+
+def test_empty_ring_has_no_frames(ring):
+    assert ring.latest_sequence() == 0
+    assert ring.latest() is None
+    assert ring.get(0) is None
+
+
+def test_write_and_read_latest(ring):
+    assert ring.write(frame(7), 12.5) == 1
+
+    latest = ring.latest()
+    assert latest.sequence == 1
+    assert latest.timestamp == 12.5
+    assert (latest.data == 7).all()
+
+
+def test_overwritten_frames_are_gone(ring):
+    for i in range(1, 6):
+        ring.write(frame(i), i)
+
+    # Four slots, so the first frame has been overwritten by the fifth
+    assert ring.get(1) is None
+    assert (ring.get(2).data == 2).all()
+    assert (ring.get(5).data == 5).all()
+
+
+def test_is_current_until_lapped(ring):
+    ring.write(frame(1), 1)
+    first = ring.latest()
+    assert ring.is_current(first)
+
+    for i in range(2, 6):
+        ring.write(frame(i), i)
+    assert not ring.is_current(first)
+
+
+def test_larger_frames_are_cropped(ring):
+    big = frame(0, 6, 5)
+    big[:3, :4] = 9
+    ring.write(big, 1)
+
+    assert (ring.latest().data == 9).all()
+
+
+def test_attached_ring_sees_writes(ring):
+    attached = FrameRing.attach(ring.shm.name, shared_tracker=True)
+    try:
+        assert (attached.width, attached.height, attached.slot_count) == (4, 3, 4)
+
+        ring.write(frame(3), 2.0)
+        assert attached.latest_sequence() == 1
+        assert (attached.latest().data == 3).all()
+    finally:
+        attached.release()
+
+
+def test_reader_starts_from_the_latest_frame(ring):
+    ring.write(frame(1), 1)
+    ring.write(frame(2), 2)
+    reader = FrameReader(ring)
+
+    assert [f.sequence for f in reader.next_frames()] == [2]
+    assert reader.next_frames() == []
+
+    ring.write(frame(3), 3)
+    ring.write(frame(4), 4)
+    assert [f.sequence for f in reader.next_frames()] == [3, 4]
+    assert (reader.frames_read, reader.dropped) == (3, 0)
+
+
+def test_reader_counts_frames_it_fell_behind_on(ring):
+    reader = FrameReader(ring)
+
+    for i in range(1, 8):
+        ring.write(frame(i), i)
+
+    # Only the last four are still in the ring
+    assert [f.sequence for f in reader.next_frames()] == [4, 5, 6, 7]
+    assert (reader.frames_read, reader.dropped) == (4, 3)
+
+    ring.write(frame(8), 8)
+    assert [f.sequence for f in reader.next_frames()] == [8]
+    assert reader.dropped == 3
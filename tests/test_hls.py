@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+import hls
+from hls import HlsSegment, HlsVariant
+
+
+def test_media_playlist():
+    segments = [HlsSegment("a.mp4", 2.0, 800, 10800), HlsSegment("b.mp4", 2.4, 800, 12800)]
+
+    assert hls.media_playlist(segments, media_sequence=5, ended=True, playlist_type="EVENT") == "\n".join([
+        "#EXTM3U",
+        "#EXT-X-VERSION:7",
+        "#EXT-X-TARGETDURATION:3",
+        "#EXT-X-MEDIA-SEQUENCE:5",
+        "#EXT-X-DISCONTINUITY-SEQUENCE:5",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+        "#EXT-X-PLAYLIST-TYPE:EVENT",
+        '#EXT-X-MAP:URI="a.mp4",BYTERANGE="800@0"',
+        "#EXTINF:2.000,",
+        "#EXT-X-BYTERANGE:10000@800",
+        "a.mp4",
+        "#EXT-X-DISCONTINUITY",
+        '#EXT-X-MAP:URI="b.mp4",BYTERANGE="800@0"',
+        "#EXTINF:2.400,",
+        "#EXT-X-BYTERANGE:12000@800",
+        "b.mp4",
+        "#EXT-X-ENDLIST",
+    ]) + "\n"
+
+
+def test_empty_media_playlist():
+    playlist = hls.media_playlist([])
+
+    assert "#EXT-X-TARGETDURATION:1" in playlist
+    assert "#EXT-X-ENDLIST" not in playlist
+    assert "#EXT-X-PLAYLIST-TYPE" not in playlist
+
+
+def test_master_playlist():
+    variants = [HlsVariant("full.m3u8", 2000000, 1280, 720), HlsVariant("small.m3u8", 0, 320, 180)]
+
+    assert hls.master_playlist(variants) == "\n".join([
+        "#EXTM3U",
+        "#EXT-X-VERSION:7",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+        "#EXT-X-STREAM-INF:BANDWIDTH=2000000,RESOLUTION=1280x720",
+        "full.m3u8",
+        "#EXT-X-STREAM-INF:BANDWIDTH=1,RESOLUTION=320x180",
+        "small.m3u8",
+    ]) + "\n"
+
+
+def test_write_playlist_replaces_the_file(tmp_path):
+    filename = str(tmp_path / "live.m3u8")
+
+    hls.write_playlist(filename, "first")
+    hls.write_playlist(filename, "second")
+
+    with open(filename) as f:
+        assert f.read() == "second"
+    assert os.listdir(tmp_path) == ["live.m3u8"]
+
+
+def test_live_playlist_keeps_a_window(tmp_path):
+    filename = str(tmp_path / hls.LIVE_PLAYLIST_NAME)
+    playlist = hls.LivePlaylist(filename, 2)
+
+    for name in ["a.mp4", "b.mp4", "c.mp4", "d.mp4"]:
+        playlist.add(HlsSegment(name, 2.0, 800, 10800))
+
+    with open(filename) as f:
+        content = f.read()
+
+    assert [s.uri for s in playlist.segments] == ["c.mp4", "d.mp4"]
+    assert "#EXT-X-MEDIA-SEQUENCE:2" in content
+    assert "a.mp4" not in content and "b.mp4" not in content
+    assert content.endswith("d.mp4\n")
+
+
+@pytest.mark.parametrize("path, allowed", [
+    ("parts/live.m3u8", True),
+    ("parts/2024-01-02-03-04-05.mp4", True),
+    ("parts/2024-01-02-03-04-05-cam1.mp4", True),
+    ("2024-01-02-03-04-05.m3u8", True),
+    ("2024-01-02-03-04-05-cam1.m3u8", True),
+    ("2024-01-02-03-04-05-thumb.m3u8", True),
+    ("parts/2024-01-02-03-04-05.m3u8", False),
+    ("parts/notes.mp4", False),
+    ("2024-01-02-03-04-05.mp4", False),
+    ("parts/../2024-01-02-03-04-05.mp4", False),
+    ("other/live.m3u8", False),
+    ("/etc/passwd", False),
+])
+def test_is_hls_path(path, allowed):
+    assert hls.is_hls_path(path) == allowed
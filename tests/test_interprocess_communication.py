@@ -0,0 +1,204 @@
+import socket
+import struct
+import time
+import uuid
+
+import pytest
+
+import interprocess_communication as ipc
+
+
+def message_bytes(message_type, id=ipc.NO_ID, body=None, payload=b""):
+    return b"".join(ipc.encode_message(message_type, id, body, payload))
+
+
+def test_encode_keeps_payload_separate():
+    buffers = ipc.encode_message(ipc.MESSAGE_TYPE_RESPONSE, body={"a": 1}, payload=b"x" * 10)
+
+    assert len(buffers) == 2
+    assert buffers[1] == b"x" * 10
+
+    assert len(ipc.encode_message(ipc.MESSAGE_TYPE_HEARTBEAT)) == 1
+
+
+def test_round_trip():
+    id = uuid.uuid4().bytes
+    data = message_bytes(ipc.MESSAGE_TYPE_REQUEST, id, {"request": "segment"}, b"\0\1\2")
+
+    (message, message_len) = ipc.decode_message(data)
+
+    assert message_len == len(data)
+    assert message == ipc.Message(ipc.MESSAGE_TYPE_REQUEST, id, {"request": "segment"}, b"\0\1\2")
+
+
+def test_message_without_body_or_payload():
+    data = message_bytes(ipc.MESSAGE_TYPE_HEARTBEAT)
+
+    assert len(data) == ipc.MESSAGE_HEADER.size
+    (message, _) = ipc.decode_message(data)
+    assert message.body is None
+    assert message.payload == b""
+
+
+def test_partial_messages_are_not_decoded():
+    data = message_bytes(ipc.MESSAGE_TYPE_RESPONSE, body={"a": 1}, payload=b"payload")
+
+    assert ipc.peek_message_size(data[:ipc.MESSAGE_HEADER.size - 1]) is None
+    assert ipc.peek_message_size(data[:ipc.MESSAGE_HEADER.size]) == len(data)
+
+    for end in (0, ipc.MESSAGE_HEADER.size, len(data) - 1):
+        assert ipc.decode_message(data[:end]) is None
+
+
+def test_only_the_first_message_is_decoded():
+    first = message_bytes(ipc.MESSAGE_TYPE_RESPONSE, body={"filename": "a.mp4"})
+    second = message_bytes(ipc.MESSAGE_TYPE_RESPONSE, body={"filename": "b.mp4"})
+
+    (message, message_len) = ipc.decode_message(memoryview(first + second))
+
+    assert message.body["filename"] == "a.mp4"
+    assert message_len == len(first)
+
+
+def test_other_protocol_versions_are_rejected():
+    data = bytearray(message_bytes(ipc.MESSAGE_TYPE_HEARTBEAT))
+    data[0] = ipc.PROTOCOL_VERSION + 1
+
+    with pytest.raises(ConnectionError):
+        ipc.decode_message(data)
+
+
+def test_header_layout():
+    id = uuid.uuid4().bytes
+    data = message_bytes(ipc.MESSAGE_TYPE_REQUEST, id, {"a": 1}, b"abc")
+
+    (version, message_type, header_id, body_len, payload_len) = struct.unpack_from(">BB16sII", data)
+
+    assert (version, message_type, header_id) == (ipc.PROTOCOL_VERSION, ipc.MESSAGE_TYPE_REQUEST, id)
+    assert body_len == len(b'{"a": 1}')
+    assert payload_len == 3
+
+
+@pytest.fixture
+def connection_pair(monkeypatch):
+    # A tiny read buffer so messages straddle its end and have to be moved or grown into
+    monkeypatch.setattr(ipc, "READ_BUFFER_SIZE", 64)
+
+    (a, b) = socket.socketpair()
+    (sender, receiver) = (ipc.Connection(a), ipc.Connection(b))
+    yield (sender, receiver)
+    sender.close()
+    receiver.close()
+
+
+def receive(connection, count):
+    messages = []
+    deadline = time.time() + 5
+    while len(messages) < count and time.time() < deadline:
+        messages.extend(connection.try_receive_data())
+
+    return messages
+
+
+def test_messages_across_buffer_boundaries(connection_pair):
+    (sender, receiver) = connection_pair
+
+    bodies = [{"request": "segment", "last_received": f"{i}.mp4"} for i in range(50)]
+    for body in bodies:
+        sender.send(ipc.encode_message(ipc.MESSAGE_TYPE_REQUEST, body=body))
+    sender.try_send_data()
+
+    assert [m.body for m in receive(receiver, len(bodies))] == bodies
+
+
+def test_message_larger_than_buffer(connection_pair):
+    (sender, receiver) = connection_pair
+    payload = bytes(range(256)) * 64
+
+    sender.send(ipc.encode_message(ipc.MESSAGE_TYPE_RESPONSE, body={"filename": "a.mp4"}, payload=payload))
+    sender.send(ipc.encode_message(ipc.MESSAGE_TYPE_RESPONSE, body={"filename": "b.mp4"}))
+    # The socket buffers are big enough to take the whole lot without the receiver reading any of it
+    sender.try_send_data()
+    assert not sender.has_data_to_send()
+
+    messages = receive(receiver, 2)
+
+    assert messages[0].payload == payload
+    assert len(receiver.read_buffer) > len(payload)
+    assert messages[1].body == {"filename": "b.mp4"}
+
+
+def test_message_arriving_a_byte_at_a_time(connection_pair):
+    (sender, receiver) = connection_pair
+    data = message_bytes(ipc.MESSAGE_TYPE_REQUEST, uuid.uuid4().bytes, {"request": "segment"}, b"x" * 100)
+
+    messages = []
+    for i in range(len(data)):
+        sender.socket.send(data[i:i + 1])
+        messages.extend(receiver.try_receive_data())
+
+    assert len(messages) == 1
+    assert messages[0].payload == b"x" * 100
+
+
+def test_heartbeats_are_not_returned(connection_pair):
+    (sender, receiver) = connection_pair
+    receiver.last_heartbeat_received = 0
+
+    sender.send(ipc.encode_message(ipc.MESSAGE_TYPE_HEARTBEAT))
+    sender.send(ipc.encode_message(ipc.MESSAGE_TYPE_REQUEST, body={"request": "is_recording"}))
+    sender.try_send_data()
+
+    assert [m.type for m in receive(receiver, 1)] == [ipc.MESSAGE_TYPE_REQUEST]
+    assert receiver.last_heartbeat_received > 0
+
+
+def test_closed_connection_raises(connection_pair):
+    (sender, receiver) = connection_pair
+    sender.close()
+
+    with pytest.raises(ConnectionAbortedError):
+        receiver.try_receive_data()
+
+
+class FakeCameraManager:
+    def is_recording(self):
+        return True
+
+    def segment_data(self, filename):
+        raise FileNotFoundError(filename)
+
+    def hls_file(self, path):
+        raise RuntimeError("encoder stopped")
+
+
+def test_respond_to_request():
+    assert ipc.respond_to_request(FakeCameraManager(), {"request": "is_recording"}) == ({"value": True}, b"")
+
+
+@pytest.mark.parametrize("message, error", [
+    ({"request": "segment_data", "filename": "missing.mp4"}, ipc.ERROR_NOT_FOUND),
+    ({"request": "hls_file", "path": "index.m3u8"}, ipc.ERROR_FAILED),
+    ({"request": "no_such_request"}, ipc.ERROR_UNKNOWN_REQUEST),
+])
+def test_respond_to_request_errors(message, error):
+    (body, payload) = ipc.respond_to_request(FakeCameraManager(), message)
+
+    assert body[ipc.ERROR_KEY] == error
+    assert payload == b""
+
+
+def test_check_response_raises_errors():
+    (body, payload) = ipc.error_response(ipc.ERROR_NOT_FOUND, "missing.mp4")
+
+    with pytest.raises(ipc.RequestError) as raised:
+        ipc.check_response(ipc.Message(ipc.MESSAGE_TYPE_RESPONSE, ipc.NO_ID, body, payload))
+
+    assert raised.value.error == ipc.ERROR_NOT_FOUND
+    assert str(raised.value) == "missing.mp4"
+
+
+def test_check_response_passes_responses_through():
+    response = ipc.Message(ipc.MESSAGE_TYPE_RESPONSE, ipc.NO_ID, {"value": True}, b"")
+
+    assert ipc.check_response(response) is response
@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+import pytest
+
+import interprocess_communication as ipc
+import interprocess_communication_asyncio as ipc_asyncio
+from live_stream import LiveFragment
+
+
+class FakeCameraManager:
+    def __init__(self):
+        self.segment_listeners = []
+        self.fragment_listeners = []
+
+    def add_segment_listener(self, listener):
+        self.segment_listeners.append(listener)
+
+    def add_live_listener(self, init_listener, fragment_listener):
+        self.fragment_listeners.append(fragment_listener)
+
+    def recent_segment_names(self):
+        return ["1.mp4"]
+
+    def live_init_segment(self):
+        return ("init", b"ftyp moov")
+
+    def is_recording(self):
+        return True
+
+    def segment(self, last_received):
+        return ("2.mp4", b"segment after " + last_received.encode())
+
+    def segment_data(self, filename):
+        raise FileNotFoundError(filename)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert condition()
+
+
+@pytest.fixture
+def connected():
+    camera_manager = FakeCameraManager()
+    server = ipc_asyncio.WebServerSide("127.0.0.1", 0)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    client = ipc_asyncio.CameraClientSide(camera_manager, "127.0.0.1", port, "cam1")
+
+    try:
+        wait_for(lambda: server.camera_ids() == ["cam1"])
+        yield (server, camera_manager)
+    finally:
+        client.stop()
+        server.stop()
+
+
+def test_requests_round_trip(connected):
+    (server, _) = connected
+
+    assert server.is_recording()
+    assert server.segment("1.mp4") == ("2.mp4", b"segment after 1.mp4")
+    assert server.segment("1.mp4", camera_id="cam1") == ("2.mp4", b"segment after 1.mp4")
+
+
+def test_errors_are_raised_by_the_request(connected):
+    (server, _) = connected
+
+    with pytest.raises(ipc.RequestError) as raised:
+        server.segment_data("missing.mp4")
+
+    assert raised.value.error == ipc.ERROR_NOT_FOUND
+
+    with pytest.raises(ConnectionError):
+        server.is_recording("cam2")
+
+
+def test_hello_sends_recent_segments_and_live_init(connected):
+    (server, _) = connected
+
+    assert server.segment_name("") == "1.mp4"
+    wait_for(lambda: server.live_init_segment() is not None)
+    assert server.live_init_segment() == ("init", b"ftyp moov")
+
+
+def test_segment_events_wake_waiters(connected):
+    (server, camera_manager) = connected
+
+    assert server.wait_for_segment_name("1.mp4", timeout=0.1) == ""
+
+    for listener in camera_manager.segment_listeners:
+        listener("2.mp4")
+
+    assert server.wait_for_segment_name("1.mp4", timeout=5) == "2.mp4"
+
+
+def test_live_fragments_wake_async_waiters(connected):
+    (server, camera_manager) = connected
+    fragment = LiveFragment(7, "init", 0.5, 1000.0, True, b"moof mdat")
+
+    # Waits on the event loop, as the webserver's handlers do
+    waiting = asyncio.run_coroutine_threadsafe(server.wait_for_live_fragment_async(None, timeout=5), server.loop)
+
+    for listener in camera_manager.fragment_listeners:
+        listener(fragment)
+
+    assert waiting.result(timeout=5) == fragment
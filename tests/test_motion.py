@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from motion import MotionDetector, MotionTrigger
+
+# Two 40x20 cameras side by side
+REGIONS = [("left", 0, 0, 40, 20), ("right", 40, 0, 40, 20)]
+
+
+def frame(left=0, right=0):
+    out = np.zeros((20, 80, 3), np.uint8)
+    out[:, :40] = left
+    out[:, 40:] = right
+    return out
+
+
+@pytest.fixture
+def detector():
+    return MotionDetector(REGIONS, downscale=4, pixel_threshold=25, background_rate=0.1)
+
+
+def test_first_frame_only_sets_the_background(detector):
+    assert detector.update(frame(left=255)) == {"left": 0.0, "right": 0.0}
+
+
+def test_only_the_changed_camera_scores(detector):
+    detector.update(frame())
+
+    scores = detector.update(frame(right=255))
+
+    assert scores["left"] == 0.0
+    assert scores["right"] == pytest.approx(1.0)
+
+
+def test_part_of_a_camera_changing_scores_that_fraction(detector):
+    detector.update(frame())
+    changed = frame()
+    changed[:, :20] = 255
+
+    assert detector.update(changed)["left"] == pytest.approx(0.5)
+
+
+def test_small_changes_are_ignored(detector):
+    detector.update(frame())
+
+    assert detector.update(frame(left=20, right=20)) == {"left": 0.0, "right": 0.0}
+
+
+def test_background_catches_up_with_a_lasting_change():
+    detector = MotionDetector(REGIONS, downscale=4, pixel_threshold=25, background_rate=0.5)
+    detector.update(frame())
+
+    for _ in range(10):
+        scores = detector.update(frame(left=255))
+
+    assert scores["left"] == 0.0
+
+
+class FakeRecorder:
+    def __init__(self):
+        self.recording = False
+        self.pre_roll_seconds = None
+
+    def is_recording(self):
+        return self.recording
+
+    def start_recording(self, pre_roll_seconds):
+        self.recording = True
+        self.pre_roll_seconds = pre_roll_seconds
+
+    def stop_recording(self):
+        self.recording = False
+
+
+@pytest.fixture
+def recorder():
+    return FakeRecorder()
+
+
+@pytest.fixture
+def trigger(recorder):
+    return MotionTrigger(recorder, score_threshold=0.1, pre_roll_seconds=3, post_roll_seconds=10)
+
+
+def test_motion_starts_recording_with_pre_roll(trigger, recorder):
+    trigger.update({"left": 0.05, "right": 0.0}, now=100)
+    assert not recorder.recording
+
+    trigger.update({"left": 0.05, "right": 0.2}, now=101)
+
+    assert recorder.recording
+    assert recorder.pre_roll_seconds == 3
+
+
+def test_recording_stops_after_post_roll_without_motion(trigger, recorder):
+    trigger.update({"left": 0.5}, now=100)
+    trigger.update({"left": 0.5}, now=105)
+
+    trigger.update({"left": 0.0}, now=114)
+    assert recorder.recording
+
+    trigger.update({"left": 0.0}, now=115)
+    assert not recorder.recording
+
+
+def test_recording_started_by_hand_is_left_alone(trigger, recorder):
+    recorder.start_recording(0)
+
+    trigger.update({"left": 0.5}, now=100)
+    trigger.update({"left": 0.0}, now=200)
+
+    assert recorder.recording
+    assert recorder.pre_roll_seconds == 0
+
+
+def test_recording_changed_by_hand_is_no_longer_stopped(trigger, recorder):
+    trigger.update({"left": 0.5}, now=100)
+    trigger.recording_changed_by_hand()
+
+    trigger.update({"left": 0.0}, now=200)
+
+    assert recorder.recording
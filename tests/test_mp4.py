@@ -0,0 +1,136 @@
+import struct
+
+import pytest
+
+import mp4
+
+TIMESCALE = 1000
+SAMPLE_DURATION = 40
+
+
+def box(box_type, *children):
+    content = b"".join(children)
+    return struct.pack(">I4s", 8 + len(content), box_type) + content
+
+
+def full_box(box_type, version, flags, *children):
+    return box(box_type, struct.pack(">B", version), flags.to_bytes(3, "big"), *children)
+
+
+def init_segment(trex_sample_flags=0):
+    avcc = box(b"avcC", bytes([1, 0x64, 0x00, 0x1F, 0xFF]))
+    avc1 = box(b"avc1", bytes(mp4.VISUAL_SAMPLE_ENTRY_SIZE), avcc)
+    stsd = full_box(b"stsd", 0, 0, struct.pack(">I", 1), avc1)
+    mdhd = full_box(b"mdhd", 0, 0, struct.pack(">IIII", 0, 0, TIMESCALE, 0))
+    tkhd = full_box(b"tkhd", 0, 0, struct.pack(">IIII", 0, 0, 1, 0))
+    trak = box(b"trak", tkhd, box(b"mdia", mdhd, box(b"minf", box(b"stbl", stsd))))
+    trex = full_box(b"trex", 0, 0, struct.pack(">IIIII", 1, 1, SAMPLE_DURATION, 0, trex_sample_flags))
+    return box(b"ftyp", b"isom") + box(b"moov", trak, box(b"mvex", trex))
+
+
+def fragment(decode_time, sample_count=3, first_sample_flags=None, sample_durations=None, tfhd_sample_flags=None):
+    tfhd_flags = 0x20000
+    tfhd_fields = struct.pack(">I", 1)
+    if tfhd_sample_flags is not None:
+        tfhd_flags |= 0x20
+        tfhd_fields += struct.pack(">I", tfhd_sample_flags)
+    tfhd = full_box(b"tfhd", 0, tfhd_flags, tfhd_fields)
+    tfdt = full_box(b"tfdt", 1, 0, struct.pack(">Q", decode_time))
+
+    trun_flags = 0x01
+    trun_fields = struct.pack(">Ii", sample_count, 0)
+    if first_sample_flags is not None:
+        trun_flags |= 0x04
+        trun_fields += struct.pack(">I", first_sample_flags)
+    if sample_durations is not None:
+        trun_flags |= 0x100 | 0x200
+        trun_fields += b"".join(struct.pack(">II", duration, 10) for duration in sample_durations)
+    trun = full_box(b"trun", 0, trun_flags, trun_fields)
+
+    moof = box(b"moof", full_box(b"mfhd", 0, 0, struct.pack(">I", 1)), box(b"traf", tfhd, tfdt, trun))
+    return moof + box(b"mdat", bytes(10 * sample_count))
+
+
+def test_iterate_boxes():
+    data = box(b"ftyp", b"isom") + box(b"free") + box(b"mdat", b"abc")
+
+    assert list(mp4.iterate_boxes(data)) == [(b"ftyp", 8, 12), (b"free", 20, 20), (b"mdat", 28, 31)]
+
+
+def test_iterate_boxes_with_large_and_open_ended_sizes():
+    large = struct.pack(">I4sQ", 1, b"mdat", 16 + 3) + b"abc"
+    open_ended = struct.pack(">I4s", 0, b"mdat") + b"abcd"
+
+    assert list(mp4.iterate_boxes(large)) == [(b"mdat", 16, 19)]
+    assert list(mp4.iterate_boxes(open_ended)) == [(b"mdat", 8, 12)]
+
+
+def test_iterate_boxes_stops_at_a_partial_header():
+    data = box(b"free") + b"\0\0\0"
+
+    assert [b[0] for b in mp4.iterate_boxes(data)] == [b"free"]
+
+
+@pytest.mark.parametrize("size", [4, 100])
+def test_iterate_boxes_rejects_invalid_sizes(size):
+    data = struct.pack(">I4s", size, b"free") + bytes(8)
+
+    with pytest.raises(ValueError):
+        list(mp4.iterate_boxes(data))
+
+
+def test_find_box():
+    data = init_segment()
+
+    (start, end) = mp4.find_box(data, [b"moov", b"trak", b"mdia", b"mdhd"])
+    assert data[start - 4:start] == b"mdhd"
+    assert end - start == 20
+
+    assert mp4.find_box(data, [b"moov", b"udta"]) is None
+    assert mp4.find_box(data, [b"moof"]) is None
+
+
+def test_init_segment_info():
+    data = init_segment(trex_sample_flags=mp4.SAMPLE_IS_NON_SYNC)
+
+    assert mp4.timescale(data) == TIMESCALE
+    assert mp4.default_sample_flags(data) == mp4.SAMPLE_IS_NON_SYNC
+    assert mp4.avc_codec_string(data) == "avc1.64001F"
+
+
+def test_init_segment_size():
+    init = init_segment()
+
+    assert mp4.init_segment_size(init + fragment(0) + fragment(120)) == len(init)
+
+    with pytest.raises(ValueError):
+        mp4.init_segment_size(init)
+
+
+def test_fragment_decode_time():
+    assert mp4.fragment_decode_time(fragment(2 ** 40)) == 2 ** 40
+
+    with pytest.raises(ValueError):
+        mp4.fragment_decode_time(box(b"moof"))
+
+
+def test_fragment_starts_with_keyframe():
+    assert mp4.fragment_starts_with_keyframe(fragment(0, first_sample_flags=0))
+    assert not mp4.fragment_starts_with_keyframe(fragment(0, first_sample_flags=mp4.SAMPLE_IS_NON_SYNC))
+
+    # Without flags of its own, the fragment goes by the tfhd's defaults and then the trex's
+    assert not mp4.fragment_starts_with_keyframe(fragment(0), mp4.SAMPLE_IS_NON_SYNC)
+    assert mp4.fragment_starts_with_keyframe(fragment(0, tfhd_sample_flags=0), mp4.SAMPLE_IS_NON_SYNC)
+    assert mp4.fragment_starts_with_keyframe(fragment(0))
+
+
+def test_fragmented_duration():
+    data = init_segment() + fragment(0) + fragment(3 * SAMPLE_DURATION)
+
+    assert mp4.fragmented_duration(data) == 6 * SAMPLE_DURATION / TIMESCALE
+
+
+def test_fragmented_duration_with_sample_durations():
+    data = init_segment() + fragment(1000, first_sample_flags=0, sample_durations=[40, 50, 60])
+
+    assert mp4.fragmented_duration(data) == 150 / TIMESCALE
@@ -0,0 +1,84 @@
+import os
+import time
+import uuid
+
+import numpy as np
+import pytest
+
+import ffmpeg
+import mp4
+from frame_ring import FrameRing
+from recorder import CaptureClock
+
+FPS = 10
+
+
+@pytest.fixture
+def ring():
+    ring = FrameRing.create(f"camera-streamer-test-{uuid.uuid4().hex[:8]}", 4, 2, 4)
+    yield ring
+    ring.release()
+
+
+def capture(ring, timestamp):
+    ring.write(np.zeros((2, 4, 3), np.uint8), timestamp)
+    return ring.latest()
+
+
+def test_frames_are_written_a_frame_interval_after_capture(ring):
+    clock = CaptureClock(ring, FPS)
+    frame = capture(ring, time.time())
+
+    assert clock.wait_until_due(frame)
+    assert time.time() >= frame.timestamp + 1 / FPS
+
+
+def test_late_frames_are_written_straight_away(ring):
+    clock = CaptureClock(ring, FPS)
+    frame = capture(ring, time.time() - 1)
+
+    start = time.time()
+    assert clock.wait_until_due(frame)
+    assert time.time() - start < 1 / FPS
+
+
+def test_captures_no_newer_than_the_last_are_duplicates(ring):
+    clock = CaptureClock(ring, FPS)
+
+    assert clock.wait_until_due(capture(ring, 100.0))
+    assert not clock.wait_until_due(capture(ring, 100.0))
+    assert not clock.wait_until_due(capture(ring, 99.0))
+    assert clock.wait_until_due(capture(ring, 100.1))
+    assert (clock.duplicated, clock.dropped) == (2, 0)
+
+
+def test_frames_overwritten_while_waiting_are_dropped(ring):
+    clock = CaptureClock(ring, FPS)
+    frame = capture(ring, 100.0)
+    for i in range(4):
+        capture(ring, 100.1 + i)
+
+    assert not clock.wait_until_due(frame)
+    assert clock.dropped == 1
+
+
+def test_variable_frame_rate_segments_keep_capture_times(tmp_path, monkeypatch):
+    imageio_ffmpeg = pytest.importorskip("imageio_ffmpeg")
+    monkeypatch.setattr(ffmpeg, "FFMPEG_EXE", imageio_ffmpeg.get_ffmpeg_exe())
+
+    process = ffmpeg.start_segment_encoder(
+        64, 48, FPS, 60, str(tmp_path / "%Y-%m-%d-%H-%M-%S.mp4"), variable_frame_rate=True)
+    # Half the camera's frame rate - at a constant frame rate, the video would only be half as long
+    for _ in range(6):
+        process.stdin.write(bytes(64 * 48 * 3))
+        process.stdin.flush()
+        time.sleep(2 / FPS)
+    process.stdin.close()
+    segments = [os.fsdecode(line.strip()) for line in process.stdout]
+    process.wait()
+
+    with open(tmp_path / segments[0], "rb") as f:
+        duration = mp4.fragmented_duration(f.read())
+
+    # Five gaps between the frames, and however long ffmpeg guesses the last frame lasts
+    assert duration == pytest.approx(5 * 2 / FPS, abs=2 / FPS)
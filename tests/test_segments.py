@@ -0,0 +1,146 @@
+import threading
+import time
+
+import pytest
+
+from segments import SegmentCache, next_segment_name, RECENT_SEGMENTS
+
+
+def test_next_segment_name_with_no_segments():
+    assert next_segment_name([], "") == ""
+
+
+def test_next_segment_name_follows_last_received():
+    segments = ["a.mp4", "b.mp4", "c.mp4"]
+
+    assert next_segment_name(segments, "a.mp4") == "b.mp4"
+    assert next_segment_name(segments, "b.mp4") == "c.mp4"
+    assert next_segment_name(segments, "c.mp4") == ""
+
+
+def test_next_segment_name_for_a_new_viewer():
+    # Starts a segment back from the latest so there's one to buffer ahead
+    assert next_segment_name(["a.mp4", "b.mp4", "c.mp4"], "") == "b.mp4"
+    assert next_segment_name(["a.mp4"], "") == "a.mp4"
+
+
+def test_next_segment_name_only_looks_at_recent_segments():
+    segments = [f"{i}.mp4" for i in range(RECENT_SEGMENTS + 5)]
+
+    assert next_segment_name(segments, "0.mp4") == segments[-2]
+    assert next_segment_name(segments, segments[-RECENT_SEGMENTS]) == segments[-RECENT_SEGMENTS + 1]
+
+
+def test_cache_hits():
+    cache = SegmentCache(100)
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return b"data"
+
+    assert cache.get("a", fetch) == b"data"
+    assert cache.get("a", fetch) == b"data"
+
+    assert len(fetches) == 1
+    assert cache.stats() == {"segments": 1, "bytes": 4, "hits": 1, "misses": 1, "coalesced": 0}
+
+
+def test_empty_results_are_not_cached():
+    cache = SegmentCache(100)
+
+    assert cache.get("a", lambda: b"") == b""
+    assert cache.get("a", lambda: b"data") == b"data"
+    assert cache.stats()["misses"] == 2
+
+
+def test_least_recently_used_segments_are_evicted():
+    cache = SegmentCache(10)
+    cache.get("a", lambda: b"aaaa")
+    cache.get("b", lambda: b"bbbb")
+    cache.get("a", lambda: b"")
+    cache.get("c", lambda: b"cccc")
+
+    assert list(cache.segments) == ["a", "c"]
+    assert cache.stats()["bytes"] == 8
+
+    # Too big to ever fit, so it's handed back without evicting anything
+    assert cache.get("d", lambda: b"d" * 11) == b"d" * 11
+    assert list(cache.segments) == ["a", "c"]
+
+
+def test_concurrent_gets_share_one_fetch():
+    cache = SegmentCache(100)
+    fetching = threading.Event()
+    release = threading.Event()
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        fetching.set()
+        release.wait(5)
+        return b"data"
+
+    results = []
+    fetcher = threading.Thread(target=lambda: results.append(cache.get("a", fetch)))
+    fetcher.start()
+    fetching.wait(5)
+
+    waiters = [threading.Thread(target=lambda: results.append(cache.get("a", fetch))) for _ in range(3)]
+    for waiter in waiters:
+        waiter.start()
+    while cache.stats()["coalesced"] < len(waiters):
+        time.sleep(0.001)
+
+    release.set()
+    for thread in [fetcher] + waiters:
+        thread.join(5)
+
+    assert results == [b"data"] * 4
+    assert len(fetches) == 1
+    assert cache.stats()["coalesced"] == 3
+
+
+def test_failed_fetch_is_raised_to_waiters_and_not_cached():
+    cache = SegmentCache(100)
+    fetching = threading.Event()
+    release = threading.Event()
+
+    def fetch():
+        fetching.set()
+        release.wait(5)
+        raise TimeoutError("camera didn't respond")
+
+    errors = []
+
+    def get():
+        try:
+            cache.get("a", fetch)
+        except TimeoutError as ex:
+            errors.append(ex)
+
+    fetcher = threading.Thread(target=get)
+    fetcher.start()
+    fetching.wait(5)
+    waiter = threading.Thread(target=get)
+    waiter.start()
+    while cache.stats()["coalesced"] < 1:
+        time.sleep(0.001)
+
+    release.set()
+    fetcher.join(5)
+    waiter.join(5)
+
+    assert len(errors) == 2
+    assert cache.get("a", lambda: b"data") == b"data"
+
+
+def test_fetch_errors_propagate():
+    cache = SegmentCache(100)
+
+    def fetch():
+        raise FileNotFoundError("a")
+
+    with pytest.raises(FileNotFoundError):
+        cache.get("a", fetch)
+    assert cache.fetching == {}